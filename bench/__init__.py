@@ -0,0 +1,3 @@
+"""
+Офлайн бенчмарк: локальные стенды Firebase и Telegram и генератор нагрузки
+"""
@@ -0,0 +1,193 @@
+"""
+Локальная замена Firebase Realtime Database
+REST (GET/PUT/PATCH/POST/DELETE на /path.json с запросами orderBy/startAt/...)
+и потоковое чтение (text/event-stream) с событиями put/patch, как у настоящей базы.
+"""
+
+import asyncio
+import json
+import time
+from collections import Counter
+
+from firebase_store import MemoryBackend, _apply_query, compute_etag, normalize_path, push_key
+
+from bench.httpserver import HttpServer, Response, StreamResponse
+
+
+def _query_from_params(params):
+    """Параметры запроса REST (JSON значения) → словарь для _apply_query"""
+    query = {}
+    for name in ('orderBy', 'startAt', 'endAt', 'equalTo'):
+        if name in params:
+            query[name] = json.loads(params[name])
+    for name in ('limitToFirst', 'limitToLast'):
+        if name in params:
+            query[name] = int(params[name])
+    return query
+
+
+def _is_under(path, parent):
+    return parent == '' or path == parent or path.startswith(parent + '/')
+
+
+class Subscription:
+    """Один открытый поток слушателя"""
+
+    __slots__ = ('path', 'query', 'queue')
+
+    def __init__(self, path, query):
+        self.path = path
+        self.query = query
+        self.queue = asyncio.Queue()
+
+    def accepts_child(self, value):
+        """Проходит ли дочерний узел фильтр запроса (для orderBy по полю)"""
+        order_by = self.query.get('orderBy')
+        if not order_by or order_by.startswith('$'):
+            return True
+        field = value.get(order_by) if isinstance(value, dict) else None
+        if field is None:
+            return False
+        if 'startAt' in self.query and field < self.query['startAt']:
+            return False
+        if 'endAt' in self.query and field > self.query['endAt']:
+            return False
+        if 'equalTo' in self.query and field != self.query['equalTo']:
+            return False
+        return True
+
+
+class FakeRealtimeDatabase:
+    """Стенд базы: данные в памяти, счётчики запросов, хуки на запись"""
+
+    def __init__(self, data=None, keepalive=30.0):
+        self.db = MemoryBackend(data)
+        self.keepalive = keepalive
+        self.server = HttpServer(self.handle)
+        self.requests = Counter()       # метод → число REST запросов
+        self.streams_opened = 0
+        self.write_hooks = []           # hook(method, path, value, t) после каждой записи
+        self._subscriptions = set()
+
+    @property
+    def url(self):
+        return self.server.url
+
+    async def start(self):
+        await self.server.start()
+        return self
+
+    async def stop(self):
+        await self.server.stop()
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    # ---------- HTTP ----------
+
+    async def handle(self, request):
+        if not request.path.endswith('.json'):
+            return Response.json({'error': 'not found'}, status=404)
+        path = normalize_path(request.path[:-len('.json')])
+        params = request.query
+
+        if request.method == 'GET' and 'text/event-stream' in request.headers.get('accept', ''):
+            return self._stream(path, _query_from_params(params))
+
+        self.requests[request.method] += 1
+        silent = params.get('print') == 'silent'
+
+        # Условная запись: if-match с ETag, при расхождении 412 и текущее значение
+        if_match = request.headers.get('if-match')
+        if if_match is not None and request.method in ('PUT', 'DELETE'):
+            current = self.db.read(path)
+            if compute_etag(current) != if_match:
+                self.requests['412'] += 1
+                return Response.json(current, status=412, headers={'ETag': compute_etag(current)})
+
+        if request.method == 'GET':
+            value = self.db.read(path)
+            if request.headers.get('x-firebase-etag') == 'true':
+                return Response.json(value, headers={'ETag': compute_etag(value)})
+            if params.get('shallow') == 'true' and isinstance(value, dict):
+                value = {key: True if isinstance(child, dict) else child for key, child in value.items()}
+            else:
+                query = _query_from_params(params)
+                if query and isinstance(value, dict):
+                    value = _apply_query(value, query)
+            return Response.json(value)
+
+        body = request.json()
+        if request.method == 'PUT':
+            self._write(path, body, 'PUT')
+            if request.headers.get('x-firebase-etag') == 'true':
+                return Response.json(body, headers={'ETag': compute_etag(self.db.read(path))})
+            return Response(204) if silent else Response.json(body)
+        if request.method == 'PATCH':
+            for child, value in (body or {}).items():
+                self._write(f"{path}/{normalize_path(child)}" if path else normalize_path(child), value, 'PATCH')
+            return Response(204) if silent else Response.json(body)
+        if request.method == 'POST':
+            key = push_key()
+            self._write(f"{path}/{key}", body, 'POST')
+            return Response.json({'name': key})
+        if request.method == 'DELETE':
+            self._write(path, None, 'DELETE')
+            return Response(204) if silent else Response.json(None)
+        return Response.json({'error': 'method not allowed'}, status=405)
+
+    # ---------- запись и уведомления ----------
+
+    def _write(self, path, value, method):
+        self.db.write(path, value)
+        now = time.perf_counter()
+        for hook in self.write_hooks:
+            hook(method, path, value, now)
+        self._notify(path)
+
+    def _notify(self, path):
+        for sub in list(self._subscriptions):
+            if _is_under(path, sub.path):
+                rel = path[len(sub.path):].lstrip('/')
+                value = self.db.read(path)
+                first = rel.split('/', 1)[0]
+                if sub.query and '/' not in rel and value is not None and not sub.accepts_child(value):
+                    continue
+                if sub.query and '/' in rel and not sub.accepts_child(self.db.read(f"{sub.path}/{first}")):
+                    continue
+                sub.queue.put_nowait(('put', {'path': '/' + rel, 'data': value}))
+            elif _is_under(sub.path, path):
+                sub.queue.put_nowait(('put', {'path': '/', 'data': self._snapshot(sub)}))
+
+    def _snapshot(self, sub):
+        value = self.db.read(sub.path)
+        if sub.query and isinstance(value, dict):
+            value = _apply_query(value, sub.query)
+        return value
+
+    def _stream(self, path, query):
+        sub = Subscription(path, query)
+        self.streams_opened += 1
+
+        async def stream(writer):
+            self._subscriptions.add(sub)
+            try:
+                await self._send(writer, 'put', {'path': '/', 'data': self._snapshot(sub)})
+                while True:
+                    try:
+                        event, payload = await asyncio.wait_for(sub.queue.get(), self.keepalive)
+                    except asyncio.TimeoutError:
+                        await self._send(writer, 'keep-alive', None)
+                        continue
+                    await self._send(writer, event, payload)
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            finally:
+                self._subscriptions.discard(sub)
+
+        return StreamResponse(stream)
+
+    @staticmethod
+    async def _send(writer, event, payload):
+        writer.write(f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+        await writer.drain()
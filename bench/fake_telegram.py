@@ -0,0 +1,153 @@
+"""
+Локальная замена Telegram Bot API
+Отвечает на методы, которые вызывает бот, записывает отправленные сообщения
+и может изображать лимит группы (429 с retry_after).
+"""
+
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qsl
+
+from bench.httpserver import HttpServer, Response
+
+# Поля, которые приходят строкой и не должны разбираться как JSON
+RAW_FIELDS = {'text', 'chat_id', 'from_chat_id', 'callback_query_id', 'secret_token', 'url'}
+
+
+def _parse_params(request):
+    content_type = request.headers.get('content-type', '')
+    if 'application/json' in content_type:
+        return request.json() or {}
+    params = {}
+    for name, value in parse_qsl(request.body.decode('utf-8'), keep_blank_values=True):
+        if name in RAW_FIELDS:
+            params[name] = value
+            continue
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+class FakeTelegram:
+    """Стенд Bot API: /bot<token>/<method>"""
+
+    def __init__(self, group_limit_per_min=None, bot_id=1000):
+        self.server = HttpServer(self.handle)
+        self.group_limit_per_min = group_limit_per_min
+        self.bot_id = bot_id
+        self.calls = Counter()           # метод → число вызовов
+        self.sent = []                   # (время, chat_id, text)
+        self.message_hooks = []          # hook(chat_id, text, t) на каждое отправленное сообщение
+        self.rate_limited = 0
+        self._message_id = 0
+        self._recent = defaultdict(deque)  # chat_id → времена отправок за минуту
+
+    @property
+    def url(self):
+        return self.server.url
+
+    @property
+    def base_url(self):
+        """Для Application.builder().base_url(...)"""
+        return f"{self.server.url}/bot"
+
+    async def start(self):
+        await self.server.start()
+        return self
+
+    async def stop(self):
+        await self.server.stop()
+
+    # ---------- HTTP ----------
+
+    async def handle(self, request):
+        method = request.path.rstrip('/').rsplit('/', 1)[-1]
+        params = _parse_params(request)
+        self.calls[method] += 1
+
+        handler = getattr(self, f"_m_{method}", None)
+        if handler is None:
+            return self._ok(True)
+        return await handler(params)
+
+    def _ok(self, result):
+        return Response.json({'ok': True, 'result': result})
+
+    def _retry_after(self, seconds):
+        self.rate_limited += 1
+        return Response.json({
+            'ok': False,
+            'error_code': 429,
+            'description': f"Too Many Requests: retry after {seconds}",
+            'parameters': {'retry_after': seconds},
+        }, status=429)
+
+    def _limited(self, chat_id, count=1):
+        """Лимит группы: не больше group_limit_per_min сообщений в минуту"""
+        if not self.group_limit_per_min or not str(chat_id).startswith('-'):
+            return 0
+        now = time.monotonic()
+        recent = self._recent[str(chat_id)]
+        while recent and now - recent[0] > 60:
+            recent.popleft()
+        if len(recent) + count > self.group_limit_per_min:
+            return max(1, int(60 - (now - recent[0])) + 1)
+        recent.extend([now] * count)
+        return 0
+
+    def _message(self, chat_id, text=None):
+        self._message_id += 1
+        message = {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'supergroup' if str(chat_id).startswith('-') else 'private'},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench'},
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    def _record(self, chat_id, text):
+        now = time.perf_counter()
+        self.sent.append((now, str(chat_id), text))
+        for hook in self.message_hooks:
+            hook(str(chat_id), text, now)
+
+    # ---------- методы Bot API ----------
+
+    async def _m_getMe(self, params):
+        return self._ok({
+            'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+            'can_join_groups': True, 'can_read_all_group_messages': True, 'supports_inline_queries': False,
+        })
+
+    async def _m_getUpdates(self, params):
+        await asyncio.sleep(min(float(params.get('timeout', 0) or 0), 1.0))
+        return self._ok([])
+
+    async def _m_sendMessage(self, params):
+        chat_id = params['chat_id']
+        retry = self._limited(chat_id)
+        if retry:
+            return self._retry_after(retry)
+        self._record(chat_id, params.get('text', ''))
+        return self._ok(self._message(chat_id, params.get('text', '')))
+
+    async def _m_copyMessages(self, params):
+        ids = params.get('message_ids', [])
+        retry = self._limited(params['chat_id'])
+        if retry:
+            return self._retry_after(retry)
+        for _ in ids:
+            self._record(params['chat_id'], '')
+        return self._ok([{'message_id': self._message(params['chat_id'])['message_id']} for _ in ids])
+
+    async def _m_forwardMessages(self, params):
+        return await self._m_copyMessages(params)
+
+    async def _m_editMessageText(self, params):
+        return self._ok(self._message(params.get('chat_id', -1), params.get('text', '')))
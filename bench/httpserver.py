@@ -0,0 +1,157 @@
+"""
+Минимальный HTTP/1.1 сервер на asyncio для локальных стендов
+Keep-alive, Content-Length тела, потоковые ответы (SSE) - ровно то, что нужно клиентам бота.
+"""
+
+import asyncio
+import json
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+REASONS = {
+    200: 'OK', 204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 412: 'Precondition Failed',
+    429: 'Too Many Requests', 500: 'Internal Server Error',
+}
+
+
+class Request:
+    """Разобранный HTTP запрос"""
+
+    __slots__ = ('method', 'path', 'query', 'headers', 'body')
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+class Response:
+    """Обычный ответ целиком"""
+
+    __slots__ = ('status', 'body', 'headers')
+
+    def __init__(self, status=200, body=b'', headers=None, content_type='application/json'):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else body.encode('utf-8')
+        self.headers = {'Content-Type': content_type, **(headers or {})}
+
+    @classmethod
+    def json(cls, data, status=200, headers=None):
+        return cls(status, json.dumps(data, ensure_ascii=False), headers)
+
+
+class StreamResponse:
+    """Потоковый ответ: stream(writer) пишет в соединение, пока его не закроют"""
+
+    def __init__(self, stream, headers=None):
+        self.stream = stream
+        self.headers = headers or {}
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = b''
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).strip() or b'0', 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    elif headers.get('content-length'):
+        body = await reader.readexactly(int(headers['content-length']))
+
+    parts = urlsplit(target)
+    return Request(method.upper(), unquote(parts.path), dict(parse_qsl(parts.query)), headers, body)
+
+
+def encode_head(status, headers):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+class HttpServer:
+    """Сервер с одним async обработчиком handler(request) → Response | StreamResponse"""
+
+    def __init__(self, handler, host='127.0.0.1', port=0):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self._server = None
+        self._streams = set()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def close_streams(self):
+        """Оборвать открытые потоковые ответы (слушатели увидят разрыв соединения)"""
+        for writer in list(self._streams):
+            writer.close()
+
+    async def stop(self):
+        self.close_streams()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                try:
+                    response = await self.handler(request)
+                except Exception as e:
+                    response = Response.json({'error': repr(e)}, status=500)
+
+                if isinstance(response, StreamResponse):
+                    headers = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                               'Connection': 'close', **response.headers}
+                    writer.write(encode_head(200, headers))
+                    await writer.drain()
+                    self._streams.add(writer)
+                    try:
+                        await response.stream(writer)
+                    finally:
+                        self._streams.discard(writer)
+                    break
+
+                headers = {**response.headers, 'Content-Length': str(len(response.body)),
+                           'Connection': 'keep-alive'}
+                writer.write(encode_head(response.status, headers) + response.body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,162 @@
+"""
+Офлайн сценарий аренды лидера (режим multi)
+Два держателя LeaderLease на локальном стенде Firebase: захват, продление, передача при
+остановке, перехват после падения и долгий on_acquire. Каждые 20 мс проверяется, что
+лидер не больше одного.
+
+    python -m bench.lease --ttl 3
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from bench.fake_rtdb import FakeRealtimeDatabase
+
+LEASE_REF = 'bot/lease'
+
+
+class Watcher:
+    """Опрос is_leader всех держателей: сколько раз лидеров было двое и когда лидером стал каждый"""
+
+    def __init__(self, leases):
+        self.leases = leases
+        self.overlaps = 0
+        self.samples = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            leaders = [lease for lease in self.leases if lease.is_leader]
+            self.samples += 1
+            if len(leaders) > 1:
+                self.overlaps += 1
+            await asyncio.sleep(0.02)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def wait_leader(lease, timeout):
+    """Секунд до лидерства lease или None, если не дождались"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if lease.is_leader:
+            return time.perf_counter() - started
+        await asyncio.sleep(0.02)
+    return None
+
+
+async def crash(lease):
+    """Оборвать продление без release. Отмену повторяем, пока таск не завершится: на 3.11
+    asyncio.wait_for теряет отмену, пришедшую в момент ответа Firebase"""
+    task = lease._task
+    while not task.done():
+        task.cancel()
+        await asyncio.wait({task}, timeout=0.05)
+
+
+async def wait_expired(store, timeout):
+    """Дождаться, пока запись аренды истечёт по expiresAt; False - не дождались"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        current = await store.get(LEASE_REF)
+        if not isinstance(current, dict) or current.get('expiresAt', 0) <= time.time() * 1000:
+            return True
+        await asyncio.sleep(0.02)
+    return False
+
+
+def check(results, name, ok, detail):
+    results.append(ok)
+    print(f"   {'✅' if ok else '❌'} {name:<34} {detail}")
+
+
+async def run(args):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from firebase_store import FirebaseStore, RestBackend
+    from leader_lease import LeaderLease
+
+    rtdb = await FakeRealtimeDatabase().start()
+    store = FirebaseStore(RestBackend(f"{rtdb.url}?ns=bench"))
+    ttl = args.ttl
+    results = []
+    slow_acquire = args.slow_acquire * ttl
+
+    async def slow(epoch):
+        # Лидер долго поднимается (слушатели ждут первого события): аренда не должна истечь
+        await asyncio.sleep(slow_acquire)
+
+    first = LeaderLease(store, LEASE_REF, 'worker-a', ttl=ttl, clock_skew=ttl / 8)
+    second = LeaderLease(store, LEASE_REF, 'worker-b', ttl=ttl, clock_skew=ttl / 8, on_acquire=slow)
+    watcher = Watcher([first, second])
+    watcher.start()
+
+    print()
+    print(f"👑 Сценарий аренды лидера (ttl {ttl:.1f} с)")
+
+    # Захват: свободная аренда берётся первым раундом
+    first.start()
+    took = await wait_leader(first, ttl)
+    check(results, "захват свободной аренды", took is not None, f"{(took or 0) * 1000:.0f} мс")
+
+    # Продление: второй кандидат всё это время не лидер, эпоха не меняется
+    second.start()
+    await asyncio.sleep(ttl * 2)
+    check(results, "продление (2 ttl)", first.is_leader and not second.is_leader and first.epoch == 1,
+          f"эпоха {first.epoch}, у второго {second.epoch}")
+
+    # Передача при остановке: лидер отдаёт аренду, второй берёт её со следующего раунда
+    started = time.perf_counter()
+    await first.stop()
+    took = await wait_leader(second, ttl * 2)
+    check(results, "передача при остановке", took is not None and took < ttl,
+          f"{(time.perf_counter() - started) * 1000:.0f} мс, эпоха {second.epoch}")
+
+    # Долгий on_acquire (дольше аренды): лидерство держится, пока поднимаемся
+    await asyncio.sleep(slow_acquire + ttl)
+    check(results, f"on_acquire {slow_acquire:.1f} с > ttl", second.is_leader and second.lost == 0,
+          f"потерь {second.lost}, эпоха {second.epoch}")
+
+    # Падение лидера: продление прекращается без release. Отсчёт - с момента, когда запись аренды
+    # истекла: дальше перехват зависит только от раунда кандидата, а не от того, где оборвалось продление
+    await crash(second)
+    expired = await wait_expired(store, ttl * 2)
+    third = LeaderLease(store, LEASE_REF, 'worker-c', ttl=ttl, clock_skew=ttl / 8)
+    watcher.leases.append(third)
+    third.start()
+    took = await wait_leader(third, ttl * 2)
+    check(results, "перехват после падения",
+          expired and took is not None and took < ttl and third.epoch == second.epoch + 1,
+          f"{(took or 0) * 1000:.0f} мс после истечения, эпоха {third.epoch}")
+
+    await watcher.stop()
+    check(results, "не больше одного лидера", watcher.overlaps == 0,
+          f"двое лидеров в {watcher.overlaps} из {watcher.samples} проверок")
+
+    await third.stop()
+    await store.close()
+    await rtdb.stop()
+    return all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн сценарий аренды лидера")
+    parser.add_argument('--ttl', type=float, default=3, help="аренда, секунды")
+    parser.add_argument('--slow-acquire', type=float, default=1.5,
+                        help="длительность on_acquire второго держателя в долях ttl")
+    ok = asyncio.run(run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
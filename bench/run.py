@@ -0,0 +1,261 @@
+"""
+Офлайн бенчмарк бота целиком
+Поднимает локальные стенды Firebase и Telegram, гоняет handle_message, reaction_callback и
+доставку с сайта (process_firebase_messages) с заданной частотой и печатает задержки.
+
+    python -m bench.run --duration 20 --tg-rate 5 --site-rate 2 --reaction-rate 10
+    python -m bench.run --multi --rat
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from bench.fake_rtdb import FakeRealtimeDatabase
+from bench.fake_telegram import FakeTelegram
+
+CHAT_ID = '-1001000000001'
+RAT_CHAT_ID = '-1001000000002'
+TOKEN_RE = re.compile(r'#(\d+)')
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Direction:
+    """Замеры одного направления: время старта по токену → задержка доставки"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = {}
+        self.latencies = []
+
+    def start(self, token):
+        self.started[token] = time.perf_counter()
+
+    def delivered(self, token, now):
+        t0 = self.started.pop(token, None)
+        if t0 is not None:
+            self.latencies.append(now - t0)
+
+    def report(self):
+        sent = len(self.latencies) + len(self.started)
+        return (
+            f"{self.name:<18} отправлено {sent:>6}  доставлено {len(self.latencies):>6}  "
+            f"p50 {percentile(self.latencies, 0.50) * 1000:8.1f} мс  "
+            f"p99 {percentile(self.latencies, 0.99) * 1000:8.1f} мс"
+        )
+
+
+async def paced(rate, duration, action):
+    """Вызывает action(i) с частотой rate в секунду в течение duration секунд"""
+    if rate <= 0:
+        return
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    i = 0
+    while time.perf_counter() - start < duration:
+        await action(i)
+        i += 1
+        delay = start + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run(args):
+    rtdb = await FakeRealtimeDatabase().start()
+    telegram = await FakeTelegram(group_limit_per_min=args.telegram_limit).start()
+
+    # Настройки бота - до импорта, он читает окружение при загрузке
+    state_dir = tempfile.mkdtemp(prefix='dpbot-bench-')
+    os.environ.update({
+        'BOT_TOKEN': '123456:bench',
+        'CHAT_ID': CHAT_ID,
+        'RAT_CHAT_ID': RAT_CHAT_ID,
+        'FIREBASE_DATABASE_URL': f"{rtdb.url}?ns=bench",
+        'FIREBASE_BACKEND': 'rest',
+        'STATE_DIR': state_dir,
+        'TG_GROUP_RATE_PER_MIN': str(args.tg_group_rate),
+        'CHAT_RETENTION_DAYS': '0',
+        'CHAT_MAX_MESSAGES': '0',
+        'METRICS_PORT': '0',
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+    if args.multi:
+        # Один воркер в режиме multi: аренда лидера и ключи доставки на том же стенде
+        os.environ['WORKER_MODE'] = 'multi'
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    import bot
+    from telegram import Update
+    from telegram.ext import Application
+
+    room = bot.routes.default
+    app = Application.builder().token(bot.BOT_TOKEN).base_url(telegram.base_url).build()
+    await app.initialize()
+    await bot.post_init(app)
+    context = SimpleNamespace(bot=app.bot, args=[])
+
+    if args.rat:
+        # RAT режим: сообщения группы дублируются в RAT группу, сайт пишет туда же
+        await bot.store.set(room.rat_mode_ref, {'active': True})
+        for _ in range(50):
+            if room.is_rat_active():
+                break
+            await asyncio.sleep(0.1)
+
+    tg_to_site = Direction('Telegram→сайт')
+    site_to_tg = Direction('сайт→Telegram')
+    reactions = Direction('реакции')
+    pending_taps = {}  # (uid, emoji) → [токены нажатий]
+
+    def on_rtdb_write(method, path, value, now):
+        if not isinstance(value, dict):
+            return
+        if path.startswith(room.chat_ref) and value.get('fromTelegram'):
+            for token in TOKEN_RE.findall(value.get('text', '')):
+                tg_to_site.delivered(token, now)
+        elif path.startswith(room.reactions_ref):
+            for token in pending_taps.pop((value.get('uid'), value.get('emoji')), []):
+                reactions.delivered(token, now)
+
+    def on_telegram_message(chat_id, text, now):
+        for token in TOKEN_RE.findall(text):
+            site_to_tg.delivered(token, now)
+
+    rtdb.write_hooks.append(on_rtdb_write)
+    telegram.message_hooks.append(on_telegram_message)
+
+    # ---------- генераторы нагрузки ----------
+
+    update_ids = iter(range(1, 10 ** 9))
+
+    def user(i):
+        uid = 5000 + i % args.users
+        return {'id': uid, 'is_bot': False, 'first_name': f"User{uid}"}
+
+    async def tg_message(i):
+        token = str(i)
+        tg_to_site.start(token)
+        update = Update.de_json({
+            'update_id': next(update_ids),
+            'message': {
+                'message_id': i + 1,
+                'date': int(time.time()),
+                'chat': {'id': int(CHAT_ID), 'type': 'supergroup'},
+                'from': user(i),
+                'text': f"сообщение из Telegram #{token}",
+            },
+        }, app.bot)
+        await bot.handle_message(update, context)
+
+    async def site_message(i):
+        token = f"{10 ** 8 + i}"
+        site_to_tg.start(token)
+        await bot.store.push(room.chat_ref, {
+            'uid': f"site_{i % args.users}",
+            'name': f"Гость {i % args.users}",
+            'color': '#ff00ff',
+            'text': f"сообщение с сайта #{token}",
+            't': int(time.time() * 1000),
+        })
+
+    async def reaction(i):
+        token = f"r{i}"
+        emoji = bot.render.SITE_EMOJIS[i % len(bot.render.SITE_EMOJIS)]
+        tg_user = user(i)
+        pending_taps.setdefault((f"tg_{tg_user['id']}", emoji), []).append(token)
+        reactions.start(token)
+        update = Update.de_json({
+            'update_id': next(update_ids),
+            'callback_query': {
+                'id': str(i),
+                'from': tg_user,
+                'chat_instance': 'bench',
+                'data': f"react_{emoji}",
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': int(CHAT_ID), 'type': 'supergroup'},
+                    'text': 'menu',
+                },
+            },
+        }, app.bot)
+        await bot.reaction_callback(update, context)
+
+    # Сайт пишет своим клиентом - его запросы не должны попасть в счёт бота
+    site_requests_before = rtdb.total_requests()
+    started = time.perf_counter()
+    if args.multi:
+        print(f"👑 Лидер: {bot.lease.is_leader} (эпоха {bot.lease.epoch})")
+
+    await asyncio.gather(
+        paced(args.tg_rate, args.duration, tg_message),
+        paced(args.site_rate, args.duration, site_message),
+        paced(args.reaction_rate, args.duration, reaction),
+    )
+
+    # Даём очередям дослать хвост
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline and (tg_to_site.started or site_to_tg.started or reactions.started):
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    await bot.post_shutdown(app)
+    await app.shutdown()
+
+    # ---------- отчёт ----------
+
+    delivered = len(tg_to_site.latencies) + len(site_to_tg.latencies) + len(reactions.latencies)
+    site_writes = int(args.site_rate * args.duration)
+    bot_requests = rtdb.total_requests() - site_requests_before - site_writes
+    telegram_calls = sum(telegram.calls.values()) - telegram.calls['getMe']
+
+    print()
+    print("📊 Результаты бенчмарка")
+    print(f"   длительность {elapsed:.1f} с, пользователей {args.users}")
+    for direction in (tg_to_site, site_to_tg, reactions):
+        print("   " + direction.report())
+    print(f"   пропускная способность: {delivered / elapsed:.1f} сообщений/с")
+    print(f"   запросов к Firebase от бота: {bot_requests} "
+          f"({bot_requests / max(1, delivered):.2f} на сообщение), потоков: {rtdb.streams_opened}")
+    print(f"   вызовов Telegram API: {telegram_calls}, 429: {telegram.rate_limited}, "
+          f"по методам: {dict(telegram.calls)}")
+
+    if args.rat:
+        mirrored = sum(1 for _, chat_id, _ in telegram.sent if chat_id == RAT_CHAT_ID)
+        rat_outbox = bot.outboxes[RAT_CHAT_ID].stats()
+        print(f"   RAT группа: сообщений {mirrored} (пересылок {rat_outbox['forwarded']}), "
+              f"вызовов API {rat_outbox['api_calls']}")
+
+    await rtdb.stop()
+    await telegram.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн бенчмарк DepressivePasties Bot")
+    parser.add_argument('--duration', type=float, default=10, help="секунд нагрузки")
+    parser.add_argument('--drain', type=float, default=30, help="сколько ждать хвост после нагрузки")
+    parser.add_argument('--tg-rate', type=float, default=5, help="сообщений из Telegram в секунду")
+    parser.add_argument('--site-rate', type=float, default=2, help="сообщений с сайта в секунду")
+    parser.add_argument('--reaction-rate', type=float, default=5, help="нажатий реакций в секунду")
+    parser.add_argument('--users', type=int, default=50, help="разных пользователей")
+    parser.add_argument('--tg-group-rate', type=float, default=20, help="лимит бота на группу, сообщений в минуту")
+    parser.add_argument('--telegram-limit', type=int, default=20,
+                        help="лимит стенда Telegram на группу в минуту (0 - без лимита)")
+    parser.add_argument('--multi', action='store_true', help="режим WORKER_MODE=multi (аренда лидера)")
+    parser.add_argument('--rat', action='store_true', help="включить RAT режим (дубли группы в RAT группу)")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
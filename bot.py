@@ -5,13 +5,17 @@ DepressivePasties Telegram Bot
 
 import os
 import asyncio
+import io
+import json
 import random
+import secrets
 import string
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from dotenv import load_dotenv
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -21,60 +25,206 @@ from telegram.ext import (
     ContextTypes
 )
 
-import firebase_admin
-from firebase_admin import credentials, db
+from firebase_admin import credentials
+
+import metrics
+import profiling
+import render
+from bot_logging import SAMPLE, get_logger, parse_levels, setup_logging, stats as bot_logging_stats
+from chat_compactor import ChatCompactor
+from chat_cursor import ChatCursor, chat_messages_from_event
+from firebase_store import (
+    FirebaseStore, MemoryBackend, RestBackend, is_permanent_error as firebase_permanent_error, push_key
+)
+from link_codes import CLAIMED, EXPIRED, USED, LinkCodeSweeper, claim_code, release_code, remove_link
+from flood_control import FLOOD_POLICIES, FloodControl, MessageMerger
+from leader_lease import BUSY, DONE, CursorMirror, DeliveryLedger, LeaderLease, default_worker_id
+from listener_bridge import ListenerBridge
+from message_history import MessageHistory
+from reaction_buffer import ReactionBuffer
+from rooms import load_routes, room_state_path
+from rtdb_stream import RealtimeStream
+from spool import PartialDelivery, Spool
+from telegram_outbox import ChatOutbox, PartialSendError, is_permanent_error as telegram_permanent_error
+from update_scheduler import KeyedUpdateProcessor
+from ttl_deleter import SharedTTLSchedule, TTLDeleter
+from warm_snapshot import WarmSnapshot
 
 # Загружаем переменные окружения
 load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-CHAT_ID = os.getenv('CHAT_ID')
-RAT_CHAT_ID = "-1002378701536"  # ID группы для RAT режима
 FIREBASE_DATABASE_URL = os.getenv('FIREBASE_DATABASE_URL')
 
-# Firebase инициализация
-# Поддержка Railway: может работать с переменной FIREBASE_KEY_JSON или файлом
-try:
-    import json
-    firebase_key_json = os.getenv('FIREBASE_KEY_JSON')
-    
-    if firebase_key_json:
-        # Railway/облако - используем переменную окружения
-        print("🔧 Используем Firebase ключ из переменной окружения")
-        firebase_key = json.loads(firebase_key_json)
-        cred = credentials.Certificate(firebase_key)
-    else:
-        # Локально - используем файл
-        print("🔧 Используем Firebase ключ из файла")
-        cred = credentials.Certificate('serviceAccountKey.json')
-    
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': FIREBASE_DATABASE_URL
-    })
-    print("✅ Firebase подключен")
-except Exception as e:
-    print(f"❌ Ошибка подключения к Firebase: {e}")
-    print("📌 Проверь FIREBASE_KEY_JSON или serviceAccountKey.json")
-
-# Путь к данным в Firebase
-BASE_PATH = 'sessions/DepressivePasties'
-CHAT_REF = f'{BASE_PATH}/chat'
-LINKS_REF = f'{BASE_PATH}/telegram_links'
-CODES_REF = f'{BASE_PATH}/link_codes'
-REACTIONS_REF = f'{BASE_PATH}/reactions'
-RAT_MODE_REF = f'{BASE_PATH}/rat_mode'  # Флаг RAT режима
-
-# Эмодзи из сайта (те же 18 что на сайте)
-SITE_EMOJIS = [
-    '👍', '👎', '❤️', '😂', '😮', '😢', 
-    '🔥', '🤡', '🤬', '🍷', '🧐', '💃',
-    '🚩', '🤷‍♂️', '🙄', '💔', '🤯', '🔔'
-]
-
-# Глобальные переменные
-firebase_listener = None
-last_processed_message = {}
-message_queue = None  # Будет создана в main()
+# Комнаты: сессия сайта ↔ группа Telegram (+ RAT группа). ROOMS - JSON список или путь к файлу,
+# без него - одна комната из BASE_PATH / CHAT_ID / RAT_CHAT_ID
+ROOMS = os.getenv('ROOMS')
+BASE_PATH = os.getenv('BASE_PATH', 'sessions/DepressivePasties')
+CHAT_ID = os.getenv('CHAT_ID')
+RAT_CHAT_ID = os.getenv('RAT_CHAT_ID', "-1002378701536")  # ID группы для RAT режима
+# Правила базы открывают только сессии из этого узла (firebase_rules.json); бот вносит туда свои комнаты
+ALLOWED_SESSIONS_REF = os.getenv('ALLOWED_SESSIONS_REF', 'allowed_sessions')
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://dp-telegram-bot.fly.dev
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # без него генерируется на каждый запуск
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
+
+# Апдейты одного чата - по порядку, разных чатов, лички и кнопок - параллельно (в обоих режимах)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))  # одновременно выполняющихся обработчиков
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '1000'))  # апдейтов в работе и в очередях чатов
+UPDATE_DEPTH_WARNING = int(os.getenv('UPDATE_DEPTH_WARNING', '20'))  # предупреждение о глубокой очереди чата
+
+# Асинхронный доступ к Firebase из обработчиков
+FIREBASE_BACKEND = os.getenv('FIREBASE_BACKEND', 'rest')  # rest | memory (офлайн прогоны)
+FIREBASE_MAX_CONCURRENCY = int(os.getenv('FIREBASE_MAX_CONCURRENCY', '16'))
+FIREBASE_TIMEOUT = float(os.getenv('FIREBASE_TIMEOUT', '10'))
+# Слушатели: поток без единого байта дольше этого считается мёртвым (Firebase шлёт keep-alive раз в 30 с)
+LISTENER_IDLE_TIMEOUT = float(os.getenv('LISTENER_IDLE_TIMEOUT', '90'))
+LISTENER_MAX_BACKOFF = float(os.getenv('LISTENER_MAX_BACKOFF', '60'))  # потолок паузы между переподключениями
+
+# Локальное состояние бота (файлы между рестартами)
+STATE_DIR = os.getenv('STATE_DIR', 'data')
+
+# Снимок для быстрого старта: привязки, RAT режим и курсоры - на диске, сверка с Firebase в фоне
+WARM_SNAPSHOT_INTERVAL = float(os.getenv('WARM_SNAPSHOT_INTERVAL', '30'))  # секунды; 0 - без снимка
+WARM_SNAPSHOT_MAX_AGE = float(os.getenv('WARM_SNAPSHOT_MAX_AGE', '86400'))  # старше - привязкам не верим
+
+# Спул неудавшихся доставок (оба направления): повторы с экспонентой и разбросом, затем dead letter
+SPOOL_MAX_DELAY = float(os.getenv('SPOOL_MAX_DELAY', '300'))  # потолок паузы между повторами, секунды
+SPOOL_MAX_AGE = float(os.getenv('SPOOL_MAX_AGE', '86400'))  # дольше - в dead letter, секунды
+
+# Очередь слушатель → event loop
+LISTENER_QUEUE_SIZE = int(os.getenv('LISTENER_QUEUE_SIZE', '1000'))
+LISTENER_QUEUE_OVERFLOW = os.getenv('LISTENER_QUEUE_OVERFLOW', 'block')  # block | drop_oldest | spill
+
+# Отправка в Telegram группы: лимит ~20 сообщений в минуту на группу
+TG_GROUP_RATE_PER_MIN = float(os.getenv('TG_GROUP_RATE_PER_MIN', '20'))
+TG_GROUP_BURST = int(os.getenv('TG_GROUP_BURST', '3'))
+TG_COALESCE_WINDOW = float(os.getenv('TG_COALESCE_WINDOW', '2'))  # секунды
+TG_COALESCE_MAX_CHARS = int(os.getenv('TG_COALESCE_MAX_CHARS', '4096'))
+
+# Дубли основной группы в RAT группу: render - текстом (очередь группы склеивает их с сообщениями сайта
+# в одно), forward - пересылкой пачками forward_messages (до 100 за вызов), текстом только привязанные
+RAT_MIRROR = os.getenv('RAT_MIRROR', 'render')
+RAT_MIRROR_MODES = ('forward', 'render')
+
+# Флуд-контроль до записи в Firebase: token bucket на пользователя и на группу (в секунду; 0 - без лимита).
+# Сверх лимита: merge - сообщения пользователя склеиваются и уходят, когда лимит позволит; drop - отбрасываются
+FLOOD_POLICY = os.getenv('FLOOD_POLICY', 'merge')
+FLOOD_USER_RATE = float(os.getenv('FLOOD_USER_RATE', '1'))
+FLOOD_USER_BURST = int(os.getenv('FLOOD_USER_BURST', '5'))
+FLOOD_CHAT_RATE = float(os.getenv('FLOOD_CHAT_RATE', '10'))
+FLOOD_CHAT_BURST = int(os.getenv('FLOOD_CHAT_BURST', '30'))
+FLOOD_REACTION_USER_RATE = float(os.getenv('FLOOD_REACTION_USER_RATE', '5'))
+FLOOD_REACTION_USER_BURST = int(os.getenv('FLOOD_REACTION_USER_BURST', '20'))
+FLOOD_REACTION_CHAT_RATE = float(os.getenv('FLOOD_REACTION_CHAT_RATE', '50'))
+FLOOD_REACTION_CHAT_BURST = int(os.getenv('FLOOD_REACTION_CHAT_BURST', '200'))
+FLOOD_MAX_USERS = int(os.getenv('FLOOD_MAX_USERS', '10000'))  # пользователей в памяти лимитера (LRU)
+
+# Реакции: окно склейки перед записью в Firebase
+REACTION_WINDOW = float(os.getenv('REACTION_WINDOW', '0.5'))  # секунды
+# /history: последние сообщения комнаты в памяти (0 - выключено), заполняются при старте одним запросом
+HISTORY_SIZE = int(os.getenv('HISTORY_SIZE', '200'))
+HISTORY_DEFAULT = int(os.getenv('HISTORY_DEFAULT', '20'))  # /history без числа
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))  # сообщений на страницу
+
+# Хранение чата: живой узел держим маленьким, остальное - в сжатый архив по дням (0 - без лимита)
+CHAT_RETENTION_DAYS = float(os.getenv('CHAT_RETENTION_DAYS', '7'))
+CHAT_MAX_MESSAGES = int(os.getenv('CHAT_MAX_MESSAGES', '500'))
+CHAT_COMPACTION_INTERVAL = float(os.getenv('CHAT_COMPACTION_INTERVAL', '600'))  # секунды
+
+# Очистка истёкших и использованных кодов привязки
+LINK_CODE_SWEEP_INTERVAL = float(os.getenv('LINK_CODE_SWEEP_INTERVAL', '60'))  # секунды
+
+# Несколько воркеров: single - один процесс; multi - аренда лидера в Firebase (только с BOT_MODE=webhook).
+# Лидер слушает чат, удаляет по расписанию и архивирует; апдейты Telegram обрабатывает любой воркер
+WORKER_MODE = os.getenv('WORKER_MODE', 'single')
+WORKER_ID = os.getenv('WORKER_ID') or default_worker_id()  # по умолчанию host-pid-суффикс
+BOT_STATE_REF = os.getenv('BOT_STATE_REF', 'bot')  # общий узел воркеров: аренда, расписание, курсоры, доставки
+LEASE_TTL = float(os.getenv('LEASE_TTL', '15'))  # секунды
+DELIVERY_CLAIM_TIMEOUT = float(os.getenv('DELIVERY_CLAIM_TIMEOUT', '60'))  # когда захват доставки считается брошенным
+
+# Диагностика для админов: /profile N (сэмплирующий профайлер), /spans (последние замеры), /dead и /retry_dead (спул)
+ADMIN_IDS = {admin_id.strip() for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id.strip()}
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '60'))
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '25'))
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '2000'))  # замеров в кольцевом буфере
+DEAD_LETTERS_MAX = 20  # записей в ответе /dead - ответ помещается в одно сообщение
+
+# Метрики Prometheus на локальном порту (0 - выключены)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+
+# Логи: общий уровень, уровни подсистем (core, telegram_in, telegram_out, firebase_out, listener, rat),
+# формат text | json и выборка отладки по сообщениям (строк в секунду на шаблон)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # например: telegram-in=debug,listener=warning
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '5'))
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '20'))
+
+setup_logging(
+    LOG_LEVEL,
+    parse_levels(LOG_LEVELS),
+    fmt=LOG_FORMAT,
+    sample_rate=LOG_SAMPLE_RATE,
+    sample_burst=LOG_SAMPLE_BURST,
+)
+core_log = get_logger('core')
+tg_log = get_logger('telegram_in')
+out_log = get_logger('telegram_out')
+fb_log = get_logger('firebase_out')
+listener_log = get_logger('listener')
+rat_log = get_logger('rat')
+
+# Firebase инициализируется в main() (init_firebase) - импорт модуля не ходит в сеть
+cred = None
+
+# Таблица маршрутов: пути комнаты в Firebase (room.chat_ref, room.links_ref, ...) и её группы
+routes = load_routes(ROOMS, BASE_PATH, CHAT_ID, RAT_CHAT_ID)
+RAT_MESSAGE_TTL = 300  # В RAT режиме сообщения живут в Firebase 5 минут
+
+# Общий узел воркеров (режим multi)
+LEASE_REF = f'{BOT_STATE_REF}/lease'
+TTL_SCHEDULE_REF = f'{BOT_STATE_REF}/ttl_schedule'
+CURSORS_REF = f'{BOT_STATE_REF}/cursors'
+DELIVERIES_REF = f'{BOT_STATE_REF}/deliveries'
+DELIVERY_KEY_MAX_AGE = 86400  # ключи доставок храним сутки
+
+# Метки путей для метрик вызовов Firebase (ключи сообщений и кодов в метку не попадают)
+FIREBASE_PATH_LABELS = metrics.PathLabels({**routes.path_labels(), BOT_STATE_REF: 'BOT_STATE_REF'})
+
+# Типы апдейтов, для которых есть обработчики (команды/сообщения и кнопки)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Глобальные переменные (общие для всех комнат; состояние комнаты - в Room)
+message_queue = None  # ListenerBridge, создаётся в post_init
+store = None  # FirebaseStore, создаётся в post_init
+rtdb_stream = None  # RealtimeStream (слушатели), создаётся в post_init
+outboxes = {}  # chat_id → ChatOutbox, создаются в post_init
+ttl_deleter = None  # TTLDeleter (single) или SharedTTLSchedule (multi), создаётся в post_init
+spool = None  # Spool, создаётся в post_init
+message_flood = None  # FloodControl сообщений из групп, создаётся в post_init
+reaction_flood = None  # FloodControl реакций
+message_merger = None  # MessageMerger (политика merge)
+firebase_processor_task = None  # process_firebase_messages
+lease = None  # LeaderLease (multi)
+ledger = None  # DeliveryLedger (multi)
+cursor_mirror = None  # CursorMirror (multi)
+leader_tasks = set()  # фоновые задачи, которые живут, пока мы лидер
+delivery_tasks = set()  # очереди доставки комнат (multi)
+delivery_pipelines = {}  # комната → очередь (сообщение, ключ, захват) в порядке прихода (multi)
+busy_rechecks = set()  # таймеры повторной проверки захватов другого воркера (multi)
+metrics_server = None  # MetricsServer, создаётся в post_init
+update_processor = None  # KeyedUpdateProcessor, создаётся в main()
+profiler = profiling.SamplingProfiler()  # /profile
+admin_tasks = set()  # /profile в фоне - очередь апдейтов чата его не ждёт
+warm_snapshot = None  # WarmSnapshot, создаётся в post_init
+startup_tasks = set()  # подключение слушателей в фоне при тёплом старте
 
 
 # ============= ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ =============
@@ -84,118 +234,194 @@ def generate_link_code():
     return 'LINK-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
 
 
-def get_link_by_site_uid(site_uid):
-    """Получить привязку по UID с сайта"""
+def init_firebase():
+    """Ключ сервисного аккаунта для REST хранилища и слушателей
+    Поддержка Railway: может работать с переменной FIREBASE_KEY_JSON или файлом
+    """
+    global cred
     try:
-        ref = db.reference(LINKS_REF)
-        links = ref.get() or {}
-        for link_id, link_data in links.items():
-            if link_data.get('siteUserId') == site_uid:
-                return link_data
+        firebase_key_json = os.getenv('FIREBASE_KEY_JSON')
+        
+        if firebase_key_json:
+            # Railway/облако - используем переменную окружения
+            core_log.info("🔧 Используем Firebase ключ из переменной окружения")
+            cred = credentials.Certificate(json.loads(firebase_key_json))
+        else:
+            # Локально - используем файл
+            core_log.info("🔧 Используем Firebase ключ из файла")
+            cred = credentials.Certificate('serviceAccountKey.json')
+        
+        core_log.info("✅ Firebase ключ загружен")
+        return True
     except Exception as e:
-        print(f"❌ Ошибка get_link_by_site_uid: {e}")
-    return None
+        core_log.error("❌ Ошибка подключения к Firebase: %s", e)
+        core_log.error("📌 Проверь FIREBASE_KEY_JSON или serviceAccountKey.json")
+        return False
+
+
+def create_firebase_store():
+    """Асинхронное хранилище Firebase для обработчиков"""
+    if FIREBASE_BACKEND == 'memory':
+        backend = MemoryBackend()
+        core_log.info("🧪 Firebase: локальный backend в памяти")
+    else:
+        backend = RestBackend(
+            FIREBASE_DATABASE_URL,
+            credential=cred,
+            max_connections=FIREBASE_MAX_CONCURRENCY,
+            timeout=FIREBASE_TIMEOUT,
+        )
+    return FirebaseStore(
+        backend,
+        max_concurrency=FIREBASE_MAX_CONCURRENCY,
+        timeout=FIREBASE_TIMEOUT,
+        path_label=FIREBASE_PATH_LABELS,
+    )
+
+
+def schedule_delete(ref_path, delay=RAT_MESSAGE_TTL):
+    """Удалить узел Firebase через delay секунд (один общий планировщик, пакетное удаление)"""
+    ttl_deleter.schedule(ref_path, delay)
+
 
+def get_outbox(chat_id):
+    """Очередь отправки в группу (основную или RAT любой комнаты)"""
+    return outboxes[chat_id]
 
-def get_link_by_tg_id(tg_user_id):
-    """Получить привязку по Telegram ID"""
+
+# ============= СПУЛ ДОСТАВОК =============
+
+def telegram_lane(chat_id):
+    return f"telegram:{chat_id}"
+
+
+def firebase_lane(room):
+    return f"firebase:{room.name}"
+
+
+def submit_to_group(chat_id, text):
+    """В очередь группы; пока в спуле ждут её прежние сообщения или если отправка не удалась - в спул"""
+    if spool.pending(telegram_lane(chat_id)):
+        spool_to_group(chat_id, text)
+        return
+    
+    def on_done(ok, unsent=None):
+        if not ok:
+            spool_to_group(chat_id, unsent or text, RuntimeError("не отправлено"))
+    
+    get_outbox(chat_id).submit(text, on_done=on_done)
+
+
+def forward_to_group(chat_id, from_chat_id, message_id, fallback_text):
+    """Переслать сообщение в группу через её очередь (подряд идущие - одним вызовом);
+    не вышло или в спуле ждут прежние - вместо пересылки текст fallback_text
+    """
+    if spool.pending(telegram_lane(chat_id)):
+        spool_to_group(chat_id, fallback_text)
+        return
+    
+    def on_done(ok):
+        if not ok:
+            spool_to_group(chat_id, fallback_text, RuntimeError("не переслано"))
+    
+    get_outbox(chat_id).submit_forward(from_chat_id, message_id, on_done=on_done)
+
+
+def spool_to_group(chat_id, text, error=None):
+    spool.put('telegram', telegram_lane(chat_id), {'chat_id': chat_id, 'text': text}, error=error)
+
+
+async def send_spooled_telegram(payload):
+    """Повтор из спула: через ту же очередь группы (лимит и RetryAfter общие)"""
     try:
-        ref = db.reference(LINKS_REF)
-        links = ref.get() or {}
-        for link_id, link_data in links.items():
-            if link_data.get('tgUserId') == tg_user_id:
-                return link_data
-    except Exception as e:
-        print(f"❌ Ошибка get_link_by_tg_id: {e}")
-    return None
+        await get_outbox(payload['chat_id']).send(payload['text'])
+    except PartialSendError as e:
+        # Начало уже в чате - в спуле остаётся только хвост
+        raise PartialDelivery({**payload, 'text': e.unsent}) from e.__cause__
 
 
-def is_rat_mode_active():
-    """Проверить активен ли RAT режим"""
+async def write_chat_message(room, msg_key, message_data, delete_after=None):
+    """Запись сообщения из Telegram в чат комнаты; не получилось - в спул, повторит он (запись по ключу идемпотентна)"""
+    payload = {'path': f"{room.chat_ref}/{msg_key}", 'value': message_data, 'delete_after': delete_after}
+    lane = firebase_lane(room)
+    if spool.pending(lane):
+        # Порядок: пока спул комнаты не разобран, новые сообщения встают за ним
+        spool.put('firebase', lane, payload)
+        return False
     try:
-        ref = db.reference(RAT_MODE_REF)
-        rat_data = ref.get() or {}
-        return rat_data.get('active', False)
+        await send_spooled_firebase(payload)
+        return True
     except Exception as e:
-        print(f"❌ Ошибка is_rat_mode_active: {e}")
+        spool.put('firebase', lane, payload, error=e)
         return False
 
 
-# ============= КОМАНДЫ БОТА =============
+async def send_spooled_firebase(payload):
+    await store.set(payload['path'], payload['value'])
+    if payload.get('delete_after'):
+        schedule_delete(payload['path'], payload['delete_after'])
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /start"""
-    welcome_text = """
-🎮 **DepressivePasties Bot**
 
-Этот бот синхронизирует чат между сайтом и Telegram!
+def room_for_update(update):
+    """Комната апдейта: группа - по таблице маршрутов, личка - комната по умолчанию"""
+    chat = update.effective_chat
+    if chat is None or chat.type == 'private':
+        return routes.default
+    return routes.room_for_chat(chat.id)
 
-**Команды:**
-/link CODE - Привязать аккаунт с сайта
-/unlink - Отвязать аккаунт
-/whoami - Проверить свою привязку
-/r или /reaction - Отправить реакцию
-/help - Помощь
 
-**Как привязать:**
-1. Зайди на сайт и нажми "🔗 Связать Telegram"
-2. Скопируй код (вида LINK-XXXX)
-3. Отправь сюда: `/link LINK-XXXX`
+def get_link_by_site_uid(room, site_uid):
+    """Получить привязку по UID с сайта (из локального индекса комнаты, без сети)"""
+    return room.link_index.get_by_site_uid(site_uid)
+
+
+def get_link_by_tg_id(room, tg_user_id):
+    """Получить привязку по Telegram ID (из локального индекса комнаты, без сети)"""
+    return room.link_index.get_by_tg_id(tg_user_id)
 
-После привязки твои сообщения будут отображаться с твоим именем и цветом с сайта! 🎨
-"""
-    await update.message.reply_text(welcome_text, parse_mode='Markdown')
 
+def is_rat_mode_active(room):
+    """Проверить активен ли RAT режим комнаты (из памяти, без сети)"""
+    return room.is_rat_active()
+
+
+async def find_link_code(code, rooms):
+    """Ищет код привязки в комнатах (параллельно): (комната, данные кода, etag) или (None, None, None)"""
+    results = await asyncio.gather(*(store.get_etag(f"{room.codes_ref}/{code}") for room in rooms))
+    for room, (code_data, etag) in zip(rooms, results):
+        if code_data:
+            return room, code_data, etag
+    return None, None, None
+
+
+# ============= КОМАНДЫ БОТА =============
 
+@metrics.observe_handler
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /start"""
+    await update.message.reply_text(render.WELCOME_TEXT, parse_mode=render.MARKDOWN)
+
+
+@metrics.observe_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help"""
-    help_text = """
-📖 **Помощь**
-
-**Основные команды:**
-• `/link CODE` - Привязать аккаунт
-• `/unlink` - Отвязать аккаунт  
-• `/whoami` - Твой статус
-• `/r` или `/reaction` - Меню реакций
-
-**Как работает:**
-✅ Привязанные пользователи - сообщения идут с именем/цветом с сайта
-⚪ Без привязки - сообщения идут с префиксом [TG]
-
-**Реакции:**
-Используй `/r` чтобы открыть меню с эмодзи. Можешь отправить любой эмодзи командой:
-`/r 🎉` или `/reaction ❤️`
-"""
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await update.message.reply_text(render.HELP_TEXT, parse_mode=render.MARKDOWN)
 
 
+@metrics.observe_handler
 async def link_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /link CODE"""
     if not context.args:
-        await update.message.reply_text(
-            "❌ Укажи код!\n\nИспользуй: `/link LINK-XXXX`\n\n"
-            "Код можно получить на сайте, нажав кнопку '🔗 Связать Telegram'",
-            parse_mode='Markdown'
-        )
+        await update.message.reply_text(render.LINK_USAGE_TEXT, parse_mode=render.MARKDOWN)
         return
     
     code = context.args[0].upper()
     tg_user = update.effective_user
     
     try:
-        # Проверяем, не привязан ли уже этот TG аккаунт
-        existing_link = get_link_by_tg_id(tg_user.id)
-        if existing_link:
-            await update.message.reply_text(
-                f"⚠️ Твой Telegram уже привязан к аккаунту **{existing_link['siteName']}**\n\n"
-                f"Сначала отвяжись командой `/unlink`",
-                parse_mode='Markdown'
-            )
-            return
-        
-        # Проверяем код
-        codes_ref = db.reference(CODES_REF)
-        code_data = codes_ref.child(code).get()
+        # Код ищем в комнате группы, из лички - во всех комнатах
+        room = room_for_update(update) if update.effective_chat.type != 'private' else None
+        room, code_data, etag = await find_link_code(code, [room] if room else routes.rooms)
         
         if not code_data:
             await update.message.reply_text(
@@ -204,21 +430,38 @@ async def link_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Проверяем срок действия (5 минут)
-        if code_data.get('expiresAt', 0) < time.time() * 1000:
+        # Проверяем, не привязан ли уже этот TG аккаунт в комнате кода
+        existing_link = get_link_by_tg_id(room, tg_user.id)
+        if existing_link:
+            await update.message.reply_text(
+                render.already_linked_text(existing_link['siteName']),
+                parse_mode=render.MARKDOWN_V2
+            )
+            return
+        
+        # Захват кода - одна условная запись: из двух одновременных /link проходит один
+        code_path = f"{room.codes_ref}/{code}"
+        status, code_data = await claim_code(store, code_path, tg_user.id, current=(code_data, etag))
+        
+        # Срок действия - 5 минут (истёкший код удалит фоновая очистка)
+        if status == EXPIRED:
             await update.message.reply_text(
                 "⏰ Код истёк!\n\n"
                 "Код действует только 5 минут. Сгенерируй новый на сайте."
             )
-            # Удаляем устаревший код
-            codes_ref.child(code).delete()
             return
         
-        # Проверяем, не использован ли код
-        if code_data.get('used'):
+        if status == USED:
             await update.message.reply_text("❌ Этот код уже использован!")
             return
         
+        if status != CLAIMED:
+            await update.message.reply_text(
+                "❌ Неверный код!\n\n"
+                "Проверь, правильно ли ты скопировал код с сайта."
+            )
+            return
+        
         # Создаём привязку
         link_data = {
             'siteUserId': code_data['userId'],
@@ -231,126 +474,115 @@ async def link_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'linkCode': code
         }
         
-        # Сохраняем в Firebase
-        links_ref = db.reference(LINKS_REF)
-        links_ref.child(code_data['userId']).set(link_data)
-        
-        # Помечаем код как использованный
-        codes_ref.child(code).update({'used': True})
+        # Сохраняем в Firebase; не вышло - возвращаем код, чтобы его можно было ввести ещё раз
+        try:
+            await store.set(f"{room.links_ref}/{code_data['userId']}", link_data)
+        except Exception:
+            await release_code(store, code_path, tg_user.id)
+            raise
+        room.link_index.put(code_data['userId'], link_data)
         
         await update.message.reply_text(
-            f"✅ **Успешно привязано!**\n\n"
-            f"Теперь ты **{code_data['name']}** 🎨\n\n"
-            f"Твои сообщения будут отображаться с этим именем и цветом на сайте!",
-            parse_mode='Markdown'
+            render.link_success_text(code_data['name']),
+            parse_mode=render.MARKDOWN_V2
         )
         
-        print(f"✅ Привязка создана: {tg_user.first_name} → {code_data['name']}")
+        tg_log.info("✅ Привязка создана: %s → %s", tg_user.first_name, code_data['name'],
+                    extra={'tg_user': tg_user.id, 'room': room.name})
         
     except Exception as e:
-        print(f"❌ Ошибка в link_command: {e}")
+        tg_log.exception("❌ Ошибка в link_command: %s", e)
         await update.message.reply_text(
             "❌ Произошла ошибка при привязке. Попробуй ещё раз."
         )
 
 
+@metrics.observe_handler
 async def unlink_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /unlink"""
     tg_user_id = update.effective_user.id
     
     try:
-        link = get_link_by_tg_id(tg_user_id)
+        # В группе - привязка в её комнате, из лички - во всех комнатах
+        room = room_for_update(update) if update.effective_chat.type != 'private' else None
+        linked = [(r, get_link_by_tg_id(r, tg_user_id)) for r in ([room] if room else routes.rooms)]
+        linked = [(r, link) for r, link in linked if link]
         
-        if not link:
+        if not linked:
             await update.message.reply_text(
                 "ℹ️ Твой Telegram не привязан ни к какому аккаунту."
             )
             return
         
-        # Удаляем привязку
-        links_ref = db.reference(LINKS_REF)
-        links_ref.child(link['siteUserId']).delete()
+        # Удаляем условно (только если привязка всё ещё наша), комнаты - параллельно
+        removed = await asyncio.gather(*(
+            remove_link(store, f"{r.links_ref}/{link['siteUserId']}", tg_user_id) for r, link in linked
+        ))
+        linked = [(r, link) for (r, link), ok in zip(linked, removed) if ok]
+        for r, link in linked:
+            r.link_index.remove(link['siteUserId'])
+        
+        if not linked:
+            await update.message.reply_text(
+                "ℹ️ Твой Telegram не привязан ни к какому аккаунту."
+            )
+            return
         
         await update.message.reply_text(
-            f"✅ Отвязано от аккаунта **{link['siteName']}**\n\n"
-            f"Теперь твои сообщения будут идти как [TG] сообщения.",
-            parse_mode='Markdown'
+            render.unlinked_text(link['siteName'] for _, link in linked),
+            parse_mode=render.MARKDOWN_V2
         )
         
-        print(f"✅ Отвязка: {update.effective_user.first_name} от {link['siteName']}")
+        for r, link in linked:
+            tg_log.info("✅ Отвязка: %s от %s", update.effective_user.first_name, link['siteName'],
+                        extra={'tg_user': tg_user_id, 'room': r.name})
         
     except Exception as e:
-        print(f"❌ Ошибка в unlink_command: {e}")
+        tg_log.exception("❌ Ошибка в unlink_command: %s", e)
         await update.message.reply_text("❌ Ошибка при отвязке.")
 
 
+@metrics.observe_handler
 async def whoami_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /whoami"""
     tg_user = update.effective_user
-    link = get_link_by_tg_id(tg_user.id)
-    
-    if link:
-        text = (
-            f"✅ **Ты привязан!**\n\n"
-            f"👤 Имя на сайте: **{link['siteName']}**\n"
-            f"🎨 Цвет: `{link['siteColor']}`\n"
-            f"🔗 Привязано: {datetime.fromtimestamp(link['linkedAt']/1000).strftime('%d.%m.%Y %H:%M')}\n\n"
-            f"Твои сообщения отображаются с этим именем и цветом!"
-        )
-    else:
-        text = (
-            f"⚪ **Не привязан**\n\n"
-            f"👤 Telegram: {tg_user.first_name}\n"
-            f"🆔 ID: `{tg_user.id}`\n\n"
-            f"Твои сообщения идут с префиксом [TG].\n"
-            f"Используй `/link CODE` чтобы привязать аккаунт с сайта."
-        )
+    room = room_for_update(update)
+    link = get_link_by_tg_id(room, tg_user.id) if room else None
+    if not link and update.effective_chat.type == 'private':
+        # Из лички - первая комната, где есть привязка
+        link = next((l for l in (get_link_by_tg_id(r, tg_user.id) for r in routes) if l), None)
     
-    await update.message.reply_text(text, parse_mode='Markdown')
+    linked_at = datetime.fromtimestamp(link['linkedAt']/1000).strftime('%d.%m.%Y %H:%M') if link else None
+    await update.message.reply_text(render.whoami_text(link, tg_user, linked_at), parse_mode=render.MARKDOWN_V2)
 
 
+@metrics.observe_handler
 async def reaction_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /r или /reaction - меню реакций"""
     
     # Если указан эмодзи напрямую: /r ❤️
     if context.args and len(context.args) > 0:
         emoji = ' '.join(context.args)
-        await send_reaction_to_firebase(update.effective_user, emoji)
+        await send_reaction_to_firebase(room_for_update(update), update.effective_user, emoji)
         
         # Удаляем сообщение пользователя с командой через 0.5 сек
         await asyncio.sleep(0.5)
         try:
             await update.message.delete()
+            mark_deleted(context, update.message)
         except:
             pass  # Игнорируем если нет прав на удаление
         return
     
-    # Создаём inline клавиатуру с эмодзи
-    keyboard = []
-    row = []
-    for i, emoji in enumerate(SITE_EMOJIS):
-        row.append(InlineKeyboardButton(emoji, callback_data=f"react_{emoji}"))
-        if (i + 1) % 6 == 0:  # По 6 эмодзи в ряд
-            keyboard.append(row)
-            row = []
-    if row:  # Добавляем остаток
-        keyboard.append(row)
-    
-    # Кнопка для кастомного эмодзи
-    keyboard.append([
-        InlineKeyboardButton("✨ Свой эмодзи", callback_data="react_custom")
-    ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    # Клавиатура с эмодзи собрана один раз при запуске
     await update.message.reply_text(
-        "🎭 Выбери реакцию:\n\n"
-        "Или отправь командой: `/r 🎉`",
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
+        render.REACTION_MENU_TEXT,
+        reply_markup=render.REACTION_KEYBOARD,
+        parse_mode=render.MARKDOWN
     )
 
 
+@metrics.observe_handler
 async def reaction_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нажатий на кнопки реакций"""
     query = update.callback_query
@@ -359,19 +591,14 @@ async def reaction_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     
     if data == "react_custom":
-        await query.edit_message_text(
-            "✨ **Отправь любой эмодзи!**\n\n"
-            "Просто напиши эмодзи в чат или используй:\n"
-            "`/r 🎉` (твой эмодзи)",
-            parse_mode='Markdown'
-        )
+        await query.edit_message_text(render.CUSTOM_REACTION_TEXT, parse_mode=render.MARKDOWN)
         return
     
     # Извлекаем эмодзи из callback_data
     emoji = data.replace('react_', '')
     
-    # Отправляем реакцию в Firebase
-    await send_reaction_to_firebase(query.from_user, emoji)
+    # Отправляем реакцию в Firebase - в комнату группы, где нажали кнопку
+    await send_reaction_to_firebase(room_for_update(update), query.from_user, emoji)
     
     # Просто удаляем меню без уведомления
     try:
@@ -380,11 +607,68 @@ async def reaction_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass  # Игнорируем если нет прав
 
 
-async def send_reaction_to_firebase(tg_user, emoji):
-    """Отправляет реакцию в Firebase"""
+@metrics.observe_handler
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /history [n] - последние n сообщений комнаты из памяти (без запроса в Firebase)"""
+    room = room_for_update(update)
+    if room is None or room.history is None:
+        return
+    try:
+        count = int(context.args[0]) if context.args else HISTORY_DEFAULT
+    except ValueError:
+        await update.message.reply_text("❌ Используй: /history 20")
+        return
+    count = max(1, min(count, HISTORY_SIZE))
+    
+    text, keyboard = history_page(room, count, 0)
+    await update.message.reply_text(text, parse_mode=render.MARKDOWN_V2, reply_markup=keyboard)
+
+
+@metrics.observe_handler
+async def history_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание /history: буфер читается заново, страница 0 - самые новые"""
+    query = update.callback_query
+    await query.answer()
+    
+    room = room_for_update(update)
+    if room is None or room.history is None:
+        return
+    try:
+        _, count, page = query.data.split('_')
+        count, page = max(1, min(int(count), HISTORY_SIZE)), int(page)
+    except ValueError:
+        return
+    
+    text, keyboard = history_page(room, count, page)
+    try:
+        await query.edit_message_text(text, parse_mode=render.MARKDOWN_V2, reply_markup=keyboard)
+    except BadRequest:
+        pass  # страница не изменилась
+
+
+def history_page(room, count, page):
+    """Текст и кнопки страницы истории: последние count сообщений по HISTORY_PAGE_SIZE"""
+    entries = room.history.latest(count)
+    pages = max(1, -(-len(entries) // HISTORY_PAGE_SIZE))
+    page = max(0, min(page, pages - 1))
+    end = len(entries) - page * HISTORY_PAGE_SIZE
+    chunk = entries[max(0, end - HISTORY_PAGE_SIZE):end]
+    
+    text = render.history_text(chunk, page, pages)
+    # Страница - одно сообщение: если длинные тексты не влезли, отбрасываем самые старые
+    while len(text) > render.TELEGRAM_MAX_CHARS and len(chunk) > 1:
+        chunk = chunk[1:]
+        text = render.history_text(chunk, page, pages)
+    return text, render.history_keyboard(count, page, pages)
+
+
+async def send_reaction_to_firebase(room, tg_user, emoji):
+    """Отправляет реакцию в Firebase комнаты (через буфер: склейка одинаковых нажатий, одна запись на окно)"""
+    if room is None:
+        return
     try:
         # Проверяем привязку
-        link = get_link_by_tg_id(tg_user.id)
+        link = get_link_by_tg_id(room, tg_user.id)
         
         if link:
             # Привязанный пользователь - используем его цвет с сайта
@@ -395,71 +679,81 @@ async def send_reaction_to_firebase(tg_user, emoji):
             color = '#00a0e9'
             uid = f"tg_{tg_user.id}"
         
-        # Создаём реакцию
-        reaction_data = {
-            'uid': uid,
-            'color': color,
-            'emoji': emoji,
-            'emo': emoji,  # для совместимости
-            't': int(time.time() * 1000),
-            'id': f"tg_{int(time.time() * 1000000)}",
-            'fromTelegram': True
-        }
+        # Флуд-контроль: сверх лимита нажатие только докидывается к такой же ждущей реакции (merge)
+        if not reaction_flood.allow(room.chat_id, tg_user.id):
+            if FLOOD_POLICY != 'merge' or not room.reaction_buffer.merge(uid, emoji):
+                tg_log.debug("🚧 Реакция сверх лимита отброшена: %s", tg_user.id, extra=SAMPLE)
+            return
         
-        # Отправляем в Firebase
-        reactions_ref = db.reference(REACTIONS_REF)
-        reactions_ref.push(reaction_data)
+        room.reaction_buffer.add(uid, color, emoji)
         
-        print(f"✅ Реакция отправлена: {emoji} от {tg_user.first_name}")
+        tg_log.debug("✅ Реакция принята: %s от %s", emoji, tg_user.first_name, extra=SAMPLE)
         
     except Exception as e:
-        print(f"❌ Ошибка send_reaction_to_firebase: {e}")
+        tg_log.exception("❌ Ошибка send_reaction_to_firebase: %s", e)
 
 
 # ============= ОБРАБОТКА СООБЩЕНИЙ =============
+
+def mark_deleted(context, message):
+    """Сообщение уже удалено обработчиком команды - delete_any_slash_message его пропустит"""
+    # Только группы: в личке delete_any_slash_message не вызывается, отметка бы не снялась
+    if message.chat.type in ('group', 'supergroup'):
+        context.chat_data.setdefault('deleted_messages', set()).add(message.message_id)
+
+
+@metrics.observe_handler
 async def delete_any_slash_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    deleted = context.chat_data.get('deleted_messages')
+    if deleted and update.message.message_id in deleted:
+        deleted.discard(update.message.message_id)
+        return
     if update.message.text.startswith('/') and update.message.chat.type in ['group', 'supergroup']:
         try:
             await update.message.delete()
-            print(f"🗑️ Удалено сообщение с /: {update.message.text[:50]}")
+            tg_log.debug("🗑️ Удалено сообщение с /: %s", update.message.text[:50], extra=SAMPLE)
         except Exception as e:
-            print(f"⚠️ Ошибка удаления: {e} — дай боту права, мать его!")
-app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS, delete_any_slash_message))
-        
+            tg_log.warning("⚠️ Ошибка удаления: %s — дай боту права, мать его!", e)
+
+
+@metrics.observe_handler
+@profiling.SPANS.traced()
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка обычных текстовых сообщений из целевых групп — с RAT-магией и автоудалением"""
-    
-    print(f"📨 Получено сообщение из чата {update.message.chat.id} (тип: {update.message.chat.type})")
-    print(f"🔍 Целевой CHAT_ID: {CHAT_ID}")
-    print(f"🔍 RAT_CHAT_ID: {RAT_CHAT_ID}")
-    print(f"🔍 Сравнение: '{str(update.message.chat.id)}' vs '{CHAT_ID}' или '{RAT_CHAT_ID}'")
+    """Обработка обычных текстовых сообщений из групп комнат — с RAT-магией и автоудалением"""
     
     chat_id = str(update.message.chat.id)
-    if chat_id not in [CHAT_ID, RAT_CHAT_ID]:
-        print(f"⚠️ Игнорируем: чат {chat_id} — чужак!")
+    tg_log.debug("📨 Получено сообщение из чата %s (тип: %s)", chat_id, update.message.chat.type, extra=SAMPLE)
+    
+    # Комната группы - один поиск по словарю
+    room = routes.room_for_chat(chat_id)
+    if room is None:
+        tg_log.debug("⚠️ Игнорируем: чат %s — чужак!", chat_id, extra=SAMPLE)
         return
     
-    if chat_id == RAT_CHAT_ID and not is_rat_mode_active():
-        print(f"⚠️ Игнорируем RAT группу когда режим off — свобода спит!")
+    # Один снимок флага на всё сообщение - маршрут и удаление решаются в одном режиме
+    rat_active = is_rat_mode_active(room)
+    
+    if chat_id == room.rat_chat_id and not rat_active:
+        rat_log.debug("⚠️ Игнорируем RAT группу когда режим off — свобода спит!", extra=SAMPLE)
         return
     
     if update.message.from_user.is_bot:
-        print(f"⚠️ Игнорируем бота")
+        tg_log.debug("⚠️ Игнорируем бота", extra=SAMPLE)
         return
     
     text = update.message.text
     if text and text.startswith('/'):
         try:
             await update.message.delete()
-            print(f"🗑️ Удалена команда: {text[:50]}")
+            tg_log.debug("🗑️ Удалена команда: %s", text[:50], extra=SAMPLE)
         except Exception as e:
-            print(f"⚠️ Ошибка удаления: {e} — дай боту права админа с delete!")
+            tg_log.warning("⚠️ Ошибка удаления: %s — дай боту права админа с delete!", e)
         return
     
     tg_user = update.message.from_user
-    print(f"✅ Обрабатываем от {tg_user.first_name}: {text[:50]}")
+    tg_log.debug("✅ Обрабатываем от %s: %s", tg_user.first_name, text[:50], extra=SAMPLE)
     
-    link = get_link_by_tg_id(tg_user.id)
+    link = get_link_by_tg_id(room, tg_user.id)
     
     try:
         message_data = {
@@ -471,126 +765,818 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'fromTelegram': True
         }
         
-        # Push в Firebase ТОЛЬКО если из main или RAT on и из RAT (но для RAT не push, чтоб нет loop)
-        if chat_id == CHAT_ID or (chat_id == RAT_CHAT_ID and False):  # Для RAT не push, оставляем в TG
-            chat_ref = db.reference(CHAT_REF)
-            new_msg_ref = chat_ref.push(message_data)
-            msg_key = new_msg_ref.key
-            print(f"📱→🌐 {message_data['name']}: {text[:50]} (ключ: {msg_key})")
-            
-            if is_rat_mode_active():
-                ref_path = f"{CHAT_REF}/{msg_key}"
-                asyncio.create_task(delayed_delete(ref_path, 300))
-                print(f"⏳ Удаление {ref_path} через 5 мин")
-        
-        # Дубли в RAT TG если RAT on и из main
-        if is_rat_mode_active() and chat_id == CHAT_ID:
-            telegram_text = f"🎨 **{message_data['name']}**: {text}" if link else f"**{message_data['name']}**: {text}"
-            await context.bot.send_message(
-                chat_id=RAT_CHAT_ID,
-                text=telegram_text,
-                parse_mode='Markdown'
-            )
-            print(f"🐀 Дубли в RAT: {message_data['name']}: {text[:50]}")
+        # Запись в Firebase только из основной группы (из RAT не пишем, чтоб не было петли)
+        if chat_id != room.chat_id:
+            return
+        
+        # Флуд-контроль - до любой работы с Firebase; пока есть придержанные, новые встают за ними
+        if message_merger.is_holding(chat_id, tg_user.id) or not message_flood.allow(chat_id, tg_user.id):
+            if FLOOD_POLICY == 'merge' and message_merger.hold(chat_id, tg_user.id, message_data, (room, bool(link))):
+                tg_log.debug("🚧 Сверх лимита, склеиваем: %s", tg_user.id, extra=SAMPLE)
+            else:
+                tg_log.debug("🚧 Сверх лимита, отброшено: %s", tg_user.id, extra=SAMPLE)
+            return
+        
+        await relay_from_telegram(room, message_data, bool(link), rat_active, update.message.message_id)
         
     except Exception as e:
-        print(f"❌ Ошибка: {e}")
+        tg_log.exception("❌ Ошибка обработки сообщения: %s", e)
 
 
-# ============= СЛУШАТЕЛЬ FIREBASE =============
+async def relay_from_telegram(room, message_data, linked, rat_active, message_id=None):
+    """Сообщение из основной группы → чат комнаты на сайте (+ дубль в RAT группу в RAT режиме)
+
+    message_id - id исходного сообщения в группе (для пересылки); у склеенных его нет.
+    """
+    text = message_data['text']
+    
+    # Ключ как у push, но свой: повтор из спула перезапишет тот же узел, а не создаст дубль
+    msg_key = push_key(message_data['t'])
+    delete_after = RAT_MESSAGE_TTL if rat_active else None
+    # RAT сообщения живут 5 минут и в историю не попадают
+    if room.history is not None and not rat_active:
+        room.history.record(msg_key, message_data)
+    if await write_chat_message(room, msg_key, message_data, delete_after):
+        fb_log.debug("📱→🌐 %s: %s", message_data['name'], text[:50],
+                     extra={**SAMPLE, 'room': room.name, 'key': msg_key})
+        if rat_active:
+            rat_log.debug("⏳ Удаление %s/%s через 5 мин", room.chat_ref, msg_key, extra=SAMPLE)
+    
+    # Дубли в RAT TG если RAT on
+    if rat_active and room.rat_chat_id:
+        telegram_text = render.relay_text(message_data['name'], text, linked=linked)
+        # Через общую очередь RAT чата - делит с сайтом один лимит группы
+        if RAT_MIRROR == 'forward' and message_id is not None and not linked:
+            # Подпись «переслано от» - то же имя из Telegram; текстом шлём только имя с сайта
+            forward_to_group(room.rat_chat_id, room.chat_id, message_id, telegram_text)
+        else:
+            submit_to_group(room.rat_chat_id, telegram_text)
+        rat_log.debug("🐀 Дубли в RAT: %s: %s", message_data['name'], text[:50], extra=SAMPLE)
+
+
+async def send_merged_message(context, message_data):
+    """Склеенные сообщения сверх лимита (MessageMerger): RAT режим - на момент отправки"""
+    room, linked = context
+    await relay_from_telegram(room, message_data, linked, is_rat_mode_active(room))
+
 
-def firebase_callback(event):
-    """Синхронный callback для Firebase - добавляет в очередь с key"""
+# ============= ДИАГНОСТИКА (АДМИНЫ) =============
+
+def is_admin(tg_user):
+    return tg_user is not None and str(tg_user.id) in ADMIN_IDS
+
+
+@metrics.observe_handler
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [секунды] - профиль всех потоков (только ADMIN_IDS)"""
+    if not is_admin(update.effective_user):
+        return
+    
     try:
-        if not event.data:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("❌ Используй: /profile 10")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    if profiler.running:
+        await update.message.reply_text("⏳ Профайлер уже запущен")
+        return
+    await update.message.reply_text(f"⏱ Профилирую {seconds} с...")
+    core_log.info("⏱ Профиль %d с по запросу %s", seconds, update.effective_user.id)
+    # Апдейты одного чата идут по порядку: ждать профиль в обработчике - заморозить чат на всё время
+    spawn(send_profile(update.message, seconds), admin_tasks)
+
+
+async def send_profile(message, seconds):
+    """Профиль в фоне и ответ файлом и сводкой, когда он готов"""
+    try:
+        profile = await profiler.run(seconds)
+    except RuntimeError:
+        await message.reply_text("⏳ Профайлер уже запущен")
+        return
+    
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    try:
+        await message.reply_document(
+            document=io.BytesIO(profile.collapsed().encode('utf-8')),
+            filename=f"profile-{stamp}.collapsed",
+            caption="Стеки в формате collapsed (flamegraph.pl, speedscope)",
+        )
+        await message.reply_text(render.profile_text(profile, PROFILE_TOP_N), parse_mode=render.MARKDOWN_V2)
+    except Exception as e:
+        core_log.error("❌ Не удалось отправить профиль: %s", e)
+
+
+@metrics.observe_handler
+async def spans_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /spans [n] - последние замеры горячих участков (только ADMIN_IDS)"""
+    if not is_admin(update.effective_user):
+        return
+    
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    await update.message.reply_text(render.spans_text(profiling.SPANS.summary()), parse_mode=render.MARKDOWN_V2)
+    dump = profiling.SPANS.dump(limit)
+    if dump:
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        await update.message.reply_document(
+            document=io.BytesIO(dump.encode('utf-8')),
+            filename=f"spans-{stamp}.txt",
+        )
+
+
+@metrics.observe_handler
+async def dead_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /dead [n] - последние записи dead letter спула (только ADMIN_IDS)"""
+    if not is_admin(update.effective_user):
+        return
+    
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    letters = spool.dead_letters(max(1, min(limit, DEAD_LETTERS_MAX)))
+    await update.message.reply_text(render.dead_letters_text(letters), parse_mode=render.MARKDOWN_V2)
+
+
+@metrics.observe_handler
+async def retry_dead_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /retry_dead [id ...] - вернуть записи dead letter в спул: все или по id (только ADMIN_IDS)"""
+    if not is_admin(update.effective_user):
+        return
+    
+    if not all(arg.isdigit() for arg in context.args):
+        await update.message.reply_text("❌ Используй: /retry_dead или /retry_dead 12 15")
+        return
+    count = spool.retry_dead([int(arg) for arg in context.args] or None)
+    core_log.info("📤 Из dead letter в спул: %d по запросу %s", count, update.effective_user.id)
+    await update.message.reply_text(f"📤 Возвращено в спул: {count}")
+
+
+# ============= СЛУШАТЕЛЬ FIREBASE =============
+
+def make_chat_callback(room):
+    """Callback слушателя чата комнаты (в event loop) - кладёт новые сообщения в общую очередь"""
+    chat_cursor = room.chat_cursor
+    
+    async def firebase_callback(event):
+        try:
+            messages = chat_messages_from_event(event.event_type, event.path, event.data)
+            
+            # Первый запуск без курсора: историю только запоминаем, доставляем новое
+            if chat_cursor.fresh and not event.path.strip('/'):
+                for msg_key, msg in messages:
+                    chat_cursor.mark(msg.get('t', 0), msg_key)
+                return
+            
+            for msg_key, msg in messages:
+                msg_time = msg.get('t', 0)
+                
+                # Дедупликация по ключу: переподключение и рестарт не дают повторов
+                if not chat_cursor.claim(msg_time, msg_key):
+                    continue
+                
+                # История - и сайт, и Telegram (записанное этим воркером отсеется по ключу)
+                if room.history is not None and not room.is_rat_active():
+                    room.history.record(msg_key, msg)
+                
+                if msg.get('fromTelegram'):
+                    chat_cursor.mark(msg_time, msg_key)
+                    continue
+                
+                # Очередь полна - по политике: ждём (поток не читается дальше), вытесняем или переливаем
+                await message_queue.put((room.name, msg, msg_key))
+                
+        except Exception as e:
+            listener_log.exception("❌ Ошибка в firebase_callback: %s", e, extra={'room': room.name})
+    
+    return firebase_callback
+
+
+def advance_chat_cursor(room, msg, msg_key):
+    """Сдвигает курсор после доставки и переносит startAt для следующего переподключения"""
+    # На диск - фоновой записью курсора (раз в секунду и при остановке), не на каждую доставку
+    room.chat_cursor.mark(msg.get('t', 0), msg_key)
+    room.chat_listen_params['startAt'] = str(room.chat_cursor.start_at())
+    if cursor_mirror is not None:
+        cursor_mirror.touch(room.name, room.chat_cursor)
+
+
+def on_site_message_sent(room, msg, msg_key, target_chat, rat_active, telegram_text, valid=None):
+    """Итог доставки сообщения с сайта; не отправлено - в спул (кроме снятых при смене лидера)"""
+    def on_done(ok, unsent=None):
+        if ok:
+            accept_site_message(room, msg, msg_key, target_chat, rat_active)
             return
         
-        msg = event.data
-        
-        if msg.get('fromTelegram'):
+        if unsent is None and valid is not None and not valid():
+            # Лидерство потеряно до отправки: сообщение доставит новый лидер
+            room.chat_cursor.release(msg_key)
+            if ledger is not None:
+                ledger.release(room.name, msg_key)
             return
         
-        msg_time = msg.get('t', 0)
-        last_time = last_processed_message.get('time', 0)
-        if msg_time <= last_time:
+        out_log.warning("⚠️ Не доставлено в %s, в спул: %s", target_chat, msg.get('text', '')[:50], extra={'key': msg_key})
+        spool_to_group(target_chat, unsent or telegram_text, RuntimeError("не отправлено"))
+        accept_site_message(room, msg, msg_key, target_chat, rat_active, delivered=False)
+    
+    return on_done
+
+
+def accept_site_message(room, msg, msg_key, target_chat, rat_active, delivered=True):
+    """Сообщение с сайта принято (доставлено или лежит в спуле): сдвигаем курсор, в RAT режиме планируем удаление"""
+    if ledger is not None:
+        ledger.mark_sent(room.name, msg_key)
+    advance_chat_cursor(room, msg, msg_key)
+    if delivered and msg.get('t'):
+        lag = max(0.0, time.time() - msg['t'] / 1000)
+        metrics.DELIVERY_LAG_SECONDS.observe(lag, chat=target_chat)
+    
+    if rat_active:
+        ref_path = f"{room.chat_ref}/{msg_key}"
+        schedule_delete(ref_path)
+        rat_log.debug("⏳ Запланировано удаление %s через 5 мин", ref_path, extra=SAMPLE)
+
+
+def queue_item(item):
+    """(комната, сообщение, ключ) из элемента очереди; перелив версии с одной комнатой - без комнаты"""
+    if len(item) == 2:
+        return (routes.default.name, *item)
+    return item
+
+
+def release_dropped(item):
+    """Сообщение вытеснено из переполненной очереди - ключ больше не «в очереди» и может прийти снова"""
+    room_name, msg, msg_key = queue_item(item)
+    room = routes.by_name(room_name)
+    if room is not None:
+        room.chat_cursor.release(msg_key)
+
+
+def claim_replayed(item):
+    """Перелив прошлого запуска: берём, только если курсор комнаты ещё не видел ключ"""
+    room_name, msg, msg_key = queue_item(item)
+    room = routes.by_name(room_name)
+    return room is not None and room.chat_cursor.claim(msg.get('t', 0), msg_key)
+
+
+async def process_firebase_messages(app):
+    """Асинхронная обработка сообщений всех комнат из одной очереди: рендер и передача в очередь чата"""
+    listener_log.info("🔄 Запуск обработчика сообщений Firebase...")
+    
+    while True:
+        room_name, msg, msg_key = queue_item(await message_queue.get())
+        room = routes.by_name(room_name)
+        if room is None:
+            listener_log.warning("⚠️ Сообщение для неизвестной комнаты %s", room_name)
+            continue
+        
+        with profiling.SPANS.span('process_firebase_messages', room=room.name):
+            if ledger is None:
+                deliver_site_message(room, msg, msg_key)
+            else:
+                submit_delivery(room, msg, msg_key)
+
+
+def deliver_site_message(room, msg, msg_key, valid=None):
+    """Рендер сообщения с сайта и передача в очередь отправки группы комнаты"""
+    try:
+        name = msg.get('name', 'Гость')
+        text = msg.get('text', '')
+        
+        link = get_link_by_site_uid(room, msg.get('uid', ''))
+        telegram_text = render.relay_text(name, text, linked=bool(link))
+        
+        rat_active = is_rat_mode_active(room) and bool(room.rat_chat_id)  # один снимок на сообщение
+        target_chat = room.rat_chat_id if rat_active else room.chat_id
+        
+        if spool.pending(telegram_lane(target_chat)):
+            # Порядок: пока спул группы не разобран, новые сообщения встают за ним
+            spool_to_group(target_chat, telegram_text)
+            accept_site_message(room, msg, msg_key, target_chat, rat_active, delivered=False)
             return
         
-        last_processed_message['time'] = msg_time
+        # Лимит группы, склейка пачек и RetryAfter - внутри очереди чата
+        get_outbox(target_chat).submit(
+            telegram_text,
+            on_done=on_site_message_sent(room, msg, msg_key, target_chat, rat_active, telegram_text, valid),
+            valid=valid,
+        )
+        out_log.debug("🌐→📱 %s: %s", name, text[:50], extra={**SAMPLE, 'chat': target_chat, 'key': msg_key})
         
-        msg_key = event.path[1:] if event.path.startswith('/') else event.path  # Ключ сообщения
+    except Exception as e:
+        out_log.exception("❌ Ошибка обработки сообщения: %s", e)
+        room.chat_cursor.release(msg_key)
+        if ledger is not None:
+            ledger.release(room.name, msg_key)
+
+
+def submit_delivery(room, msg, msg_key):
+    """Режим multi: захват ключа стартует сразу, а доставка идёт по очереди комнаты в порядке прихода"""
+    pipeline = delivery_pipelines.get(room.name)
+    if pipeline is None:
+        pipeline = delivery_pipelines[room.name] = asyncio.Queue()
+        spawn(deliver_in_order(room, pipeline), delivery_tasks)
+    # Захваты - параллельные запросы и завершаются в любом порядке; порядок держит очередь
+    claim = asyncio.ensure_future(claim_delivery(room, msg_key))
+    pipeline.put_nowait((msg, msg_key, claim))
+
+
+async def claim_delivery(room, msg_key):
+    """Захват ключа идемпотентности: (состояние, эпоха) или None - доставлять не нам"""
+    if lease is None or not lease.is_leader:
+        room.chat_cursor.release(msg_key)
+        return None
+    epoch = lease.epoch
+    try:
+        return await ledger.claim(room.name, msg_key, epoch), epoch
+    except Exception as e:
+        out_log.error("❌ Не удалось захватить доставку %s: %s", msg_key, e)
+        room.chat_cursor.release(msg_key)
+        return None
+
+
+async def deliver_in_order(room, pipeline):
+    """Очередь доставки комнаты: ждёт захваты по порядку прихода и отдаёт сообщения в очередь чата"""
+    while True:
+        msg, msg_key, claim = await pipeline.get()
+        result = await claim
+        if result is None:
+            continue
+        state, epoch = result
         
-        try:
-            message_queue.put_nowait((msg, msg_key))
-        except:
-            pass
-            
+        if state == DONE:
+            # Доставил прошлый лидер - просто двигаем курсор
+            advance_chat_cursor(room, msg, msg_key)
+        elif state == BUSY:
+            # Доставляет другой воркер: если он упал, захват станет брошенным - проверим по таймеру,
+            # очередь комнаты его не ждёт
+            recheck_busy(room, msg, msg_key)
+        else:
+            # Отправка только пока эпоха наша: потеряли аренду - сообщение снимется с очереди
+            deliver_site_message(room, msg, msg_key, valid=lambda epoch=epoch: lease.is_leader and lease.epoch == epoch)
+
+
+def recheck_busy(room, msg, msg_key):
+    """Через DELIVERY_CLAIM_TIMEOUT снова отдать сообщение в очередь доставки комнаты"""
+    def resubmit():
+        busy_rechecks.discard(handle)
+        submit_delivery(room, msg, msg_key)
+    
+    handle = asyncio.get_running_loop().call_later(DELIVERY_CLAIM_TIMEOUT, resubmit)
+    busy_rechecks.add(handle)
+
+
+def spawn(coro, tasks):
+    """Фоновая задача со ссылкой в tasks (иначе её может собрать сборщик мусора)"""
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+def start_links_listener(room):
+    """Подписывает индекс привязок комнаты на её links_ref (первое событие - полная загрузка)"""
+    room.links_listener = rtdb_stream.subscribe(
+        room.links_ref, room.link_index.on_event, name=f"{room.name}:links")
+    listener_log.info("✅ Слушатель привязок подключен", extra={'room': room.name})
+
+
+def start_rat_mode_listener(room):
+    """Подписывает флаг RAT режима комнаты на её rat_mode_ref"""
+    room.rat_listener = rtdb_stream.subscribe(
+        room.rat_mode_ref, room.rat_mode.on_event, name=f"{room.name}:rat")
+    rat_log.info("✅ Слушатель RAT режима подключен", extra={'room': room.name})
+
+
+async def start_firebase_listener(room):
+    """Запускает слушатель чата комнаты с курсора: orderBy t, startAt - только новые сообщения"""
+    params = room.chat_listen_params
+    params.update({'orderBy': '"t"', 'startAt': str(room.chat_cursor.start_at())})
+    # Словарь параметров общий с advance_chat_cursor: при переподключении startAt уже свежий
+    room.chat_listener = rtdb_stream.subscribe(
+        room.chat_ref, make_chat_callback(room), params=params, name=f"{room.name}:chat")
+    # Первое событие - граница истории для нового курсора: ждём его, как раньше ждали подключения
+    if await room.chat_listener.wait_ready(15):
+        listener_log.info("✅ Firebase слушатель подключен (startAt t=%s)", params['startAt'],
+                          extra={'room': room.name})
+    else:
+        listener_log.warning("⚠️ Firebase слушатель ещё не подключен, переподключается в фоне",
+                             extra={'room': room.name})
+
+
+# ============= ЗАПУСК И ОСТАНОВКА =============
+
+def chat_cursor_path(room):
+    """Файл курсора комнаты; курсор версии с одной комнатой переезжает к комнате по умолчанию"""
+    path = room_state_path(STATE_DIR, room, 'chat_cursor.json')
+    legacy = os.path.join(STATE_DIR, 'chat_cursor.json')
+    if room is routes.default and os.path.exists(legacy) and not os.path.exists(path):
+        os.replace(legacy, path)
+    return path
+
+
+async def register_sessions():
+    """Вносит сессии комнат в ALLOWED_SESSIONS_REF - без этого правила базы закрывают их для сайта"""
+    sessions = {room.base_path.split('/', 1)[1]: True for room in routes
+                if room.base_path.startswith('sessions/') and room.base_path.count('/') == 1}
+    if not sessions:
+        return
+    try:
+        await store.update(ALLOWED_SESSIONS_REF, sessions)
     except Exception as e:
-        print(f"❌ Ошибка в firebase_callback: {e}")
+        core_log.warning("⚠️ Не удалось обновить %s: %s", ALLOWED_SESSIONS_REF, e)
 
 
-async def process_firebase_messages(app):
-    """Асинхронная обработка сообщений из очереди"""
-    print("🔄 Запуск обработчика сообщений Firebase...")
+async def start_room(room, warm_state=None):
+    """Состояние, фоновые задачи и слушатели одной комнаты"""
+    # Курсор чата: слушатель начнёт с последнего доставленного сообщения
+    room.chat_cursor = ChatCursor(chat_cursor_path(room))
+    room.chat_cursor.load()
+    room.chat_cursor.start()
     
-    while True:
+    # Снимок прошлого запуска: привязки и RAT режим сразу в памяти, без похода в сеть
+    warm = warm_snapshot is not None and warm_snapshot.restore(room, warm_state)
+    
+    # История: одним запросом последние HISTORY_SIZE сообщений, в фоне - старт её не ждёт
+    if HISTORY_SIZE > 0:
+        room.history = MessageHistory(HISTORY_SIZE)
+        spawn(fill_history(room), startup_tasks)
+    
+    # Реакции копятся коротким окном и уходят одной записью
+    room.reaction_buffer = ReactionBuffer(store, room.reactions_ref, window=REACTION_WINDOW)
+    
+    # Компактизация чата: старое - в архив по дням, живой узел остаётся маленьким
+    if CHAT_RETENTION_DAYS or CHAT_MAX_MESSAGES:
+        room.chat_compactor = ChatCompactor(
+            store,
+            room.base_path,
+            chat_child=room.chat_ref.rsplit('/', 1)[1],
+            archive_child=room.chat_archive_ref.rsplit('/', 1)[1],
+            max_age_days=CHAT_RETENTION_DAYS,
+            max_count=CHAT_MAX_MESSAGES,
+            interval=CHAT_COMPACTION_INTERVAL,
+        )
+        if lease is None:
+            room.chat_compactor.start()
+    
+    # Очистка кодов привязки (в режиме multi - у лидера)
+    room.code_sweeper = LinkCodeSweeper(store, room.codes_ref, interval=LINK_CODE_SWEEP_INTERVAL)
+    if lease is None:
+        room.code_sweeper.start()
+    
+    # Тёплый старт: слушатели подключаются в фоне, их первое событие (полный узел) сверяет снимок
+    if warm:
+        spawn(connect_room(room), startup_tasks)
+    else:
+        await connect_room(room)
+
+
+async def fill_history(room):
+    """Холодное заполнение истории: orderBy t, limitToLast HISTORY_SIZE"""
+    try:
+        messages = await store.get(room.chat_ref, orderBy='t', limitToLast=HISTORY_SIZE)
+        room.history.fill(messages)
+        core_log.info("📜 История загружена: %d сообщений", len(room.history), extra={'room': room.name})
+    except Exception as e:
+        core_log.warning("⚠️ Не удалось загрузить историю: %s", e, extra={'room': room.name})
+
+
+async def connect_room(room):
+    """Слушатели комнаты: привязки, RAT режим, затем чат"""
+    if rtdb_stream is None:
+        listener_log.warning("⚠️ Слушатели Firebase недоступны с backend %s", FIREBASE_BACKEND,
+                             extra={'room': room.name})
+        return
+    
+    # Индекс привязок: один раз загружаем и дальше держим актуальным через слушатель
+    # Подписка - задача в event loop; ждём её первое событие (полный узел)
+    start_links_listener(room)
+    if await room.links_listener.wait_ready(15):
+        listener_log.info("✅ Индекс привязок загружен: %d шт.", len(room.link_index), extra={'room': room.name})
+    else:
+        listener_log.warning("⚠️ Индекс привязок ещё не загружен, продолжаем без него", extra={'room': room.name})
+    
+    # RAT режим: флаг в памяти, слушатель присылает изменения
+    if room.rat_chat_id:
+        start_rat_mode_listener(room)
+        if not await room.rat_listener.wait_ready(15):
+            rat_log.warning("⚠️ RAT режим ещё не загружен, считаем его выключенным", extra={'room': room.name})
+    
+    # Слушатель чата - после индекса привязок, чтобы первые сообщения уже нашли имена
+    # (в режиме multi его запускает только лидер)
+    if lease is None:
+        await start_firebase_listener(room)
+
+
+# ============= НЕСКОЛЬКО ВОРКЕРОВ =============
+
+async def become_leader(epoch):
+    """Получили аренду: слушатели чатов, удаления по расписанию и компактизация - у нас"""
+    for room in routes:
+        # Курсор прошлого лидера в Firebase новее локального файла - продолжаем с него
         try:
-            msg, msg_key = await message_queue.get()  # Теперь с key
-            
-            name = msg.get('name', 'Гость')
-            text = msg.get('text', '')
-            
-            link = get_link_by_site_uid(msg.get('uid', ''))
-            telegram_text = f"🎨 **{name}**: {text}" if link else f"**{name}**: {text}"
-            
-            target_chat = RAT_CHAT_ID if is_rat_mode_active() else CHAT_ID
-            await app.bot.send_message(
-                chat_id=target_chat,
-                text=telegram_text,
-                parse_mode='Markdown'
-            )
-            print(f"🌐→📱 {name}: {text[:50]} в чат {target_chat}")
-            
-            if is_rat_mode_active():
-                ref_path = f"{CHAT_REF}/{msg_key}"
-                asyncio.create_task(delayed_delete(ref_path, 300))
-                print(f"⏳ Запланировано удаление {ref_path} через 5 мин")
-            
+            remote = await cursor_mirror.load(room.name)
         except Exception as e:
-            print(f"❌ Ошибка обработки сообщения: {e}")
-            await asyncio.sleep(1)
+            listener_log.warning("⚠️ Не удалось прочитать курсор из Firebase: %s", e, extra={'room': room.name})
+            remote = None
+        if remote is not None and remote > (room.chat_cursor.t, room.chat_cursor.key):
+            t, key = remote
+            room.chat_cursor.restore({**room.chat_cursor.to_dict(), 't': t, 'key': key})
+            room.chat_cursor.save()
+    
+    if rtdb_stream is not None:
+        await asyncio.gather(*(start_firebase_listener(room) for room in routes))
+    ttl_deleter.start()
+    cursor_mirror.start()
+    for room in routes:
+        if room.chat_compactor is not None:
+            room.chat_compactor.start()
+        room.code_sweeper.start()
+    spawn(prune_deliveries(), leader_tasks)
+    core_log.info("👑 Воркер %s - лидер (эпоха %d)", WORKER_ID, epoch)
 
 
-def start_firebase_listener():
-    """Запускает Firebase слушатель (синхронный)"""
+async def stop_leading():
+    """Потеряли аренду: останавливаем всё, что делает только лидер"""
+    for task in list(leader_tasks):
+        task.cancel()
+    for room in routes:
+        if room.chat_listener is not None:
+            listener, room.chat_listener = room.chat_listener, None
+            await listener.close()
+        if room.chat_compactor is not None:
+            await room.chat_compactor.stop()
+        await room.code_sweeper.stop()
+    await ttl_deleter.stop()
     try:
-        chat_ref = db.reference(CHAT_REF)
-        chat_ref.listen(firebase_callback)
-        print("✅ Firebase слушатель подключен")
-        return True
+        await cursor_mirror.stop()
     except Exception as e:
-        print(f"❌ Ошибка запуска Firebase слушателя: {e}")
-        return False
+        listener_log.error("❌ Не удалось сохранить курсоры в Firebase: %s", e)
+
+
+async def prune_deliveries():
+    """Лидер раз в час чистит старые ключи доставки"""
+    while True:
+        try:
+            removed = await ledger.prune([room.name for room in routes], DELIVERY_KEY_MAX_AGE)
+            if removed:
+                core_log.info("🧹 Удалено старых ключей доставки: %d", removed)
+        except Exception as e:
+            core_log.error("❌ Ошибка очистки ключей доставки: %s", e)
+        await asyncio.sleep(3600)
+
+
+async def post_init(application):
+    """Инициализация после запуска event loop"""
+    global message_queue, store, rtdb_stream, ttl_deleter, spool, warm_snapshot, message_flood, reaction_flood, message_merger, firebase_processor_task, metrics_server, lease, ledger, cursor_mirror
+    
+    profiling.SPANS.resize(TRACE_BUFFER_SIZE)
+    
+    # Одна очередь сообщений на все комнаты (внутри event loop!)
+    os.makedirs(STATE_DIR, exist_ok=True)
+    message_queue = ListenerBridge(
+        maxsize=LISTENER_QUEUE_SIZE,
+        overflow=LISTENER_QUEUE_OVERFLOW,
+        spill_path=os.path.join(STATE_DIR, 'listener_spill.jsonl'),
+        on_drop=release_dropped,
+        replay=claim_replayed,
+    )
+    
+    # Асинхронное хранилище: один пул соединений на все комнаты, создаём внутри event loop
+    store = create_firebase_store()
+    # Слушатели - тот же адрес и токен, своё соединение на подписку (с memory backend их нет)
+    if isinstance(store.backend, RestBackend):
+        rtdb_stream = RealtimeStream(store.backend, idle_timeout=LISTENER_IDLE_TIMEOUT,
+                                     max_delay=LISTENER_MAX_BACKOFF)
+    await register_sessions()
+    
+    if WORKER_MODE == 'multi':
+        # Несколько воркеров: расписание удалений общее, слушает чат и удаляет только лидер
+        ttl_deleter = SharedTTLSchedule(store, TTL_SCHEDULE_REF)
+        ledger = DeliveryLedger(store, DELIVERIES_REF, WORKER_ID, claim_timeout=DELIVERY_CLAIM_TIMEOUT)
+        cursor_mirror = CursorMirror(store, CURSORS_REF)
+        lease = LeaderLease(store, LEASE_REF, WORKER_ID, ttl=LEASE_TTL,
+                            on_acquire=become_leader, on_release=stop_leading)
+    else:
+        # Удаления по таймеру: одна куча дедлайнов, расписание переживает рестарт
+        ttl_deleter = TTLDeleter(store, os.path.join(STATE_DIR, 'ttl_schedule.json'))
+        ttl_deleter.load()
+        ttl_deleter.start()
+    
+    # Очереди отправки в группы: свой лимит и склейка на каждый чат
+    for chat_id in routes.chat_ids():
+        outboxes[chat_id] = ChatOutbox(
+            application.bot,
+            chat_id,
+            rate_per_minute=TG_GROUP_RATE_PER_MIN,
+            burst=TG_GROUP_BURST,
+            coalesce_window=TG_COALESCE_WINDOW,
+            max_chars=TG_COALESCE_MAX_CHARS,
+        )
+        outboxes[chat_id].start()
+    
+    # Флуд-контроль сообщений и реакций из групп
+    message_flood = FloodControl(FLOOD_USER_RATE, FLOOD_USER_BURST, FLOOD_CHAT_RATE, FLOOD_CHAT_BURST, FLOOD_MAX_USERS)
+    reaction_flood = FloodControl(FLOOD_REACTION_USER_RATE, FLOOD_REACTION_USER_BURST,
+                                  FLOOD_REACTION_CHAT_RATE, FLOOD_REACTION_CHAT_BURST, FLOOD_MAX_USERS)
+    message_merger = MessageMerger(message_flood, send_merged_message, max_chars=TG_COALESCE_MAX_CHARS)
+    
+    # Спул неудавшихся доставок: дочитываем оставшееся с прошлого запуска по порядку
+    spool = Spool(os.path.join(STATE_DIR, 'spool.sqlite3'), max_delay=SPOOL_MAX_DELAY, max_age=SPOOL_MAX_AGE)
+    spool.register('firebase', send_spooled_firebase, firebase_permanent_error)
+    spool.register('telegram', send_spooled_telegram, telegram_permanent_error)
+    spool.start()
+    if len(spool):
+        core_log.info("📥 В спуле с прошлого запуска: %d доставок", len(spool))
+    
+    # Снимок прошлого запуска - до подключения слушателей
+    warm_states = {}
+    if WARM_SNAPSHOT_INTERVAL:
+        warm_snapshot = WarmSnapshot(os.path.join(STATE_DIR, 'warm_snapshot.json'),
+                                     interval=WARM_SNAPSHOT_INTERVAL, max_age=WARM_SNAPSHOT_MAX_AGE)
+        warm_states = warm_snapshot.load()
+    
+    # Комнаты поднимаются параллельно
+    await asyncio.gather(*(start_room(room, warm_states.get(room.name)) for room in routes))
+    if warm_snapshot is not None:
+        warm_snapshot.start(routes)
+    core_log.info("🏠 Комнат: %d (%s)", len(routes), ', '.join(room.name for room in routes))
+    
+    # Запускаем асинхронный обработчик сообщений
+    firebase_processor_task = asyncio.create_task(process_firebase_messages(application))
+    
+    # Аренда лидера - после комнат: become_leader запускает их слушатели чата
+    if lease is not None:
+        try:
+            await lease.renew()  # первый раунд сразу: свободная аренда - слушатели поднимутся до начала работы
+        except Exception as e:
+            core_log.warning("⚠️ Аренда лидера пока недоступна: %s", e)
+        lease.start()
+        core_log.info("👥 Режим multi: воркер %s, аренда %s (ttl %d с)", WORKER_ID, LEASE_REF, LEASE_TTL)
+    
+    # Метрики: глубина очередей и счётчики подсистем снимаются в момент запроса
+    if METRICS_PORT:
+        register_queue_metrics()
+        try:
+            metrics_server = await metrics.MetricsServer(host=METRICS_HOST, port=METRICS_PORT).start()
+            core_log.info("📈 Метрики: http://%s:%d/metrics", METRICS_HOST, metrics_server.port)
+        except OSError as e:
+            core_log.warning("⚠️ Не удалось открыть порт метрик %d: %s", METRICS_PORT, e)
+    core_log.info("✅ Система синхронизации запущена")
+
+
+def sum_stats(sources):
+    """Сумма числовых полей stats() нескольких подсистем (по всем комнатам)"""
+    total = {}
+    for stats in sources:
+        for field, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[field] = total.get(field, 0) + value
+    return total
+
+
+def register_queue_metrics():
+    """Глубина очередей и stats() подсистем для /metrics"""
+    metrics.QUEUE_DEPTH.set_function(message_queue.qsize, queue='message_queue')
+    for chat_id, outbox in outboxes.items():
+        metrics.QUEUE_DEPTH.set_function(outbox.qsize, queue=f"outbox:{chat_id}")
+    metrics.QUEUE_DEPTH.set_function(lambda: ttl_deleter.stats()['scheduled'], queue='ttl_deleter')
+    metrics.QUEUE_DEPTH.set_function(spool.__len__, queue='spool')
+    for room in routes:
+        metrics.QUEUE_DEPTH.set_function(
+            lambda room=room: room.reaction_buffer.stats()['pending'], queue=f"reaction_buffer:{room.name}")
+    
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_listener_bridge', 'Мост слушатель → event loop', message_queue.stats))
+    if rtdb_stream is not None:
+        metrics.REGISTRY.register(metrics.StatsCollector(
+            'bot_listener_streams', 'Потоки слушателей Firebase', rtdb_stream.stats))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_ttl_deleter', 'Удаления по таймеру', ttl_deleter.stats))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_reaction_buffer', 'Буфер реакций (все комнаты)',
+        lambda: sum_stats(room.reaction_buffer.stats() for room in routes)))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_link_code_sweeper', 'Очистка кодов привязки (все комнаты)',
+        lambda: sum_stats(room.code_sweeper.stats() for room in routes)))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_history', 'История сообщений в памяти (все комнаты)',
+        lambda: sum_stats(room.history.stats() for room in routes if room.history is not None)))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_flood_messages', 'Флуд-контроль сообщений',
+        lambda: {**message_flood.stats(), **message_merger.stats()}))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_flood_reactions', 'Флуд-контроль реакций', reaction_flood.stats))
+    if update_processor is not None:
+        metrics.REGISTRY.register(metrics.StatsCollector(
+            'bot_updates', 'Обработка апдейтов по чатам', update_processor.stats))
+        metrics.REGISTRY.register(metrics.LabeledGaugeCollector(
+            'bot_update_queue_depth', 'Апдейтов в очереди и в работе по ключу (чат или callback:пользователь)',
+            'key', update_processor.depths))
+    if warm_snapshot is not None:
+        metrics.REGISTRY.register(metrics.StatsCollector(
+            'bot_warm_snapshot', 'Снимок состояния для быстрого старта', warm_snapshot.stats))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_spool', 'Спул неудавшихся доставок', spool.stats))
+    metrics.REGISTRY.register(metrics.StatsCollector(
+        'bot_logging', 'Очередь логов', bot_logging_stats))
+    if lease is not None:
+        metrics.REGISTRY.register(metrics.StatsCollector(
+            'bot_leader_lease', 'Аренда лидера', lease.stats))
+        metrics.REGISTRY.register(metrics.StatsCollector(
+            'bot_delivery_ledger', 'Ключи идемпотентной доставки', ledger.stats))
+
+
+async def post_shutdown(application):
+    """Останавливаем слушателей и очереди, сохраняем расписание удалений, закрываем пул Firebase"""
+    # Сначала отдаём аренду - другой воркер подхватит слушатели, не дожидаясь её истечения
+    if lease is not None:
+        await lease.stop()
+    # Закрытие подписки - отмена задачи: соединение рвётся сразу, без ожидания события
+    if rtdb_stream is not None:
+        await rtdb_stream.close()
+    # Снимок - после слушателей: в нём последнее состояние привязок и курсоров
+    if warm_snapshot is not None:
+        await warm_snapshot.stop(routes)
+    if firebase_processor_task is not None:
+        firebase_processor_task.cancel()
+    for handle in list(busy_rechecks):
+        handle.cancel()
+    for task in list(delivery_tasks) + list(admin_tasks):
+        task.cancel()
+    # Придержанные флуд-контролем сообщения - сразу (пока живы спул и пул Firebase)
+    if message_merger is not None:
+        await message_merger.close()
+    # Спул - до очередей групп: его повторы ждут их отправки; неразобранное дочитается после рестарта
+    if spool is not None:
+        await spool.stop()
+    for outbox in outboxes.values():
+        await outbox.stop()
+    for room in routes:
+        # Курсор - после очередей групп: последние доставки уже отмечены
+        if room.chat_cursor is not None:
+            await room.chat_cursor.stop()
+        if room.chat_compactor is not None:
+            await room.chat_compactor.stop()
+        if room.code_sweeper is not None:
+            await room.code_sweeper.stop()
+        if room.reaction_buffer is not None:
+            await room.reaction_buffer.close()
+    if ttl_deleter is not None:
+        await ttl_deleter.close()
+    if ledger is not None:
+        await ledger.close()
+    if store is not None:
+        await store.close()
+    if spool is not None:
+        spool.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
 
 
 # ============= MAIN =============
 
 def main():
     """Запуск бота"""
-    global message_queue
+    global update_processor
     
     if not BOT_TOKEN:
-        print("❌ Не найден BOT_TOKEN в .env файле!")
+        core_log.error("❌ Не найден BOT_TOKEN в .env файле!")
         return
     
-    if not CHAT_ID or CHAT_ID == "-1002345678901":
-        print("⚠️  ВАЖНО: Не указан CHAT_ID в .env!")
-        print("📌 Добавь бота в группу и узнай ID группы")
-        print("📌 Для получения ID используй @getidsbot")
+    if not ROOMS and (not CHAT_ID or CHAT_ID == "-1002345678901"):
+        core_log.warning("⚠️  ВАЖНО: Не указан CHAT_ID в .env!")
+        core_log.warning("📌 Добавь бота в группу и узнай ID группы")
+        core_log.warning("📌 Для получения ID используй @getidsbot")
     
-    print("🚀 Запуск DepressivePasties Bot...")
+    core_log.info("🚀 Запуск DepressivePasties Bot...")
     
-    # Создаём приложение
-    app = Application.builder().token(BOT_TOKEN).build()
+    webhook_mode = BOT_MODE == 'webhook'
+    if webhook_mode and not WEBHOOK_URL:
+        core_log.error("❌ BOT_MODE=webhook, но не указан WEBHOOK_URL!")
+        return
+    if FLOOD_POLICY not in FLOOD_POLICIES:
+        core_log.error("❌ FLOOD_POLICY=%s: допустимо %s", FLOOD_POLICY, ' | '.join(FLOOD_POLICIES))
+        return
+    if RAT_MIRROR not in RAT_MIRROR_MODES:
+        core_log.error("❌ RAT_MIRROR=%s: допустимо %s", RAT_MIRROR, ' | '.join(RAT_MIRROR_MODES))
+        return
+    if WORKER_MODE == 'multi' and not webhook_mode:
+        # getUpdates с одним токеном может держать только один процесс
+        core_log.error("❌ WORKER_MODE=multi работает только с BOT_MODE=webhook")
+        return
+    if WORKER_MODE == 'multi' and not WEBHOOK_SECRET:
+        # Случайный секрет у каждого воркера свой, а Telegram помнит только последний setWebhook
+        core_log.error("❌ WORKER_MODE=multi требует общий WEBHOOK_SECRET для всех воркеров")
+        return
+    
+    init_firebase()
+    
+    # Создаём приложение: медленный чат не держит остальные, порядок внутри чата сохраняется
+    update_processor = KeyedUpdateProcessor(
+        concurrency=UPDATE_CONCURRENCY,
+        max_pending=UPDATE_MAX_PENDING,
+        depth_warning=UPDATE_DEPTH_WARNING,
+    )
+    app = Application.builder().token(BOT_TOKEN).concurrent_updates(update_processor).build()
     
     # Регистрируем команды (работают везде - в ЛС и группах)
     app.add_handler(CommandHandler("start", start_command))
@@ -600,9 +1586,15 @@ def main():
     app.add_handler(CommandHandler("whoami", whoami_command))
     app.add_handler(CommandHandler("r", reaction_command))
     app.add_handler(CommandHandler("reaction", reaction_command))
+    app.add_handler(CommandHandler("history", history_command))
+    app.add_handler(CommandHandler("profile", profile_command))
+    app.add_handler(CommandHandler("spans", spans_command))
+    app.add_handler(CommandHandler("dead", dead_command))
+    app.add_handler(CommandHandler("retry_dead", retry_dead_command))
     
     # Обработчик callback кнопок
     app.add_handler(CallbackQueryHandler(reaction_callback, pattern="^react_"))
+    app.add_handler(CallbackQueryHandler(history_callback, pattern="^history_"))
     
     # Обработчик обычных сообщений из целевой группы (НЕ команды!)
     # Внутри handle_message проверяется CHAT_ID
@@ -611,28 +1603,32 @@ def main():
         handle_message
     ))
     
-    # Запускаем Firebase слушатель и обработчик после старта event loop
-    async def post_init(application):
-        """Инициализация после запуска event loop"""
-        global message_queue
-        
-        # Создаём очередь для сообщений (внутри event loop!)
-        message_queue = asyncio.Queue()
-        
-        # Запускаем синхронный Firebase слушатель в отдельном потоке
-        import threading
-        firebase_thread = threading.Thread(target=start_firebase_listener, daemon=True)
-        firebase_thread.start()
-        
-        # Запускаем асинхронный обработчик сообщений
-        asyncio.create_task(process_firebase_messages(application))
-        print("✅ Система синхронизации запущена")
+    # Удаление любых сообщений с / в группах - после основных обработчиков
+    app.add_handler(MessageHandler(
+        filters.TEXT & filters.ChatType.GROUPS,
+        delete_any_slash_message
+    ), group=1)
     
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
     
     # Запускаем бота
-    print("✅ Бот запущен! Нажми Ctrl+C для остановки.")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    core_log.info("✅ Бот запущен! Нажми Ctrl+C для остановки.")
+    if webhook_mode:
+        secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        core_log.info("🌍 Webhook: %s (слушаем %s:%d)", webhook_url, WEBHOOK_LISTEN, PORT)
+        # Telegram присылает secret_token в заголовке, чужие запросы отклоняются
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
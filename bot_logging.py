@@ -0,0 +1,201 @@
+"""
+Логи бота: структурированные, по уровням подсистем, запись в отдельном потоке
+Обработчики кладут запись в очередь и сразу возвращаются; вывод делает фоновый поток.
+Отладка по каждому сообщению проходит через выборку с лимитом в секунду.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+ROOT_LOGGER = 'dpbot'
+
+# Подсистемы и что в них пишет
+SUBSYSTEMS = {
+    'core': "запуск, остановка, настройки",
+    'telegram_in': "апдейты из Telegram (команды, сообщения, реакции)",
+    'telegram_out': "отправка в Telegram (очереди чатов, RetryAfter)",
+    'firebase_out': "записи в Firebase (реакции, удаления, архив)",
+    'listener': "слушатели Firebase, курсор и мост в event loop",
+    'rat': "RAT режим: флаг, дубли, автоудаление",
+}
+
+# Стандартные поля LogRecord - всё остальное из extra попадает в вывод как поля
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'sample', 'suppressed'}
+
+# extra для строк по каждому сообщению: проходят через выборку
+SAMPLE = {'sample': True}
+
+
+def get_logger(subsystem):
+    """Логгер подсистемы: dpbot.<subsystem>"""
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem.replace('-', '_')}")
+
+
+def parse_levels(spec):
+    """'telegram-in=debug,listener=warning' → {'telegram_in': 'DEBUG', 'listener': 'WARNING'}"""
+    levels = {}
+    for part in (spec or '').split(','):
+        name, sep, level = part.partition('=')
+        if not sep:
+            continue
+        name = name.strip().replace('-', '_')
+        level = level.strip().upper()
+        if name not in SUBSYSTEMS:
+            raise ValueError(f"Неизвестная подсистема логов: {name}")
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Неизвестный уровень логов: {level}")
+        levels[name] = level
+    return levels
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items()
+            if key not in _RECORD_FIELDS and not key.startswith('_')}
+
+
+class TextFormatter(logging.Formatter):
+    """время уровень подсистема сообщение key=value ..."""
+
+    def format(self, record):
+        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))
+        sub = record.name[len(ROOT_LOGGER) + 1:] or record.name
+        line = f"{ts}.{int(record.msecs):03d} {record.levelname:<7} {sub:<12} {record.getMessage()}"
+        fields = _fields(record)
+        if getattr(record, 'suppressed', 0):
+            fields['suppressed'] = record.suppressed
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON строка на запись - для сборщиков логов на хостинге"""
+
+    def format(self, record):
+        data = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'sub': record.name[len(ROOT_LOGGER) + 1:] or record.name,
+            'msg': record.getMessage(),
+        }
+        data.update(_fields(record))
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Выборка строк с extra=SAMPLE: не больше rate в секунду (burst подряд) на шаблон сообщения
+
+    Пропущенные строки считаются и приписываются к следующей прошедшей как suppressed=N.
+    """
+
+    def __init__(self, rate=5.0, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # (логгер, шаблон) → [токены, время, пропущено]
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        if not getattr(record, 'sample', False) or self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+            record.suppressed, bucket[2] = bucket[2], 0
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler с ограниченной очередью: при переполнении запись выбрасывается, а не блокирует"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Только подставляем аргументы; трейсбек и форматирование строки - в фоновом потоке
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_queue_handler = None
+
+
+def setup_logging(level='INFO', levels=None, fmt='text', sample_rate=5.0, sample_burst=20,
+                  queue_size=10000, stream=None):
+    """Настроить логи dpbot.*: уровни подсистем, выборку, очередь и фоновый поток вывода"""
+    global _listener, _queue_handler
+    shutdown_logging()
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+    for subsystem in SUBSYSTEMS:
+        get_logger(subsystem).setLevel((levels or {}).get(subsystem, logging.NOTSET))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _queue_handler.addFilter(RateLimitFilter(sample_rate, sample_burst))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    return root
+
+
+def shutdown_logging():
+    """Дописать очередь и остановить поток вывода"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats():
+    """Счётчики для метрик: выброшено при переполнении, пропущено выборкой"""
+    if _queue_handler is None:
+        return {'queued': 0, 'dropped': 0, 'suppressed': 0}
+    sampler = next((f for f in _queue_handler.filters if isinstance(f, RateLimitFilter)), None)
+    return {
+        'queued': _queue_handler.queue.qsize(),
+        'dropped': _queue_handler.dropped,
+        'suppressed': sampler.suppressed if sampler else 0,
+    }
+
+
+atexit.register(shutdown_logging)
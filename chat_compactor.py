@@ -0,0 +1,166 @@
+"""
+Компактизация чата в Firebase
+Старые сообщения (по возрасту или сверх лимита количества) переезжают в сжатые архивные
+корзины по дням и удаляются из живого узла - одним многопутевым update на пачку.
+"""
+
+import asyncio
+import base64
+import json
+import time
+import zlib
+from datetime import datetime, timezone
+
+from bot_logging import get_logger
+from firebase_store import push_key
+
+log = get_logger('firebase_out')
+
+
+def archive_day(t_ms):
+    """День архива (UTC) для времени сообщения: '2025-11-22'"""
+    return datetime.fromtimestamp(t_ms / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def pack_messages(messages):
+    """{key: msg} → сжатая строка для архивной корзины"""
+    raw = json.dumps(messages, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.b64encode(zlib.compress(raw, 9)).decode('ascii')
+
+
+def unpack_messages(packed):
+    """Обратно к {key: msg}"""
+    return json.loads(zlib.decompress(base64.b64decode(packed)).decode('utf-8'))
+
+
+class ChatCompactor:
+    """Фоновая задача: держит живой узел чата маленьким, историю складывает в архив"""
+
+    def __init__(self, store, base_path, chat_child='chat', archive_child='chat_archive',
+                 max_age_days=7, max_count=500, interval=600, batch_size=500):
+        self.store = store
+        self.base_path = base_path
+        self.chat_child = chat_child
+        self.archive_child = archive_child
+        self.max_age_days = max_age_days
+        self.max_count = max_count
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+        self.archived = 0
+        self.runs = 0
+        self.errors = 0
+
+    @property
+    def chat_path(self):
+        return f"{self.base_path}/{self.chat_child}"
+
+    @property
+    def archive_path(self):
+        return f"{self.base_path}/{self.archive_child}"
+
+    # ---------- фоновый таск ----------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                moved = await self.compact()
+                if moved:
+                    log.info("🗜️ Чат: в архив перенесено %d сообщений", moved)
+            except Exception as e:
+                self.errors += 1
+                log.error("❌ Ошибка компактизации чата: %s", e)
+            await asyncio.sleep(self.interval)
+
+    # ---------- компактизация ----------
+
+    async def compact(self):
+        """Один проход: переносит всё лишнее пачками, возвращает число перенесённых сообщений"""
+        self.runs += 1
+        moved = 0
+        while True:
+            batch = await self._select_batch()
+            if not batch:
+                return moved
+            await self._archive_batch(batch)
+            moved += len(batch)
+            self.archived += len(batch)
+            if len(batch) < self.batch_size:
+                return moved
+
+    async def _select_batch(self):
+        batch = {}
+
+        # Сверх лимита количества: считаем ключи (shallow - без тел сообщений)
+        if self.max_count:
+            keys = await self.store.get(self.chat_path, shallow=True) or {}
+            excess = len(keys) - self.max_count
+            if excess > 0:
+                oldest = await self.store.get(
+                    self.chat_path, orderBy='t', limitToFirst=min(excess, self.batch_size)
+                ) or {}
+                batch.update(oldest)
+
+        # Старше max_age_days
+        if self.max_age_days and len(batch) < self.batch_size:
+            cutoff = int((time.time() - self.max_age_days * 86400) * 1000)
+            expired = await self.store.get(
+                self.chat_path, orderBy='t', endAt=cutoff, limitToFirst=self.batch_size
+            ) or {}
+            for key, msg in expired.items():
+                if len(batch) >= self.batch_size:
+                    break
+                batch[key] = msg
+
+        return {key: msg for key, msg in batch.items() if isinstance(msg, dict)}
+
+    async def _archive_batch(self, batch):
+        by_day = {}
+        for key, msg in batch.items():
+            by_day.setdefault(archive_day(msg.get('t', 0)), {})[key] = msg
+
+        # Архивные корзины и удаление из живого чата - одной атомарной записью
+        updates = {}
+        for day, messages in by_day.items():
+            times = [msg.get('t', 0) for msg in messages.values()]
+            updates[f"{self.archive_child}/{day}/{push_key()}"] = {
+                'z': pack_messages(messages),
+                'n': len(messages),
+                'from': min(times),
+                'to': max(times),
+            }
+        for key in batch:
+            updates[f"{self.chat_child}/{key}"] = None
+
+        await self.store.update(self.base_path, updates)
+
+    # ---------- чтение архива ----------
+
+    async def list_days(self):
+        """Дни, за которые есть архив"""
+        days = await self.store.get(self.archive_path, shallow=True) or {}
+        return sorted(days)
+
+    async def read_day(self, day):
+        """Сообщения архива за день, по порядку t: [(key, msg)]"""
+        chunks = await self.store.get(f"{self.archive_path}/{day}") or {}
+        messages = {}
+        for chunk in chunks.values():
+            if isinstance(chunk, dict) and chunk.get('z'):
+                messages.update(unpack_messages(chunk['z']))
+        return sorted(messages.items(), key=lambda item: (item[1].get('t', 0), item[0]))
@@ -0,0 +1,163 @@
+"""
+Курсор чата для слушателя Firebase
+Запоминает (t, key) последнего доставленного сообщения и недавние ключи, чтобы после рестарта
+и переподключения слушатель начинал с курсора, а каждое сообщение доставлялось ровно один раз.
+На диск пишется не на каждую доставку, а фоновым таском раз в save_interval (в потоке) и при остановке.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from bot_logging import get_logger
+
+log = get_logger('listener')
+
+
+class ChatCursor:
+    """Персистентный курсор (t, key) + ограниченный набор недавно доставленных ключей"""
+
+    def __init__(self, path, recent_size=2000, skew_ms=60000, save_interval=1.0):
+        self.path = path
+        self.recent_size = recent_size
+        self.save_interval = save_interval
+        # Часы у клиентов сайта расходятся - слушаем с запасом и отсекаем дубли по ключам
+        self.skew_ms = skew_ms
+        self.t = 0
+        self.key = ''
+        self.fresh = True  # курсора ещё не было: историю не доставляем, только запоминаем
+        self._recent = OrderedDict()  # доставленные ключи (сохраняются на диск)
+        self._pending = set()         # в очереди на доставку (не сохраняются)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # запись из фонового потока и при остановке не пересекаются
+        self._dirty = False
+        self._task = None
+
+    # ---------- состояние ----------
+
+    def load(self):
+        """Читает курсор с диска; без файла - начинаем с текущего момента"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.restore(data)
+            log.info("📍 Курсор чата: t=%s, key=%s, недавних ключей: %d", self.t, self.key, len(self._recent))
+        except FileNotFoundError:
+            self.t = int(time.time() * 1000)
+            log.info("📍 Курсора чата нет - начинаем с текущего момента")
+        except Exception as e:
+            self.t = int(time.time() * 1000)
+            log.warning("⚠️ Курсор чата повреждён (%s) - начинаем с текущего момента", e)
+
+    def restore(self, data):
+        """Восстанавливает курсор из словаря (файл или снимок)"""
+        with self._lock:
+            self.t = int(data.get('t', 0))
+            self.key = data.get('key', '')
+            self._recent = OrderedDict((key, None) for key in data.get('recent', []))
+            self.fresh = False
+
+    def to_dict(self):
+        with self._lock:
+            return {'t': self.t, 'key': self.key, 'recent': list(self._recent)}
+
+    def save(self):
+        """Атомарно пишет курсор на диск"""
+        with self._save_lock:
+            self._dirty = False  # отметки во время записи снова поднимут флаг
+            data = self.to_dict()
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                self._dirty = True
+                log.error("❌ Ошибка сохранения курсора чата: %s", e)
+
+    # ---------- фоновая запись ----------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        """Останавливает фоновую запись и сохраняет несохранённое"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._dirty:
+            self.save()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.save_interval)
+            if self._dirty:
+                await asyncio.to_thread(self.save)
+
+    def start_at(self):
+        """Значение startAt для запроса orderBy t"""
+        return max(0, self.t - self.skew_ms)
+
+    # ---------- доставка ----------
+
+    def claim(self, t, key):
+        """Забирает сообщение на доставку; False - уже доставлено, в очереди или старше окна"""
+        with self._lock:
+            if key in self._recent or key in self._pending:
+                return False
+            if t < self.start_at():
+                return False
+            self._pending.add(key)
+            return True
+
+    def mark(self, t, key):
+        """Отмечает сообщение доставленным и сдвигает курсор"""
+        with self._lock:
+            self._pending.discard(key)
+            self._recent[key] = None
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.recent_size:
+                self._recent.popitem(last=False)
+            if (t, key) > (self.t, self.key):
+                self.t, self.key = t, key
+            self.fresh = False
+            self._dirty = True
+
+    def release(self, key):
+        """Снимает отметку «в очереди» - сообщение не доставлено и может прийти снова"""
+        with self._lock:
+            self._pending.discard(key)
+
+
+def chat_messages_from_event(event_type, path, data):
+    """Сообщения чата из события слушателя: [(key, msg)] по порядку (t, key)
+
+    - put '/'       → весь срез запроса {key: msg}
+    - put '/key'    → одно сообщение (None - удаление, пропускаем)
+    - patch '/'     → несколько сообщений {key: msg}
+    - изменения отдельных полей ('/key/text') пропускаем - это не новые сообщения
+    """
+    parts = [part for part in (path or '').split('/') if part]
+
+    if not parts:
+        children = data if isinstance(data, dict) else {}
+    elif len(parts) == 1 and event_type == 'put':
+        children = {parts[0]: data}
+    else:
+        return []
+
+    messages = [
+        (key, msg) for key, msg in children.items()
+        if '/' not in key and isinstance(msg, dict)
+    ]
+    messages.sort(key=lambda item: (item[1].get('t', 0), item[0]))
+    return messages
@@ -18,10 +18,11 @@ try:
     
     # Проверяем основные функции
     tree = ast.parse(code)
-    functions = [node.name for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)]
+    functions = [node.name for node in ast.walk(tree) if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
     
     required_functions = [
         'main',
+        'init_firebase',
         'start_firebase_listener',
         'process_firebase_messages',
         'firebase_callback',
@@ -56,6 +57,13 @@ try:
     except ImportError:
         print("  ❌ dotenv - установи: pip install python-dotenv")
     
+    # Импорт bot.py не подключается к Firebase (это делает init_firebase в main) - проверяем его целиком
+    try:
+        import bot
+        print("  ✅ bot")
+    except ImportError as e:
+        print(f"  ❌ bot - {e}")
+    
     print("\n✅ Проверка завершена!")
     
 except SyntaxError as e:
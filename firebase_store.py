@@ -0,0 +1,441 @@
+"""
+Асинхронный доступ к Firebase Realtime Database
+REST поверх пула keep-alive соединений, лимит одновременных запросов и таймаут на каждый вызов.
+Для офлайн прогонов есть MemoryBackend - та же база, но в памяти процесса.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+
+import metrics
+import profiling
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+# ETag отсутствующего узла (так же отвечает Firebase)
+NULL_ETAG = 'null_etag'
+
+# Вернуть из функции транзакции, чтобы ничего не записывать
+TRANSACTION_ABORT = object()
+
+
+class FirebaseError(Exception):
+    """Ошибка запроса к Firebase"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def is_permanent_error(error):
+    """Повторять бесполезно: 4xx (права, неверные данные), кроме таймаута и лимита запросов"""
+    status = getattr(error, 'status', None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+def normalize_path(path):
+    """'/a//b/' → 'a/b'"""
+    return '/'.join(part for part in (path or '').split('/') if part)
+
+
+def compute_etag(value):
+    """ETag значения для локальных backend'ов: хеш канонического JSON"""
+    if value is None:
+        return NULL_ETAG
+    raw = json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class PushKeyGenerator:
+    """Генератор ключей как у push() в Firebase: упорядочены по времени, без сети"""
+
+    def __init__(self):
+        self._last_ms = 0
+        self._last_rand = [0] * 12
+
+    def __call__(self, now_ms=None):
+        now_ms = int(time.time() * 1000) if now_ms is None else int(now_ms)
+        duplicate = now_ms == self._last_ms
+        self._last_ms = now_ms
+
+        ts_chars = []
+        ts = now_ms
+        for _ in range(8):
+            ts_chars.append(PUSH_CHARS[ts % 64])
+            ts //= 64
+        key = ''.join(reversed(ts_chars))
+
+        if not duplicate:
+            self._last_rand = [random.randrange(64) for _ in range(12)]
+        else:
+            # Тот же миллисекундный тик - увеличиваем случайную часть, чтобы сохранить порядок
+            i = 11
+            while i >= 0 and self._last_rand[i] == 63:
+                self._last_rand[i] = 0
+                i -= 1
+            if i >= 0:
+                self._last_rand[i] += 1
+
+        return key + ''.join(PUSH_CHARS[r] for r in self._last_rand)
+
+
+push_key = PushKeyGenerator()
+
+
+# ============= REST BACKEND =============
+
+class RestBackend:
+    """Firebase REST API через httpx с пулом keep-alive соединений"""
+
+    def __init__(self, database_url, credential=None, max_connections=16, timeout=10.0):
+        # Адрес эмулятора/локального стенда приходит вида http://host:port?ns=name
+        parts = urlsplit(database_url)
+        self.database_url = f"{parts.scheme}://{parts.netloc}{parts.path}".rstrip('/')
+        self.base_params = dict(parse_qsl(parts.query))
+        self.credential = credential
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0,
+            ),
+            timeout=timeout,
+        )
+        self._token = None
+        self._token_expiry = 0.0
+        self._token_lock = asyncio.Lock()
+
+    def invalidate_token(self):
+        """Следующий запрос получит свежий токен (например, база ответила 401 или auth_revoked)"""
+        self._token = None
+
+    async def auth_headers(self):
+        if self.credential is None:
+            return {}
+        if self._token is None or time.time() > self._token_expiry - 60:
+            async with self._token_lock:
+                if self._token is None or time.time() > self._token_expiry - 60:
+                    # google-auth обновляет токен синхронно - уводим в поток
+                    info = await asyncio.to_thread(self.credential.get_access_token)
+                    self._token = info.access_token
+                    self._token_expiry = info.expiry.timestamp() if info.expiry else time.time() + 3000
+        return {'Authorization': f'Bearer {self._token}'}
+
+    def url(self, path):
+        path = normalize_path(path)
+        return f"{self.database_url}/{path}.json" if path else f"{self.database_url}/.json"
+
+    async def _send(self, method, path, body=None, params=None, headers=None):
+        headers = {**(await self.auth_headers()), **(headers or {})}
+        if self.base_params:
+            params = {**self.base_params, **(params or {})}
+        try:
+            return await self._client.request(
+                method,
+                self.url(path),
+                params=params,
+                headers=headers,
+                content=json.dumps(body) if method in ('PUT', 'PATCH', 'POST') else None,
+            )
+        except httpx.HTTPError as e:
+            raise FirebaseError(f"{method} {path}: {e!r}") from e
+
+    async def request(self, method, path, body=None, params=None):
+        response = await self._send(method, path, body, params)
+        if response.status_code >= 400:
+            try:
+                detail = response.json().get('error', response.text)
+            except ValueError:
+                detail = response.text
+            raise FirebaseError(f"{method} {path}: {response.status_code} {detail}", response.status_code)
+
+        if response.status_code == 204 or not response.content:
+            return None
+        return response.json()
+
+    async def get(self, path, query=None):
+        return await self.request('GET', path, params=_query_params(query))
+
+    async def set(self, path, value):
+        await self.request('PUT', path, value, params={'print': 'silent'})
+
+    async def update(self, path, values):
+        await self.request('PATCH', path, values, params={'print': 'silent'})
+
+    async def push(self, path, value):
+        result = await self.request('POST', path, value)
+        return result['name']
+
+    async def delete(self, path):
+        await self.request('DELETE', path, params={'print': 'silent'})
+
+    async def get_etag(self, path):
+        """(значение, ETag) для условной записи"""
+        response = await self._send('GET', path, headers={'X-Firebase-ETag': 'true'})
+        if response.status_code >= 400:
+            raise FirebaseError(f"GET {path}: {response.status_code} {response.text}", response.status_code)
+        return (response.json() if response.content else None), response.headers.get('ETag', NULL_ETAG)
+
+    async def set_if(self, path, value, etag):
+        """PUT при совпадении ETag: (записано?, текущее значение, новый ETag); None - удалить"""
+        response = await self._send('PUT', path, value, headers={'if-match': etag, 'X-Firebase-ETag': 'true'})
+        if response.status_code == 412:
+            # Узел успели изменить - Firebase сразу отдаёт свежее значение и его ETag
+            current = response.json() if response.content else None
+            return False, current, response.headers.get('ETag', compute_etag(current))
+        if response.status_code >= 400:
+            raise FirebaseError(f"PUT {path}: {response.status_code} {response.text}", response.status_code)
+        return True, value, response.headers.get('ETag', compute_etag(value))
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def _query_params(query):
+    """Параметры запроса Firebase REST: orderBy/startAt/... кодируются как JSON"""
+    if not query:
+        return None
+    params = {}
+    for name, value in query.items():
+        if value is None:
+            continue
+        if name in ('limitToFirst', 'limitToLast'):
+            params[name] = str(int(value))
+        elif name == 'shallow':
+            params[name] = 'true' if value else 'false'
+        else:
+            params[name] = json.dumps(value)
+    return params
+
+
+# ============= ЛОКАЛЬНЫЙ BACKEND =============
+
+class MemoryBackend:
+    """Realtime Database в памяти процесса - для офлайн тестов пропускной способности"""
+
+    def __init__(self, data=None, latency=0.0):
+        self.root = data or {}
+        self.latency = latency
+        self.requests = 0
+
+    async def _simulate(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def read(self, path):
+        node = self.root
+        for part in normalize_path(path).split('/'):
+            if not part:
+                continue
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def write(self, path, value):
+        parts = [part for part in normalize_path(path).split('/') if part]
+        if not parts:
+            self.root = value if isinstance(value, dict) else {}
+            return
+
+        node = self.root
+        trail = []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = {}
+                node[part] = child
+            trail.append((node, part))
+            node = child
+
+        if value is None:
+            node.pop(parts[-1], None)
+            # Как в Firebase: пустые родители исчезают
+            for parent, part in reversed(trail):
+                if parent[part]:
+                    break
+                del parent[part]
+        else:
+            node[parts[-1]] = json.loads(json.dumps(value))
+
+    async def get(self, path, query=None):
+        await self._simulate()
+        value = self.read(path)
+        if query and query.get('shallow') and isinstance(value, dict):
+            return {key: True if isinstance(child, dict) else child for key, child in value.items()}
+        if query and isinstance(value, dict):
+            value = _apply_query(value, query)
+        return json.loads(json.dumps(value)) if value is not None else None
+
+    async def set(self, path, value):
+        await self._simulate()
+        self.write(path, value)
+
+    async def update(self, path, values):
+        await self._simulate()
+        base = normalize_path(path)
+        for child, value in values.items():
+            self.write(f"{base}/{child}", value)
+
+    async def push(self, path, value):
+        await self._simulate()
+        key = push_key()
+        self.write(f"{normalize_path(path)}/{key}", value)
+        return key
+
+    async def delete(self, path):
+        await self._simulate()
+        self.write(path, None)
+
+    async def get_etag(self, path):
+        await self._simulate()
+        value = self.read(path)
+        return json.loads(json.dumps(value)) if value is not None else None, compute_etag(value)
+
+    async def set_if(self, path, value, etag):
+        await self._simulate()
+        current = self.read(path)
+        if compute_etag(current) != etag:
+            return False, json.loads(json.dumps(current)) if current is not None else None, compute_etag(current)
+        self.write(path, value)
+        return True, value, compute_etag(value)
+
+    async def close(self):
+        pass
+
+
+def _rank(value):
+    """Порядок значений в Firebase: null < false < true < числа < строки < объекты"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+
+def _apply_query(children, query):
+    """orderBy/startAt/endAt/equalTo/limitTo* по правилам Firebase (упрощённо)"""
+    order_by = query.get('orderBy', '$key')
+
+    def order_value(key, value):
+        if order_by == '$key':
+            return key
+        if order_by == '$value':
+            return value
+        return value.get(order_by) if isinstance(value, dict) else None
+
+    items = sorted(
+        children.items(),
+        key=lambda item: (_rank(order_value(*item)), item[0]),
+    )
+
+    if 'equalTo' in query:
+        items = [item for item in items if order_value(*item) == query['equalTo']]
+    if 'startAt' in query:
+        start = _rank(query['startAt'])
+        items = [item for item in items if _rank(order_value(*item)) >= start]
+    if 'endAt' in query:
+        end = _rank(query['endAt'])
+        items = [item for item in items if _rank(order_value(*item)) <= end]
+    if query.get('limitToFirst'):
+        items = items[:int(query['limitToFirst'])]
+    if query.get('limitToLast'):
+        items = items[-int(query['limitToLast']):]
+    return dict(items)
+
+
+# ============= ХРАНИЛИЩЕ =============
+
+class FirebaseStore:
+    """Асинхронные чтение/запись с лимитом параллелизма и таймаутом на вызов"""
+
+    def __init__(self, backend, max_concurrency=16, timeout=10.0, path_label=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.path_label = path_label or (lambda path: 'all')  # путь → метка для метрик
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.calls = 0
+
+    async def _call(self, op, path, *args, timeout=None):
+        self.calls += 1
+        label = self.path_label(path)
+        status = 'error'
+        started = time.perf_counter()
+        async with self._semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    getattr(self.backend, op)(path, *args),
+                    timeout=timeout or self.timeout,
+                )
+                status = 'ok'
+                return result
+            except asyncio.TimeoutError as e:
+                status = 'timeout'
+                raise FirebaseError(f"{op} {path}: таймаут") from e
+            finally:
+                # Время с ожиданием семафора - так видно и очередь к пулу соединений
+                elapsed = time.perf_counter() - started
+                metrics.FIREBASE_SECONDS.observe(elapsed, op=op, path=label)
+                metrics.FIREBASE_CALLS.inc(op=op, path=label, status=status)
+                profiling.SPANS.record(f"firebase.{op}", elapsed, path=label, status=status)
+
+    async def get(self, path, timeout=None, **query):
+        """Прочитать узел (с параметрами запроса orderBy/startAt/limitToLast/...)"""
+        return await self._call('get', path, query or None, timeout=timeout)
+
+    async def set(self, path, value, timeout=None):
+        """Записать узел целиком"""
+        await self._call('set', path, value, timeout=timeout)
+
+    async def update(self, path, values, timeout=None):
+        """Многопутевое обновление: {'a/b': 1, 'c': None} - одним запросом"""
+        await self._call('update', path, values, timeout=timeout)
+
+    async def push(self, path, value, timeout=None):
+        """Добавить дочерний узел с новым ключом, возвращает ключ"""
+        return await self._call('push', path, value, timeout=timeout)
+
+    async def delete(self, path, timeout=None):
+        """Удалить узел"""
+        await self._call('delete', path, timeout=timeout)
+
+    async def get_etag(self, path, timeout=None):
+        """Прочитать узел вместе с ETag: (значение, etag)"""
+        return await self._call('get_etag', path, timeout=timeout)
+
+    async def set_if(self, path, value, etag, timeout=None):
+        """Записать, только если узел не менялся с etag: (записано?, текущее значение, etag)"""
+        return await self._call('set_if', path, value, etag, timeout=timeout)
+
+    async def transaction(self, path, update_fn, max_retries=10, timeout=None, current=None):
+        """Читает-изменяет-пишет узел через ETag, повторяя при гонке
+
+        update_fn(текущее значение) → новое значение (None - удалить) или TRANSACTION_ABORT.
+        current - уже прочитанные (значение, etag): без гонки транзакция - одна условная запись.
+        Возвращает (записано?, значение после транзакции).
+        """
+        value, etag = current if current is not None else await self.get_etag(path, timeout=timeout)
+        for _ in range(max_retries):
+            new_value = update_fn(value)
+            if new_value is TRANSACTION_ABORT:
+                return False, value
+            ok, value, etag = await self.set_if(path, new_value, etag, timeout=timeout)
+            if ok:
+                return True, value
+        raise FirebaseError(f"transaction {path}: не удалось за {max_retries} попыток")
+
+    async def close(self):
+        await self.backend.close()
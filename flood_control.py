@@ -0,0 +1,206 @@
+"""
+Защита от флуда до записи в Firebase
+Token bucket на пользователя и на чат; состояние пользователей - в LRU ограниченного размера.
+Сообщения сверх лимита отбрасываются или склеиваются в одно и уходят, когда лимит позволит.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+from bot_logging import get_logger
+
+log = get_logger('telegram_in')
+
+
+FLOOD_POLICIES = ('merge', 'drop')
+
+
+class Bucket:
+    """Состояние одного ведра: запас токенов на момент updated"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class KeyedBuckets:
+    """Token bucket на ключ (rate токенов в секунду, не больше burst подряд)
+
+    Ключей не больше max_keys: при переполнении вытесняется тот, кого дольше всех не было -
+    его ведро к этому моменту обычно уже полное, так что вытеснение лимит не ослабляет.
+    rate = 0 - без ограничений.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(float(self.burst), now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def wait_time(self, key, now=None):
+        """Через сколько секунд у ключа будет токен (0 - уже есть); токен не забирается"""
+        if not self.rate:
+            return 0.0
+        bucket = self._bucket(key, time.monotonic() if now is None else now)
+        return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / self.rate
+
+    def take(self, key, now=None):
+        if self.rate:
+            self._bucket(key, time.monotonic() if now is None else now).tokens -= 1
+
+
+class FloodControl:
+    """Лимиты на пользователя и на чат: событие проходит, только если токен есть в обоих вёдрах"""
+
+    def __init__(self, user_rate, user_burst, chat_rate, chat_burst, max_users=10000):
+        self.users = KeyedBuckets(user_rate, user_burst, max_users)
+        self.chats = KeyedBuckets(chat_rate, chat_burst, max_users)
+
+        self.allowed = 0
+        self.limited = 0
+
+    def wait_time(self, chat_id, user_id):
+        """Через сколько секунд событие пройдёт оба лимита"""
+        now = time.monotonic()
+        return max(self.users.wait_time(user_id, now), self.chats.wait_time(chat_id, now))
+
+    def allow(self, chat_id, user_id):
+        """Забрать токены пользователя и чата; False - лимит (ничего не забрано)"""
+        now = time.monotonic()
+        if self.users.wait_time(user_id, now) or self.chats.wait_time(chat_id, now):
+            self.limited += 1
+            return False
+        self.users.take(user_id, now)
+        self.chats.take(chat_id, now)
+        self.allowed += 1
+        return True
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'users': len(self.users),
+            'evicted': self.users.evicted + self.chats.evicted,
+        }
+
+
+class HeldMessage:
+    """Сообщения пользователя сверх лимита, склеенные в одно"""
+
+    __slots__ = ('message', 'texts', 'chars', 'handle')
+
+    def __init__(self, message):
+        self.message = message
+        self.texts = []
+        self.chars = 0
+        self.handle = None
+
+
+class MessageMerger:
+    """Политика merge: сообщения сверх лимита копятся по (чат, пользователь) и уходят одним,
+    когда у пользователя и чата снова есть токен.
+
+    send(context, message) - async отправка склеенного сообщения (context - как передан в hold).
+    Держим не больше max_held пользователей и max_chars текста на каждого - лишнее отбрасывается.
+    """
+
+    def __init__(self, flood, send, max_held=1000, max_chars=4096):
+        self.flood = flood
+        self.send = send
+        self.max_held = max_held
+        self.max_chars = max_chars
+        self._held = {}  # (chat_id, user_id) → (context, HeldMessage)
+        self._tasks = set()
+
+        self.merged = 0
+        self.dropped = 0
+        self.flushed = 0
+
+    def hold(self, chat_id, user_id, message, context=None):
+        """Придержать сообщение (словарь с 'text'); False - отброшено"""
+        key = (chat_id, user_id)
+        text = message.get('text', '')
+        entry = self._held.get(key)
+        if entry is None:
+            if len(self._held) >= self.max_held or len(text) > self.max_chars:
+                self.dropped += 1
+                return False
+            entry = self._held[key] = (context, HeldMessage(message))
+            self._schedule(key)
+        held = entry[1]
+
+        if held.chars + len(text) > self.max_chars:
+            self.dropped += 1
+            return False
+        held.texts.append(text)
+        held.chars += len(text) + 1
+        self.merged += 1
+        return True
+
+    def is_holding(self, chat_id, user_id):
+        """Есть ли придержанные сообщения - тогда новые встают за ними, чтобы не нарушить порядок"""
+        return (chat_id, user_id) in self._held
+
+    def _schedule(self, key):
+        _, held = self._held[key]
+        delay = max(0.05, self.flood.wait_time(*key))
+        held.handle = asyncio.get_running_loop().call_later(delay, self._flush, key)
+
+    def _flush(self, key):
+        if not self.flood.allow(*key):
+            self._schedule(key)
+            return
+        context, held = self._held.pop(key)
+        message = dict(held.message)
+        message['text'] = '\n'.join(held.texts)
+        message['t'] = int(time.time() * 1000)
+        self.flushed += 1
+        task = asyncio.create_task(self._send(context, message, len(held.texts)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, context, message, count):
+        try:
+            await self.send(context, message)
+            log.debug("🧱 Склеено сообщений сверх лимита: %d", count)
+        except Exception as e:
+            log.error("❌ Ошибка отправки склеенного сообщения: %s", e)
+
+    async def close(self):
+        """Отправить всё придержанное сразу (при остановке лимит уже не важен)"""
+        for key in list(self._held):
+            context, held = self._held.pop(key)
+            if held.handle is not None:
+                held.handle.cancel()
+            message = dict(held.message, text='\n'.join(held.texts), t=int(time.time() * 1000))
+            await self._send(context, message, len(held.texts))
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'held': len(self._held),
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'flushed': self.flushed,
+        }
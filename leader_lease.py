@@ -0,0 +1,346 @@
+"""
+Несколько воркеров: аренда лидера на узле Firebase и идемпотентная доставка
+Лидер (держатель аренды) один слушает чат и удаляет по расписанию; апдейты Telegram
+обрабатывает любой воркер. Каждая доставка с сайта помечается ключом сообщения,
+поэтому смена лидера не даёт ни дублей, ни потерь.
+"""
+
+import asyncio
+import os
+import random
+import socket
+import time
+
+from bot_logging import get_logger
+from firebase_store import NULL_ETAG, TRANSACTION_ABORT, normalize_path
+
+log = get_logger('core')
+
+
+def default_worker_id():
+    """host-pid-случайный суффикс: уникален и после рестарта на том же хосте"""
+    return f"{socket.gethostname()}-{os.getpid()}-{random.randrange(16 ** 4):04x}"
+
+
+class LeaderLease:
+    """Аренда {holder, epoch, expiresAt} с продлением через условную запись (ETag)
+
+    epoch растёт при каждой смене держателя - это fencing token: работа, начатая
+    при старой эпохе, узнаётся по номеру. Лидером воркер считает себя до
+    started + ttl - clock_skew, где started - момент перед запросом продления.
+    """
+
+    def __init__(self, store, path, worker_id=None, ttl=15.0, renew_interval=None, clock_skew=2.0,
+                 on_acquire=None, on_release=None):
+        self.store = store
+        self.path = normalize_path(path)
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.renew_interval = renew_interval or ttl / 3
+        self.clock_skew = clock_skew
+        self.on_acquire = on_acquire  # async (epoch)
+        self.on_release = on_release  # async ()
+
+        self.epoch = 0
+        self.holder = None  # последний известный держатель
+        self._held = False
+        self._valid_until = 0.0
+        self._task = None
+
+        self.acquired = 0
+        self.lost = 0
+        self.errors = 0
+
+    @property
+    def is_leader(self):
+        return self._held and time.monotonic() < self._valid_until
+
+    # ---------- фоновый таск ----------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        """Остановить продление и отдать аренду (следующий лидер не ждёт истечения ttl)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._held:
+            await self._step_down(graceful=True)
+            try:
+                await self.release()
+            except Exception as e:
+                log.warning("⚠️ Не удалось отдать аренду: %s", e)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.renew()
+            except Exception as e:
+                self.errors += 1
+                log.warning("⚠️ Ошибка продления аренды: %s", e)
+
+            # Продление не удалось дольше, чем действует аренда - больше не лидер
+            if self._held and not self.is_leader:
+                await self._step_down()
+
+            delay = self.renew_interval
+            if self._held:
+                delay = min(delay, max(0.0, self._valid_until - time.monotonic()))
+            else:
+                delay *= random.uniform(0.8, 1.2)  # кандидаты не стучатся одновременно
+            await asyncio.sleep(delay)
+
+    # ---------- аренда ----------
+
+    def _claim(self, current):
+        now_ms = time.time() * 1000
+        current = current if isinstance(current, dict) else {}
+        holder = current.get('holder')
+        if holder and holder != self.worker_id and current.get('expiresAt', 0) > now_ms:
+            self.holder = holder
+            return TRANSACTION_ABORT
+        epoch = current.get('epoch', 0) if holder == self.worker_id else current.get('epoch', 0) + 1
+        return {
+            'holder': self.worker_id,
+            'epoch': epoch,
+            'expiresAt': int(now_ms + self.ttl * 1000),
+            'renewedAt': int(now_ms),
+        }
+
+    async def renew(self):
+        """Один раунд: взять свободную/просроченную аренду или продлить свою. True - мы лидер"""
+        started = time.monotonic()
+        committed, value = await self.store.transaction(self.path, self._claim)
+        if not committed:
+            if self._held:
+                await self._step_down()
+            return False
+
+        self.holder = self.worker_id
+        self._valid_until = started + self.ttl - self.clock_skew
+        if not self._held or value['epoch'] != self.epoch:
+            self._held = True
+            self.epoch = value['epoch']
+            self.acquired += 1
+            log.info("👑 Аренда лидера получена: эпоха %d", self.epoch, extra={'worker': self.worker_id})
+            if self.on_acquire is not None:
+                # Подготовка лидера (курсоры, подключение слушателей) может идти дольше аренды -
+                # всё это время продлеваем её отдельно, иначе лидерство истечёт посреди on_acquire
+                keeper = asyncio.create_task(self._keep_alive())
+                try:
+                    await self.on_acquire(self.epoch)
+                finally:
+                    keeper.cancel()
+        return True
+
+    async def _keep_alive(self):
+        """Только продление своей аренды (без on_acquire/on_release - их вызывает основной цикл)"""
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            started = time.monotonic()
+            try:
+                committed, value = await self.store.transaction(self.path, self._claim)
+            except Exception as e:
+                self.errors += 1
+                log.warning("⚠️ Ошибка продления аренды: %s", e)
+                continue
+            if not committed or value['epoch'] != self.epoch:
+                return  # аренду забрали - основной цикл заметит и сдаст лидерство
+            self._valid_until = started + self.ttl - self.clock_skew
+
+    async def release(self):
+        """Освободить аренду, если она всё ещё наша (epoch остаётся - следующий лидер продолжит счёт)"""
+        def drop(current):
+            if isinstance(current, dict) and current.get('holder') == self.worker_id:
+                return {'epoch': current.get('epoch', 0), 'expiresAt': 0}
+            return TRANSACTION_ABORT
+        await self.store.transaction(self.path, drop)
+
+    async def _step_down(self, graceful=False):
+        self._held = False
+        self._valid_until = 0.0
+        if graceful:
+            log.info("👋 Аренда лидера отдана: эпоха %d", self.epoch, extra={'worker': self.worker_id})
+        else:
+            self.lost += 1
+            log.warning("👋 Аренда лидера потеряна: эпоха %d", self.epoch, extra={'worker': self.worker_id})
+        if self.on_release is not None:
+            try:
+                await self.on_release()
+            except Exception as e:
+                log.error("❌ Ошибка при сдаче лидерства: %s", e)
+
+    def stats(self):
+        return {
+            'leader': int(self.is_leader),
+            'epoch': self.epoch,
+            'acquired': self.acquired,
+            'lost': self.lost,
+            'errors': self.errors,
+        }
+
+
+# ============= ИДЕМПОТЕНТНАЯ ДОСТАВКА =============
+
+CLAIMED = 'claimed'  # доставляем мы
+DONE = 'done'        # уже доставлено
+BUSY = 'busy'        # доставляет другой воркер (или эпоха) - проверить позже
+
+
+class DeliveryLedger:
+    """Ключи идемпотентности: {path}/{room}/{msg_key} = {'s': 'sending'|'sent', 'w', 'e', 'at'}
+
+    Захват - одна условная запись «создать, если нет» (ETag отсутствующего узла).
+    Захват 'sending' старше claim_timeout считается брошенным (воркер упал до отправки)
+    и может быть перехвачен.
+    """
+
+    def __init__(self, store, path, worker_id, claim_timeout=60.0):
+        self.store = store
+        self.path = normalize_path(path)
+        self.worker_id = worker_id
+        self.claim_timeout = claim_timeout
+        self._tasks = set()
+
+        self.claimed = 0
+        self.duplicates = 0
+        self.taken_over = 0
+        self.errors = 0
+
+    def _entry_path(self, room, msg_key):
+        return f"{self.path}/{room}/{msg_key}"
+
+    async def claim(self, room, msg_key, epoch):
+        """CLAIMED / DONE / BUSY"""
+        path = self._entry_path(room, msg_key)
+        now_ms = int(time.time() * 1000)
+        entry = {'s': 'sending', 'w': self.worker_id, 'e': epoch, 'at': now_ms}
+
+        ok, current, etag = await self.store.set_if(path, entry, NULL_ETAG)
+        if ok:
+            self.claimed += 1
+            return CLAIMED
+
+        current = current if isinstance(current, dict) else {}
+        if current.get('s') == 'sent':
+            self.duplicates += 1
+            return DONE
+        if current.get('w') == self.worker_id and current.get('e') == epoch:
+            return CLAIMED
+        if now_ms - current.get('at', 0) < self.claim_timeout * 1000:
+            return BUSY
+
+        # Брошенный захват: перехватываем, только если его никто не тронул с момента чтения
+        ok, _, _ = await self.store.set_if(path, entry, etag)
+        if ok:
+            self.taken_over += 1
+            log.warning("♻️ Перехвачена брошенная доставка %s/%s", room, msg_key)
+            return CLAIMED
+        return BUSY
+
+    def mark_sent(self, room, msg_key):
+        """Отметить доставленным (из on_done - без ожидания)"""
+        self._spawn(self.store.update(self._entry_path(room, msg_key), {'s': 'sent', 'at': int(time.time() * 1000)}))
+
+    def release(self, room, msg_key):
+        """Снять захват - доставка не удалась, сообщение подхватит следующая попытка или лидер"""
+        self._spawn(self.store.delete(self._entry_path(room, msg_key)))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(self._guard(coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _guard(self, coro):
+        try:
+            await coro
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка записи ключа доставки: %s", e)
+
+    async def prune(self, rooms, max_age_s, batch_size=500):
+        """Удалить ключи старше max_age_s (делает лидер): дубли так давно уже не придут"""
+        cutoff = int((time.time() - max_age_s) * 1000)
+        removed = 0
+        for room in rooms:
+            old = await self.store.get(
+                f"{self.path}/{room}", orderBy='at', endAt=cutoff, limitToFirst=batch_size
+            ) or {}
+            if old:
+                await self.store.update(f"{self.path}/{room}", {key: None for key in old})
+                removed += len(old)
+        return removed
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'claimed': self.claimed,
+            'duplicates': self.duplicates,
+            'taken_over': self.taken_over,
+            'errors': self.errors,
+        }
+
+
+class CursorMirror:
+    """Курсоры чатов лидера в Firebase ({path}/{room} = {t, key}) - новый лидер продолжит с них"""
+
+    def __init__(self, store, path, interval=1.0):
+        self.store = store
+        self.path = normalize_path(path)
+        self.interval = interval
+        self._dirty = {}  # room → (t, key)
+        self._task = None
+
+    def touch(self, room, cursor):
+        self._dirty[room] = (cursor.t, cursor.key)
+
+    async def load(self, room):
+        """(t, key) из Firebase или None"""
+        data = await self.store.get(f"{self.path}/{room}")
+        if isinstance(data, dict) and 't' in data:
+            return int(data['t']), data.get('key', '')
+        return None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("❌ Ошибка сохранения курсоров в Firebase: %s", e)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        try:
+            await self.store.update(self.path, {room: {'t': t, 'key': key} for room, (t, key) in dirty.items()})
+        except Exception:
+            for room, value in dirty.items():
+                self._dirty.setdefault(room, value)
+            raise
@@ -0,0 +1,131 @@
+"""
+Коды привязки Telegram ↔ сайт
+Захват кода и отвязка - условные записи по ETag: из двух одновременных /link с одним кодом
+проходит ровно один. Фоновый проход удаляет истёкшие и использованные коды пачками.
+"""
+
+import asyncio
+import time
+
+from bot_logging import get_logger
+from firebase_store import TRANSACTION_ABORT
+
+log = get_logger('firebase_out')
+
+
+CLAIMED = 'claimed'      # код наш
+NOT_FOUND = 'not_found'  # кода нет (или его уже удалили)
+EXPIRED = 'expired'
+USED = 'used'
+
+
+async def claim_code(store, code_path, tg_user_id, current=None):
+    """Захватить код одной условной записью: (статус, данные кода)
+
+    current - уже прочитанные (значение, etag) кода: без гонки это единственный запрос.
+    Проигравший гонку получает актуальное значение и статус USED.
+    """
+    outcome = {}
+
+    def claim(code_data):
+        now_ms = int(time.time() * 1000)
+        if not isinstance(code_data, dict):
+            outcome['status'] = NOT_FOUND
+            return TRANSACTION_ABORT
+        if code_data.get('used'):
+            outcome['status'] = USED
+            return TRANSACTION_ABORT
+        if code_data.get('expiresAt', 0) < now_ms:
+            outcome['status'] = EXPIRED
+            return TRANSACTION_ABORT
+        outcome['status'] = CLAIMED
+        return {**code_data, 'used': True, 'usedBy': tg_user_id, 'usedAt': now_ms}
+
+    _, code_data = await store.transaction(code_path, claim, current=current)
+    return outcome['status'], code_data
+
+
+async def release_code(store, code_path, tg_user_id):
+    """Вернуть код, если привязку записать не удалось (только если его захватили мы)"""
+    def release(code_data):
+        if not isinstance(code_data, dict) or code_data.get('usedBy') != tg_user_id:
+            return TRANSACTION_ABORT
+        released = {key: value for key, value in code_data.items() if key not in ('usedBy', 'usedAt')}
+        released['used'] = False
+        return released
+
+    await store.transaction(code_path, release)
+
+
+async def remove_link(store, link_path, tg_user_id):
+    """Удалить привязку, только если она всё ещё принадлежит этому Telegram аккаунту"""
+    def drop(link):
+        if isinstance(link, dict) and str(link.get('tgUserId')) == str(tg_user_id):
+            return None
+        return TRANSACTION_ABORT
+
+    removed, _ = await store.transaction(link_path, drop)
+    return removed
+
+
+class LinkCodeSweeper:
+    """Фоновая задача: удаляет истёкшие и использованные коды одним многопутевым update на пачку"""
+
+    def __init__(self, store, codes_path, interval=60.0, batch_size=500):
+        self.store = store
+        self.codes_path = codes_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+        self.deleted = 0
+        self.runs = 0
+        self.errors = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.sweep() >= self.batch_size:
+                    pass
+            except Exception as e:
+                self.errors += 1
+                log.error("❌ Ошибка очистки кодов привязки: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self):
+        """Один проход: истёкшие (по индексу expiresAt) и использованные (по индексу used)"""
+        now_ms = int(time.time() * 1000)
+        expired, used = await asyncio.gather(
+            self.store.get(self.codes_path, orderBy='expiresAt', endAt=now_ms, limitToFirst=self.batch_size),
+            self.store.get(self.codes_path, orderBy='used', equalTo=True, limitToFirst=self.batch_size),
+        )
+        stale = set(expired or {}) | set(used or {})
+        self.runs += 1
+        if not stale:
+            return 0
+
+        await self.store.update(self.codes_path, {code: None for code in stale})
+        self.deleted += len(stale)
+        log.debug("🧹 Удалено кодов привязки: %d", len(stale))
+        return len(stale)
+
+    def stats(self):
+        return {
+            'deleted': self.deleted,
+            'runs': self.runs,
+            'errors': self.errors,
+        }
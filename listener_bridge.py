@@ -0,0 +1,201 @@
+"""
+Мост слушатель Firebase → обработчик сообщений
+Ограниченная очередь с явной политикой переполнения и счётчиками; слушатель и обработчик
+работают в одном event loop.
+"""
+
+import asyncio
+import json
+import os
+
+from bot_logging import get_logger
+
+log = get_logger('listener')
+
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class ListenerBridge:
+    """Ограниченная очередь между слушателем чата и обработчиком сообщений
+
+    Политики переполнения:
+    - block: слушатель ждёт, пока в очереди появится место (поток дальше не читается)
+    - drop_oldest: выбрасываем самый старый элемент (считается в dropped)
+    - spill: лишнее пишем в файл и дочитываем по мере разгрузки очереди
+
+    on_drop(item) вызывается для потерянного элемента (вытеснен или не записан в перелив).
+    replay(item) → bool решает, брать ли элемент перелива прошлого запуска: он мог быть
+    доставлен до рестарта или уже снова прийти от слушателя.
+    """
+
+    def __init__(self, maxsize=1000, overflow='block', spill_path=None, on_drop=None, replay=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения: {overflow}")
+        if overflow == 'spill' and not spill_path:
+            raise ValueError("Для политики spill нужен spill_path")
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.on_drop = on_drop
+        self.replay = replay
+        self._queue = asyncio.Queue(maxsize)
+
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replay_skipped = 0
+        self.errors = 0
+        self.high_watermark = 0
+
+        # Файл перелива: пишем в конец, читаем по смещению
+        self._spill_pending = 0
+        self._spill_read_pos = 0
+        self._replay_pending = 0  # сколько первых строк файла - с прошлого запуска
+        if overflow == 'spill':
+            self._restore_spill()
+
+    # ---------- сторона слушателя ----------
+
+    async def put(self, item):
+        """Передать элемент; при политике block ждём места - слушатель не читает поток дальше"""
+        self.received += 1
+        if self.overflow == 'block':
+            await self._put_block(item)
+        elif self.overflow == 'drop_oldest':
+            self._put_drop_oldest(item)
+        else:
+            self._put_or_spill(item)
+
+    # ---------- сторона обработчика ----------
+
+    async def get(self):
+        """Следующий элемент очереди"""
+        if self._spill_pending and self._queue.empty():
+            # Перелив прошлого запуска дочитывается с первым get - когда обработчик уже готов его проверить
+            self._refill_from_spill()
+        item = await self._queue.get()
+        self.delivered += 1
+        if self._spill_pending:
+            self._refill_from_spill()
+        return item
+
+    def qsize(self):
+        """Глубина очереди вместе с непрочитанным переливом"""
+        return self._queue.qsize() + self._spill_pending
+
+    def stats(self):
+        """Счётчики для мониторинга"""
+        return {
+            'depth': self.qsize(),
+            'maxsize': self.maxsize,
+            'high_watermark': self.high_watermark,
+            'received': self.received,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'spill_pending': self._spill_pending,
+            'replay_skipped': self.replay_skipped,
+            'errors': self.errors,
+        }
+
+    async def _put_block(self, item):
+        await self._queue.put(item)
+        self._track_depth()
+
+    def _put_drop_oldest(self, item):
+        if self._queue.full():
+            self._drop(self._queue.get_nowait())
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                log.warning("⚠️ Очередь Firebase переполнена, выброшено старых сообщений: %d", self.dropped)
+        self._queue.put_nowait(item)
+        self._track_depth()
+
+    def _put_or_spill(self, item):
+        # Пока в файле есть хвост, новые элементы тоже идут в файл - иначе нарушится порядок
+        if self._spill_pending or self._queue.full():
+            self._spill(item)
+        else:
+            self._queue.put_nowait(item)
+        self._track_depth()
+
+    def _drop(self, item):
+        if self.on_drop is None:
+            return
+        try:
+            self.on_drop(item)
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка on_drop: %s", e)
+
+    def _replayed(self, item):
+        if self.replay is None:
+            return True
+        try:
+            return self.replay(item)
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка проверки перелива: %s", e)
+            return True
+
+    def _track_depth(self):
+        depth = self.qsize()
+        if depth > self.high_watermark:
+            self.high_watermark = depth
+
+    # ---------- перелив на диск ----------
+
+    def _spill(self, item):
+        try:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            self._spill_pending += 1
+            self.spilled += 1
+            if self.spilled == 1 or self.spilled % 100 == 0:
+                log.warning("💾 Очередь Firebase переполнена, в файл отложено: %d", self.spilled)
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Не удалось записать перелив очереди: %s", e)
+            self._drop(item)
+
+    def _refill_from_spill(self):
+        try:
+            with open(self.spill_path, 'r', encoding='utf-8') as f:
+                f.seek(self._spill_read_pos)
+                while self._spill_pending and not self._queue.full():
+                    line = f.readline()
+                    if not line:
+                        self._spill_pending = 0
+                        self._replay_pending = 0
+                        break
+                    item = tuple(json.loads(line))
+                    self._spill_pending -= 1
+                    if self._replay_pending:
+                        self._replay_pending -= 1
+                        if not self._replayed(item):
+                            self.replay_skipped += 1
+                            continue
+                    self._queue.put_nowait(item)
+                self._spill_read_pos = f.tell()
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Не удалось прочитать перелив очереди: %s", e)
+            return
+
+        if not self._spill_pending:
+            # Всё дочитано - обнуляем файл
+            open(self.spill_path, 'w').close()
+            self._spill_read_pos = 0
+
+    def _restore_spill(self):
+        """После рестарта дочитываем то, что осталось в файле перелива (с первым get)"""
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, 'r', encoding='utf-8') as f:
+            self._spill_pending = sum(1 for line in f if line.strip())
+        self._replay_pending = self._spill_pending
+        if self._spill_pending:
+            log.info("💾 В файле перелива %d сообщений с прошлого запуска", self._spill_pending)
@@ -0,0 +1,213 @@
+"""
+Живое состояние из Firebase
+Локальные копии узлов, которые держит в актуальном виде слушатель - без похода в сеть на каждое сообщение
+"""
+
+import copy
+import threading
+
+from bot_logging import get_logger
+
+log = get_logger('listener')
+rat_log = get_logger('rat')
+
+
+def split_path(path):
+    """Разбивает путь Firebase на части: '/a/b' → ['a', 'b']"""
+    return [part for part in (path or '').split('/') if part]
+
+
+def apply_event(tree, event_type, path, data):
+    """Применяет put/patch событие слушателя к локальной копии узла и возвращает новое дерево"""
+    parts = split_path(path)
+
+    if event_type == 'patch':
+        # patch - это набор put по дочерним путям
+        for child, value in (data or {}).items():
+            tree = apply_event(tree, 'put', '/'.join(parts + split_path(child)), value)
+        return tree
+
+    if not parts:
+        return data
+
+    if not isinstance(tree, dict):
+        tree = {}
+
+    node = tree
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            child = {}
+            node[part] = child
+        node = child
+
+    if data is None:
+        node.pop(parts[-1], None)
+    else:
+        node[parts[-1]] = data
+    return tree
+
+
+class LinkIndex:
+    """Двусторонний индекс привязок: tgUserId → link и siteUserId → link"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ready = False   # первое событие слушателя (или снимок) уже применено
+        self._links = {}      # ключ узла telegram_links → данные привязки
+        self._keys = {}       # ключ узла → (tgUserId, siteUserId) для снятия старых записей
+        self._by_tg = {}
+        self._by_site = {}
+
+    # ---------- чтение (O(1), без сети) ----------
+
+    def get_by_tg_id(self, tg_user_id):
+        """Привязка по Telegram ID или None"""
+        return self._by_tg.get(str(tg_user_id))
+
+    def get_by_site_uid(self, site_uid):
+        """Привязка по UID с сайта или None"""
+        return self._by_site.get(site_uid)
+
+    def __len__(self):
+        return len(self._links)
+
+    @property
+    def ready(self):
+        return self._ready
+
+    # ---------- обновление ----------
+
+    def on_event(self, event):
+        """Callback слушателя LINKS_REF (в event loop; apply потокобезопасен)"""
+        try:
+            self.apply(event.event_type, event.path, event.data)
+        except Exception as e:
+            log.error("❌ Ошибка обновления индекса привязок: %s", e)
+
+    def apply(self, event_type, path, data):
+        """Применяет событие put/patch к индексу"""
+        parts = split_path(path)
+
+        with self._lock:
+            links = apply_event(self._links, event_type, path, data)
+            self._links = links if isinstance(links, dict) else {}
+
+            if parts:
+                self._reindex({parts[0]})
+            elif event_type == 'patch':
+                self._reindex({split_path(child)[0] for child in (data or {}) if split_path(child)})
+            else:
+                self._rebuild()
+
+        self._ready = True
+
+    def load(self, links):
+        """Полностью заменяет содержимое индекса (например, из снимка узла)"""
+        self.apply('put', '/', links or {})
+
+    def snapshot(self):
+        """Копия узла привязок (для снимка на диск)"""
+        with self._lock:
+            return copy.deepcopy(self._links)
+
+    def put(self, node_key, link_data):
+        """Локально применяет свою запись, не дожидаясь события слушателя"""
+        self.apply('put', f'/{node_key}', link_data)
+
+    def remove(self, node_key):
+        """Локально применяет своё удаление, не дожидаясь события слушателя"""
+        self.apply('put', f'/{node_key}', None)
+
+    def _rebuild(self):
+        by_tg, by_site, keys = {}, {}, {}
+        for node_key, link in self._links.items():
+            entry = self._entry(link)
+            if entry is None:
+                continue
+            tg_key, site_uid = entry
+            keys[node_key] = entry
+            if tg_key is not None:
+                by_tg[tg_key] = link
+            if site_uid is not None:
+                by_site[site_uid] = link
+        # Подменяем словари целиком - читатели без блокировки видят либо старый, либо новый индекс
+        self._by_tg, self._by_site, self._keys = by_tg, by_site, keys
+
+    def _reindex(self, node_keys):
+        for node_key in node_keys:
+            old = self._keys.pop(node_key, None)
+            if old:
+                tg_key, site_uid = old
+                if tg_key is not None:
+                    self._by_tg.pop(tg_key, None)
+                if site_uid is not None:
+                    self._by_site.pop(site_uid, None)
+
+            link = self._links.get(node_key)
+            entry = self._entry(link)
+            if entry is None:
+                continue
+            tg_key, site_uid = entry
+            self._keys[node_key] = entry
+            if tg_key is not None:
+                self._by_tg[tg_key] = link
+            if site_uid is not None:
+                self._by_site[site_uid] = link
+
+    @staticmethod
+    def _entry(link):
+        if not isinstance(link, dict):
+            return None
+        tg_user_id = link.get('tgUserId')
+        tg_key = str(tg_user_id) if tg_user_id is not None else None
+        return tg_key, link.get('siteUserId')
+
+
+class RatModeCell:
+    """Флаг RAT режима в памяти процесса, обновляется слушателем RAT_MODE_REF"""
+
+    def __init__(self, room=''):
+        self.room = room  # имя комнаты - только для логов
+        self._lock = threading.Lock()
+        self._ready = False   # первое событие слушателя (или снимок) уже применено
+        self._data = {}
+        self._active = False
+
+    @property
+    def active(self):
+        """Текущее значение флага - читаем один раз на сообщение и дальше пользуемся снимком"""
+        return self._active
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def on_event(self, event):
+        """Callback слушателя RAT_MODE_REF (в event loop; apply потокобезопасен)"""
+        try:
+            self.apply(event.event_type, event.path, event.data)
+        except Exception as e:
+            rat_log.error("❌ Ошибка обновления RAT режима: %s", e)
+
+    def apply(self, event_type, path, data):
+        """Применяет событие put/patch к флагу"""
+        with self._lock:
+            rat_data = apply_event(self._data, event_type, path, data)
+            self._data = rat_data if isinstance(rat_data, dict) else {}
+            active = bool(self._data.get('active', False))
+            changed = active != self._active
+            self._active = active
+
+        self._ready = True
+        if changed:
+            rat_log.info("🐀 RAT режим: %s", 'ON' if active else 'OFF', extra={'room': self.room})
+
+    def snapshot(self):
+        """Копия узла RAT режима (для снимка на диск)"""
+        with self._lock:
+            return copy.deepcopy(self._data)
+
+    def set(self, active):
+        """Локально выставляет флаг (например, из снимка) до прихода событий"""
+        self.apply('put', '/active', bool(active))
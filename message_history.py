@@ -0,0 +1,86 @@
+"""
+История последних сообщений комнаты
+Кольцевой буфер последних N сообщений в обе стороны (сайт ↔ Telegram) в памяти процесса:
+записи со __slots__, без словарей на сообщение. При старте заполняется одним запросом
+orderBy t, limitToLast N, дальше - сообщениями, которые бот видит сам. /history читает только его.
+"""
+
+from collections import deque
+
+
+class HistoryEntry:
+    """Одно сообщение истории"""
+
+    __slots__ = ('key', 't', 'name', 'text', 'from_telegram')
+
+    def __init__(self, key, t, name, text, from_telegram):
+        self.key = key
+        self.t = t
+        self.name = name
+        self.text = text
+        self.from_telegram = from_telegram
+
+
+class MessageHistory:
+    """Последние size сообщений комнаты по порядку t; повтор ключа не добавляется"""
+
+    def __init__(self, size=200, max_text=500):
+        self.size = size
+        self.max_text = max_text  # длиннее - обрезаем: буфер ограничен и по памяти
+        self._entries = deque(maxlen=size)
+        self._keys = set()
+
+        self.filled = False
+        self.recorded = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _entry(self, key, msg):
+        text = str(msg.get('text', ''))
+        if len(text) > self.max_text:
+            text = text[:self.max_text - 1] + '…'
+        return HistoryEntry(key, msg.get('t', 0), str(msg.get('name', 'Гость')), text, bool(msg.get('fromTelegram')))
+
+    def record(self, key, msg):
+        """Добавить сообщение (данные как в Firebase: name, text, t, fromTelegram); False - уже есть"""
+        if key in self._keys:
+            return False
+        entry = self._entry(key, msg)
+        if self._entries and entry.t < self._entries[-1].t:
+            # Опоздавшее (например, из спула) - вставляем по месту, чтобы порядок остался по t
+            self._merge([entry])
+        else:
+            if len(self._entries) == self.size:
+                self._keys.discard(self._entries[0].key)
+            self._entries.append(entry)
+            self._keys.add(key)
+        self.recorded += 1
+        return True
+
+    def fill(self, messages):
+        """Холодное заполнение: {ключ: сообщение} из Firebase, сливается с уже записанным"""
+        if isinstance(messages, dict):
+            self._merge([self._entry(key, msg) for key, msg in messages.items()
+                         if isinstance(msg, dict) and key not in self._keys])
+        self.filled = True
+
+    def _merge(self, entries):
+        merged = sorted([*self._entries, *entries], key=lambda entry: (entry.t, entry.key))[-self.size:]
+        self._entries = deque(merged, maxlen=self.size)
+        self._keys = {entry.key for entry in merged}
+
+    def latest(self, n):
+        """Последние n сообщений, старые первыми"""
+        if n <= 0:
+            return []
+        entries = list(self._entries)
+        return entries[-n:]
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'recorded': self.recorded,
+            'filled': int(self.filled),
+        }
@@ -0,0 +1,368 @@
+"""
+Метрики бота в текстовом формате Prometheus
+Счётчики, гистограммы задержек и снимки stats() подсистем; отдаются по HTTP на локальном порту.
+"""
+
+import asyncio
+import functools
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Базовая метрика с метками; значения по кортежу меток, потокобезопасно"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    """Монотонный счётчик"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение: set() вручную или функция, вызываемая при каждом снятии метрик"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, fn, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = fn
+
+    def render(self):
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, fn in functions:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[key] = value
+        return super().render()
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными границами корзин (в секундах)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер: with histogram.time(handler='x'): ..."""
+        return _Timer(self, labels)
+
+    def _render_value(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, extra=[('le', _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def _snapshot(self):
+        with self._lock:
+            return {key: (list(state[0]), state[1], state[2]) for key, state in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in sorted(self._snapshot().items()):
+            lines.extend(self._render_value(key, state))
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class StatsCollector:
+    """Снимок stats() подсистемы как набор gauge: <prefix>_<поле>"""
+
+    def __init__(self, prefix, help_text, source):
+        self.prefix = prefix
+        self.help = help_text
+        self.source = source
+
+    def render(self):
+        try:
+            stats = self.source()
+        except Exception:
+            return []
+        lines = []
+        for field, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{self.prefix}_{field}"
+            lines.append(f"# HELP {name} {self.help}: {field}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+        return lines
+
+
+class LabeledGaugeCollector:
+    """Gauge с одной меткой из словаря {значение метки: число}; пропавшие метки пропадают из вывода"""
+
+    def __init__(self, name, help_text, label, source):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.source = source
+
+    def render(self):
+        try:
+            values = self.source()
+        except Exception:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for label_value, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels((self.label,), (label_value,))} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    """Набор метрик, отдаваемых одним ответом"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        with self._lock:
+            if metric in self._metrics:
+                self._metrics.remove(metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        """Текст для /metrics (text/plain; version=0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# ---------- метрики бота ----------
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', 'Время обработки апдейта обработчиком', ['handler'])
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Исключения, вылетевшие из обработчика', ['handler'])
+
+FIREBASE_CALLS = REGISTRY.counter(
+    'bot_firebase_calls_total', 'Вызовы Firebase по операции, пути и исходу', ['op', 'path', 'status'])
+FIREBASE_SECONDS = REGISTRY.histogram(
+    'bot_firebase_call_seconds', 'Длительность вызова Firebase', ['op', 'path'])
+
+TELEGRAM_SEND_SECONDS = REGISTRY.histogram(
+    'bot_telegram_send_seconds', 'Длительность вызова sendMessage', ['chat'])
+TELEGRAM_RETRY_AFTER = REGISTRY.counter(
+    'bot_telegram_retry_after_total', 'Ответы RetryAfter (429) от Telegram', ['chat'])
+TELEGRAM_RETRY_AFTER_SECONDS = REGISTRY.counter(
+    'bot_telegram_retry_after_seconds_total', 'Суммарное ожидание по RetryAfter', ['chat'])
+TELEGRAM_QUEUE_SECONDS = REGISTRY.histogram(
+    'bot_telegram_queue_seconds', 'Время сообщения в очереди отправки до доставки', ['chat'], buckets=LAG_BUCKETS)
+
+DELIVERY_LAG_SECONDS = REGISTRY.histogram(
+    'bot_site_to_telegram_lag_seconds', 'Задержка от t сообщения на сайте до доставки в Telegram',
+    ['chat'], buckets=LAG_BUCKETS)
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    'bot_queue_depth', 'Глубина внутренних очередей', ['queue'])
+
+
+def observe_handler(handler):
+    """Декоратор обработчика апдейтов: гистограмма времени и счётчик исключений по имени функции"""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+class PathLabels:
+    """Путь Firebase → короткая метка по самому длинному известному префиксу (ограниченная кардинальность)"""
+
+    def __init__(self, prefixes):
+        # {путь: метка}; длинные префиксы проверяем первыми
+        self._prefixes = sorted(
+            ((path.strip('/'), label) for path, label in prefixes.items()),
+            key=lambda item: len(item[0]), reverse=True,
+        )
+
+    def __call__(self, path):
+        path = path.strip('/')
+        if not path:
+            return '/'
+        for prefix, label in self._prefixes:
+            if path == prefix or path.startswith(prefix + '/'):
+                return label
+        return 'other'
+
+
+# ---------- HTTP ----------
+
+class MetricsServer:
+    """GET /metrics на локальном порту (asyncio, без зависимостей)"""
+
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9090):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?', 1)[0] if len(parts) > 1 else ''
+            if len(parts) > 1 and parts[0] == 'GET' and path in ('/metrics', '/'):
+                status, body = '200 OK', self.registry.render().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                status, body, content_type = '404 Not Found', b'not found\n', 'text/plain'
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
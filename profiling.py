@@ -0,0 +1,178 @@
+"""
+Диагностика по запросу
+Сэмплирующий профайлер (стеки всех потоков через sys._current_frames - event loop и рабочие
+потоки asyncio.to_thread) и кольцевой буфер замеров горячих участков (span).
+"""
+
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+
+# ============= СЭМПЛИРУЮЩИЙ ПРОФАЙЛЕР =============
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Результат профилирования: счётчики стеков 'поток;внешняя;...;внутренняя'"""
+
+    def __init__(self, stacks, samples, seconds, interval):
+        self.stacks = stacks
+        self.samples = samples  # сколько раз снимали стеки (на каждом - все потоки)
+        self.seconds = seconds
+        self.interval = interval
+
+    def collapsed(self):
+        """Формат collapsed stacks (flamegraph.pl, speedscope): 'a;b;c N' на строку"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, n=20):
+        """Самые горячие функции: [(функция, своих сэмплов, всего сэмплов)] по своим"""
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]  # первый - имя потока
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return [(frame, count, total[frame]) for frame, count in own.most_common(n)]
+
+    @property
+    def total(self):
+        return sum(self.stacks.values())
+
+
+class SamplingProfiler:
+    """Снимает стеки всех потоков раз в interval секунд в своём потоке - event loop не трогает"""
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.running = False
+
+    async def run(self, seconds):
+        """Профилировать seconds секунд (один запуск за раз)"""
+        if self.running:
+            raise RuntimeError("профайлер уже запущен")
+        self.running = True
+        try:
+            return await asyncio.to_thread(self._sample, seconds)
+        finally:
+            self.running = False
+
+    def _sample(self, seconds):
+        own_id = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < self.max_depth:
+                    labels.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(names.get(thread_id, f"thread-{thread_id}"))
+                stacks[';'.join(reversed(labels))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        return Profile(stacks, samples, time.perf_counter() - started, self.interval)
+
+
+# ============= ЗАМЕРЫ (SPAN) =============
+
+class SpanRing:
+    """Последние size замеров (время начала, имя, длительность, атрибуты) - пишутся без блокировок"""
+
+    def __init__(self, size=2000):
+        self._spans = deque(maxlen=size)
+
+    def resize(self, size):
+        self._spans = deque(self._spans, maxlen=size)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def record(self, name, duration, **attrs):
+        """Добавить готовый замер (duration - секунды)"""
+        self._spans.append((time.time() - duration, name, duration, attrs))
+
+    def span(self, name, **attrs):
+        """with SPANS.span('имя'): ... - замер блока (внутри можно await)"""
+        return _Span(self, name, attrs)
+
+    def traced(self, name=None):
+        """Декоратор async функции: замер каждого вызова"""
+        def decorator(fn):
+            span_name = name or fn.__name__
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.record(span_name, time.perf_counter() - started)
+
+            return wrapper
+        return decorator
+
+    def dump(self, limit=None):
+        """Текст замеров, старые сверху: 'ЧЧ:ММ:СС.ммм  имя  12.3 мс  k=v'"""
+        spans = list(self._spans)
+        if limit:
+            spans = spans[-limit:]
+        lines = []
+        for started, name, duration, attrs in spans:
+            stamp = datetime.fromtimestamp(started).strftime('%H:%M:%S.%f')[:-3]
+            extra = ' '.join(f"{key}={value}" for key, value in attrs.items())
+            lines.append(f"{stamp}  {name}  {duration * 1000:.1f} мс  {extra}".rstrip())
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def summary(self):
+        """По именам: {имя: (количество, p50 мс, p99 мс, максимум мс)}"""
+        durations = {}
+        for _, name, duration, _ in list(self._spans):
+            durations.setdefault(name, []).append(duration * 1000)
+        result = {}
+        for name, values in durations.items():
+            values.sort()
+            result[name] = (
+                len(values),
+                values[len(values) // 2],
+                values[min(len(values) - 1, int(len(values) * 0.99))],
+                values[-1],
+            )
+        return result
+
+
+class _Span:
+    __slots__ = ('ring', 'name', 'attrs', 'started')
+
+    def __init__(self, ring, name, attrs):
+        self.ring = ring
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.ring.record(self.name, time.perf_counter() - self.started, **self.attrs)
+
+
+# Общий буфер процесса (как metrics.REGISTRY)
+SPANS = SpanRing()
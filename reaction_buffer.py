@@ -0,0 +1,135 @@
+"""
+Буфер реакций из Telegram
+Короткое окно: одинаковые реакции одного пользователя склеиваются в одну запись с count,
+весь буфер уходит в Firebase одним многопутевым update.
+"""
+
+import asyncio
+import time
+
+from bot_logging import get_logger
+from firebase_store import push_key
+
+log = get_logger('firebase_out')
+
+
+class PendingReaction:
+    """Накопленная реакция (uid, emoji) за текущее окно"""
+
+    __slots__ = ('uid', 'color', 'emoji', 'count', 't')
+
+    def __init__(self, uid, color, emoji, t):
+        self.uid = uid
+        self.color = color
+        self.emoji = emoji
+        self.count = 0
+        self.t = t
+
+
+class ReactionBuffer:
+    """Копит реакции window секунд и сбрасывает их одной записью"""
+
+    def __init__(self, store, reactions_path, window=0.5, max_pending=500):
+        self.store = store
+        self.reactions_path = reactions_path
+        self.window = window
+        self.max_pending = max_pending
+
+        self._pending = {}   # (uid, emoji) → PendingReaction
+        self._flush_handle = None
+        self._flush_tasks = set()
+
+        self.taps = 0
+        self.writes = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def add(self, uid, color, emoji):
+        """Добавить нажатие; запись в Firebase - по окончании окна"""
+        now_ms = int(time.time() * 1000)
+        key = (uid, emoji)
+        reaction = self._pending.get(key)
+        if reaction is None:
+            reaction = self._pending[key] = PendingReaction(uid, color, emoji, now_ms)
+        reaction.count += 1
+        reaction.color = color
+        reaction.t = now_ms
+        self.taps += 1
+
+        if len(self._pending) >= self.max_pending:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+
+    def merge(self, uid, emoji):
+        """Добавить нажатие, только если такая реакция уже ждёт записи (лишней записи не будет)"""
+        reaction = self._pending.get((uid, emoji))
+        if reaction is None:
+            return False
+        reaction.count += 1
+        self.taps += 1
+        return True
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        task = asyncio.create_task(self.flush())
+        # Держим ссылку на таск, чтобы его не собрал сборщик мусора
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        """Отправить всё накопленное одним многопутевым update"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        updates = {}
+        for reaction in pending.values():
+            key = push_key(reaction.t)
+            updates[key] = {
+                'uid': reaction.uid,
+                'color': reaction.color,
+                'emoji': reaction.emoji,
+                'emo': reaction.emoji,  # для совместимости
+                't': reaction.t,
+                'count': reaction.count,
+                'id': f"tg_{key}",
+                'fromTelegram': True,
+            }
+
+        try:
+            await self.store.update(self.reactions_path, updates)
+            self.writes += len(updates)
+            self.flushes += 1
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка записи реакций (%d шт.): %s", len(updates), e)
+            # Не теряем нажатия: возвращаем в буфер и пробуем в следующем окне
+            for key, reaction in pending.items():
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = reaction
+                else:
+                    current.count += reaction.count
+            if self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+
+    async def close(self):
+        """Сбросить остаток при остановке"""
+        await self.flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'taps': self.taps,
+            'writes': self.writes,
+            'flushes': self.flushes,
+            'errors': self.errors,
+        }
@@ -0,0 +1,285 @@
+"""
+Рендер сообщений в Telegram
+Клавиатуры и справка собираются один раз при импорте; текст пользователей экранируется
+для MarkdownV2 одной таблицей str.translate, длинные сообщения режутся под лимит Telegram.
+"""
+
+import re
+from datetime import datetime
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+
+TELEGRAM_MAX_CHARS = 4096
+
+MARKDOWN = ParseMode.MARKDOWN        # статичные тексты (проверены вручную)
+MARKDOWN_V2 = ParseMode.MARKDOWN_V2  # всё, где есть текст пользователей
+
+# Эмодзи из сайта (те же 18 что на сайте)
+SITE_EMOJIS = [
+    '👍', '👎', '❤️', '😂', '😮', '😢',
+    '🔥', '🤡', '🤬', '🍷', '🧐', '💃',
+    '🚩', '🤷‍♂️', '🙄', '💔', '🤯', '🔔'
+]
+
+
+# ============= MARKDOWNV2 =============
+
+# Все символы, которые MarkdownV2 требует экранировать (и сам обратный слэш)
+_MD_V2_SPECIAL = '\\_*[]()~`>#+-=|{}.!'
+_MD_V2_TABLE = str.maketrans({char: '\\' + char for char in _MD_V2_SPECIAL})
+_MD_V2_MARKUP = re.compile(r'\\(.)|[*_~`]', re.DOTALL)
+
+
+def escape_md(text):
+    """Экранирует текст для MarkdownV2 - после этого Telegram не может отклонить разметку"""
+    return str(text).translate(_MD_V2_TABLE)
+
+
+def bold(text):
+    return f"*{escape_md(text)}*"
+
+
+def code(text):
+    # Внутри `...` экранируются только ` и \\
+    return '`' + str(text).replace('\\', '\\\\').replace('`', '\\`') + '`'
+
+
+def pre(text):
+    """Блок кода ```...``` (внутри экранируются только ` и \\)"""
+    return '```\n' + str(text).replace('\\', '\\\\').replace('`', '\\`') + '\n```'
+
+
+def to_plain(text):
+    """MarkdownV2 → обычный текст (запасной вариант отправки без разметки)"""
+    return _MD_V2_MARKUP.sub(lambda match: match.group(1) or '', text)
+
+
+# ============= ДЛИНА =============
+
+def split_message(text, limit=TELEGRAM_MAX_CHARS):
+    """Режет текст на части не длиннее limit: по строкам, длинную строку - по словам или жёстко
+
+    Экранирование (\\x) не разрывается. Лимит с запасом: считается по разметке, а Telegram
+    меряет текст после её разбора.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+            current = ''
+        while len(line) > limit:
+            cut = line.rfind(' ', limit // 2, limit)
+            if cut <= 0:
+                cut = limit
+            # Не оставляем одиночный \ в конце куска - он экранирует следующий символ
+            while cut > 1 and _escape_open(line, cut):
+                cut -= 1
+            parts.append(line[:cut])
+            line = line[cut:].lstrip(' ')
+        current = line
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _escape_open(line, cut):
+    """Заканчивается ли line[:cut] незакрытым экранированием (нечётным числом \\)"""
+    slashes = 0
+    index = cut - 1
+    while index >= 0 and line[index] == '\\':
+        slashes += 1
+        index -= 1
+    return slashes % 2 == 1
+
+
+# ============= СООБЩЕНИЯ ЧАТА =============
+
+def relay_text(name, text, linked=False):
+    """Строка чата для Telegram: '🎨 *Имя*: текст' (🎨 - привязанный аккаунт сайта)"""
+    prefix = '🎨 ' if linked else ''
+    return f"{prefix}{bold(name)}: {escape_md(text)}"
+
+
+# ============= ИСТОРИЯ =============
+
+def history_text(entries, page, pages):
+    """Страница /history: 'ЧЧ:ММ 🌐 *Имя*: текст' (📱 - из Telegram), старые сверху"""
+    if not entries:
+        return "📭 История пока пуста"
+    rows = []
+    for entry in entries:
+        stamp = datetime.fromtimestamp(entry.t / 1000).strftime('%H:%M') if entry.t else '--:--'
+        source = '📱' if entry.from_telegram else '🌐'
+        rows.append(f"{code(stamp)} {source} {bold(entry.name)}: {escape_md(entry.text)}")
+    return f"📜 *История* {escape_md(f'({page + 1}/{pages})')}\n\n" + '\n'.join(rows)
+
+
+def history_keyboard(count, page, pages):
+    """Кнопки листания: страница 0 - самые новые; в callback_data - сколько сообщений и страница"""
+    buttons = []
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton("◀️ Раньше", callback_data=f"history_{count}_{page + 1}"))
+    if page > 0:
+        buttons.append(InlineKeyboardButton("Позже ▶️", callback_data=f"history_{count}_{page - 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+# ============= ОТВЕТЫ КОМАНД =============
+
+def link_success_text(site_name):
+    return (
+        f"✅ *Успешно привязано\\!*\n\n"
+        f"Теперь ты {bold(site_name)} 🎨\n\n"
+        f"Твои сообщения будут отображаться с этим именем и цветом на сайте\\!"
+    )
+
+
+def already_linked_text(site_name):
+    return (
+        f"⚠️ Твой Telegram уже привязан к аккаунту {bold(site_name)}\n\n"
+        f"Сначала отвяжись командой `/unlink`"
+    )
+
+
+def unlinked_text(site_names):
+    names = ', '.join(bold(name) for name in site_names)
+    return (
+        f"✅ Отвязано от аккаунта {names}\n\n"
+        f"Теперь твои сообщения будут идти как \\[TG\\] сообщения\\."
+    )
+
+
+def whoami_text(link, tg_user, linked_at):
+    """Статус привязки; linked_at - уже отформатированная дата"""
+    if link:
+        return (
+            f"✅ *Ты привязан\\!*\n\n"
+            f"👤 Имя на сайте: {bold(link['siteName'])}\n"
+            f"🎨 Цвет: {code(link['siteColor'])}\n"
+            f"🔗 Привязано: {escape_md(linked_at)}\n\n"
+            f"Твои сообщения отображаются с этим именем и цветом\\!"
+        )
+    return (
+        f"⚪ *Не привязан*\n\n"
+        f"👤 Telegram: {escape_md(tg_user.first_name)}\n"
+        f"🆔 ID: {code(tg_user.id)}\n\n"
+        f"Твои сообщения идут с префиксом \\[TG\\]\\.\n"
+        f"Используй `/link CODE` чтобы привязать аккаунт с сайта\\."
+    )
+
+
+# ============= ДИАГНОСТИКА (админы) =============
+
+def profile_text(profile, top_n=20):
+    """Сводка профайлера: самые горячие функции по своим сэмплам"""
+    total = profile.total or 1
+    rows = [f"{'своё':>6} {'всего':>6}  функция"]
+    for frame, own, inclusive in profile.top(top_n):
+        rows.append(f"{own * 100 / total:5.1f}% {inclusive * 100 / total:5.1f}%  {frame[:80]}")
+    return (
+        f"⏱ *Профиль за {escape_md(f'{profile.seconds:.1f}')} с*: "
+        f"{escape_md(profile.samples)} снимков, {escape_md(profile.total)} стеков\n"
+        + pre('\n'.join(rows))
+    )
+
+
+def spans_text(summary):
+    """Сводка замеров по именам: количество, p50, p99, максимум (мс)"""
+    if not summary:
+        return "📭 Замеров пока нет"
+    rows = [f"{'имя':<28} {'шт':>6} {'p50':>8} {'p99':>8} {'макс':>8}"]
+    for name, (count, p50, p99, worst) in sorted(summary.items()):
+        rows.append(f"{name[:28]:<28} {count:>6} {p50:>8.1f} {p99:>8.1f} {worst:>8.1f}")
+    return "🧵 *Замеры, мс*\n" + pre('\n'.join(rows))
+
+
+def dead_letters_text(letters):
+    """Записи dead letter спула: id, полоса, попытки, время отказа и ошибка"""
+    if not letters:
+        return "📭 Dead letter пуст"
+    rows = []
+    for letter in letters:
+        failed_at = datetime.fromtimestamp(letter['failed_at']).strftime('%d.%m %H:%M')
+        rows.append(f"#{letter['id']} {letter['lane']}, попыток {letter['attempts']}, {failed_at}")
+        rows.append(f"   {str(letter['error'] or '')[:100]}")
+    return f"☠️ *Dead letter*, последние {escape_md(len(letters))}:\n" + pre('\n'.join(rows))
+
+
+# ============= СТАТИЧНЫЕ ТЕКСТЫ И КЛАВИАТУРЫ (Markdown) =============
+
+WELCOME_TEXT = """
+🎮 **DepressivePasties Bot**
+
+Этот бот синхронизирует чат между сайтом и Telegram!
+
+**Команды:**
+/link CODE - Привязать аккаунт с сайта
+/unlink - Отвязать аккаунт
+/whoami - Проверить свою привязку
+/r или /reaction - Отправить реакцию
+/history - Последние сообщения чата
+/help - Помощь
+
+**Как привязать:**
+1. Зайди на сайт и нажми "🔗 Связать Telegram"
+2. Скопируй код (вида LINK-XXXX)
+3. Отправь сюда: `/link LINK-XXXX`
+
+После привязки твои сообщения будут отображаться с твоим именем и цветом с сайта! 🎨
+"""
+
+HELP_TEXT = """
+📖 **Помощь**
+
+**Основные команды:**
+• `/link CODE` - Привязать аккаунт
+• `/unlink` - Отвязать аккаунт
+• `/whoami` - Твой статус
+• `/r` или `/reaction` - Меню реакций
+• `/history 30` - Последние сообщения чата (по умолчанию 20)
+
+**Как работает:**
+✅ Привязанные пользователи - сообщения идут с именем/цветом с сайта
+⚪ Без привязки - сообщения идут с префиксом [TG]
+
+**Реакции:**
+Используй `/r` чтобы открыть меню с эмодзи. Можешь отправить любой эмодзи командой:
+`/r 🎉` или `/reaction ❤️`
+"""
+
+LINK_USAGE_TEXT = (
+    "❌ Укажи код!\n\nИспользуй: `/link LINK-XXXX`\n\n"
+    "Код можно получить на сайте, нажав кнопку '🔗 Связать Telegram'"
+)
+
+REACTION_MENU_TEXT = (
+    "🎭 Выбери реакцию:\n\n"
+    "Или отправь командой: `/r 🎉`"
+)
+
+CUSTOM_REACTION_TEXT = (
+    "✨ **Отправь любой эмодзи!**\n\n"
+    "Просто напиши эмодзи в чат или используй:\n"
+    "`/r 🎉` (твой эмодзи)"
+)
+
+
+def build_reaction_keyboard(emojis, per_row=6):
+    """Меню реакций: по per_row эмодзи в ряд и кнопка своего эмодзи"""
+    buttons = [InlineKeyboardButton(emoji, callback_data=f"react_{emoji}") for emoji in emojis]
+    keyboard = [buttons[i:i + per_row] for i in range(0, len(buttons), per_row)]
+    keyboard.append([InlineKeyboardButton("✨ Свой эмодзи", callback_data="react_custom")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# Разметка неизменяемая - одна на все /r
+REACTION_KEYBOARD = build_reaction_keyboard(SITE_EMOJIS)
@@ -0,0 +1,147 @@
+"""
+Комнаты: сессия сайта в Firebase ↔ группа Telegram (и RAT группа)
+Таблица маршрутов из настроек; один процесс обслуживает все комнаты,
+chat_id → комната ищется по словарю за O(1).
+"""
+
+import json
+import os
+
+from live_state import LinkIndex, RatModeCell
+
+
+class Room:
+    """Одна комната: пути в Firebase и живое состояние, которое держат её слушатели"""
+
+    def __init__(self, base_path, chat_id, rat_chat_id=None, name=None):
+        self.base_path = base_path.strip('/')
+        self.name = name or self.base_path.rsplit('/', 1)[-1]
+        self.chat_id = str(chat_id) if chat_id else None
+        self.rat_chat_id = str(rat_chat_id) if rat_chat_id else None
+
+        # Пути к данным комнаты
+        self.chat_ref = f'{self.base_path}/chat'
+        self.links_ref = f'{self.base_path}/telegram_links'
+        self.codes_ref = f'{self.base_path}/link_codes'
+        self.reactions_ref = f'{self.base_path}/reactions'
+        self.rat_mode_ref = f'{self.base_path}/rat_mode'  # Флаг RAT режима
+        self.chat_archive_ref = f'{self.base_path}/chat_archive'  # Сжатый архив чата по дням
+
+        # Живое состояние (обновляется слушателями комнаты)
+        self.link_index = LinkIndex()  # tgUserId/siteUserId → привязка
+        self.rat_mode = RatModeCell(self.name)
+        self.chat_cursor = None  # ChatCursor, создаётся при запуске (файл в STATE_DIR)
+        self.chat_listen_params = {}  # параметры запроса слушателя чата (startAt двигается с курсором)
+        self.history = None  # MessageHistory - последние сообщения для /history
+
+        # Слушатели и фоновые задачи комнаты
+        self.chat_listener = None
+        self.links_listener = None
+        self.rat_listener = None
+        self.reaction_buffer = None
+        self.chat_compactor = None
+        self.code_sweeper = None
+
+    def __repr__(self):
+        return f"Room({self.name!r}, chat={self.chat_id}, rat={self.rat_chat_id})"
+
+    @property
+    def chat_ids(self):
+        """Группы Telegram комнаты (основная и RAT)"""
+        return [chat_id for chat_id in (self.chat_id, self.rat_chat_id) if chat_id]
+
+    def is_rat_active(self):
+        """Активен ли RAT режим комнаты (из памяти, без сети)"""
+        return self.rat_mode.active
+
+    def path_labels(self):
+        """Пути комнаты → метки для метрик Firebase"""
+        return {
+            self.chat_ref: 'CHAT_REF',
+            self.links_ref: 'LINKS_REF',
+            self.codes_ref: 'CODES_REF',
+            self.reactions_ref: 'REACTIONS_REF',
+            self.rat_mode_ref: 'RAT_MODE_REF',
+            self.chat_archive_ref: 'CHAT_ARCHIVE_REF',
+            self.base_path: 'BASE_PATH',
+        }
+
+
+class RoutingTable:
+    """Все комнаты процесса: поиск по chat_id группы и по имени"""
+
+    def __init__(self, rooms):
+        if not rooms:
+            raise ValueError("Не задано ни одной комнаты")
+        self.rooms = list(rooms)
+        self._by_chat = {}
+        self._by_name = {}
+
+        for room in self.rooms:
+            if room.name in self._by_name:
+                raise ValueError(f"Комната {room.name} указана дважды")
+            self._by_name[room.name] = room
+            for chat_id in room.chat_ids:
+                if chat_id in self._by_chat:
+                    raise ValueError(f"Группа {chat_id} привязана к двум комнатам: "
+                                     f"{self._by_chat[chat_id].name} и {room.name}")
+                self._by_chat[chat_id] = room
+
+    def __iter__(self):
+        return iter(self.rooms)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    @property
+    def default(self):
+        """Комната по умолчанию (первая) - для личных сообщений боту"""
+        return self.rooms[0]
+
+    def room_for_chat(self, chat_id):
+        """Комната группы (основной или RAT) или None для чужих чатов"""
+        return self._by_chat.get(str(chat_id))
+
+    def by_name(self, name):
+        return self._by_name.get(name)
+
+    def chat_ids(self):
+        """Все группы всех комнат"""
+        return list(self._by_chat)
+
+    def path_labels(self):
+        labels = {}
+        for room in self.rooms:
+            labels.update(room.path_labels())
+        return labels
+
+
+def load_routes(spec, default_base_path, default_chat_id, default_rat_chat_id=None):
+    """Таблица маршрутов из ROOMS
+
+    ROOMS - JSON список или путь к JSON файлу с ним:
+        [{"session": "sessions/DepressivePasties", "chat_id": "-100...", "rat_chat_id": "-100..."}, ...]
+    Необязательное поле name - имя комнаты (по умолчанию последняя часть session).
+    Без ROOMS - одна комната из BASE_PATH / CHAT_ID / RAT_CHAT_ID.
+    """
+    if not spec:
+        return RoutingTable([Room(default_base_path, default_chat_id, default_rat_chat_id)])
+
+    if not spec.lstrip().startswith('['):
+        with open(spec, 'r', encoding='utf-8') as f:
+            spec = f.read()
+
+    rooms = []
+    for entry in json.loads(spec):
+        session = entry.get('session') or entry.get('base_path')
+        if not session or not entry.get('chat_id'):
+            raise ValueError(f"Комнате нужны session и chat_id: {entry}")
+        rooms.append(Room(session, entry['chat_id'], entry.get('rat_chat_id'), name=entry.get('name')))
+    return RoutingTable(rooms)
+
+
+def room_state_path(state_dir, room, filename):
+    """Файл состояния комнаты: STATE_DIR/rooms/<имя>/<filename>"""
+    path = os.path.join(state_dir, 'rooms', room.name)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, filename)
@@ -0,0 +1,204 @@
+"""
+Слушатель Realtime Database на asyncio
+Потоковое чтение (text/event-stream) через httpx в том же event loop, что и бот: подписка - это
+задача и одно соединение, без потока на слушателя. События put/patch разбираются по одному
+по мере прихода; при обрыве - переподключение с экспонентой и разбросом, при 401/auth_revoked -
+со свежим токеном.
+"""
+
+import asyncio
+import inspect
+import json
+import random
+
+import httpx
+
+from bot_logging import get_logger
+from firebase_store import normalize_path
+
+log = get_logger('listener')
+
+
+class StreamEvent:
+    """Событие слушателя - те же поля, что у firebase_admin.db.Event"""
+
+    __slots__ = ('event_type', 'path', 'data')
+
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+
+class Subscription:
+    """Одна подписка: путь, параметры запроса и callback(event) (обычная функция или async)
+
+    params читаются заново при каждом подключении - туда можно двигать startAt.
+    """
+
+    def __init__(self, stream, path, callback, params=None, name=None):
+        self.stream = stream
+        self.path = normalize_path(path)
+        self.callback = callback
+        self.params = params if params is not None else {}
+        self.name = name or self.path
+        self._task = None
+        self._ready = asyncio.Event()
+
+        self.connected = False
+        self.connects = 0
+        self.events = 0
+        self.errors = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def wait_ready(self, timeout=None):
+        """Ждёт первое событие (полный узел с учётом запроса); False - не дождались за timeout"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self):
+        """Отписаться: задача отменяется, соединение закрывается сразу"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.stream._subscriptions.discard(self)
+
+    async def _run(self):
+        failures = 0
+        while True:
+            try:
+                delivered = await self._listen()
+                # Сервер закрыл поток сам - переподключаемся без паузы, если до этого что-то пришло
+                failures = 0 if delivered else failures + 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                self.errors += 1
+                log.warning("⚠️ Поток %s оборвался: %s", self.name, e)
+            finally:
+                self.connected = False
+            if failures:
+                delay = self.stream.backoff(failures)
+                log.info("🔁 Переподключение %s через %.1f с", self.name, delay)
+                await asyncio.sleep(delay)
+
+    async def _listen(self):
+        """Одно подключение: читает события, пока поток жив; True - было хотя бы одно событие"""
+        backend = self.stream.backend
+        headers = {**(await backend.auth_headers()), 'Accept': 'text/event-stream'}
+        params = {**backend.base_params, **self.params}
+        delivered = False
+
+        async with self.stream.client.stream('GET', backend.url(self.path), params=params, headers=headers) as response:
+            if response.status_code == 401:
+                backend.invalidate_token()
+                raise StreamError("401: токен отклонён")
+            if response.status_code >= 400:
+                raise StreamError(f"{response.status_code} {(await response.aread())[:200]!r}")
+
+            self.connected = True
+            self.connects += 1
+            self.stream.connects += 1
+            log.debug("📡 Поток %s подключен", self.name)
+
+            event_type = None
+            data_lines = []
+            # Строки приходят по мере чтения сокета: событие разбирается, как только закончилось
+            async for line in response.aiter_lines():
+                if line.startswith('event:'):
+                    event_type = line[6:].strip()
+                elif line.startswith('data:'):
+                    data_lines.append(line[5:].lstrip())
+                elif not line:
+                    if event_type is not None:
+                        await self._dispatch(event_type, '\n'.join(data_lines))
+                        delivered = delivered or event_type in ('put', 'patch')
+                    event_type = None
+                    data_lines = []
+        return delivered
+
+    async def _dispatch(self, event_type, data):
+        if event_type in ('put', 'patch'):
+            payload = json.loads(data)
+            self.events += 1
+            self.stream.events += 1
+            try:
+                result = self.callback(StreamEvent(event_type, payload.get('path', '/'), payload.get('data')))
+                if inspect.isawaitable(result):
+                    await result  # async callback - backpressure: следующее событие ждёт
+            except Exception as e:
+                log.exception("❌ Ошибка в обработчике потока %s: %s", self.name, e)
+            self._ready.set()
+        elif event_type == 'keep-alive':
+            pass
+        elif event_type == 'auth_revoked':
+            # Токен истёк - сервер закроет поток; подключаемся заново со свежим
+            self.stream.backend.invalidate_token()
+            raise StreamError("auth_revoked")
+        elif event_type == 'cancel':
+            # Правила базы запретили чтение - повтор с паузой
+            raise StreamError(f"cancel: {data}")
+
+
+class StreamError(Exception):
+    """Поток закрыт сервером или отклонён"""
+
+
+class RealtimeStream:
+    """Все подписки процесса: общий httpx клиент, соединение на подписку
+
+    backend - RestBackend (адрес базы, параметры и токен те же, что у запросов).
+    idle_timeout - столько без единого байта считаем поток мёртвым (Firebase шлёт keep-alive раз в 30 с).
+    """
+
+    def __init__(self, backend, idle_timeout=90.0, base_delay=1.0, max_delay=60.0):
+        self.backend = backend
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0, read=idle_timeout),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=0),
+            follow_redirects=True,  # база может перенаправить поток на другой хост
+        )
+        self._subscriptions = set()
+
+        self.connects = 0
+        self.events = 0
+
+    def subscribe(self, path, callback, params=None, name=None):
+        """Подписаться на путь; первое событие - полный узел (с учётом запроса)"""
+        subscription = Subscription(self, path, callback, params, name)
+        self._subscriptions.add(subscription)
+        return subscription.start()
+
+    def backoff(self, failures):
+        """Экспонента с разбросом: [d/2, d], d = base * 2^(failures-1), не больше max_delay"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def close(self):
+        for subscription in list(self._subscriptions):
+            await subscription.close()
+        await self.client.aclose()
+
+    def stats(self):
+        subscriptions = list(self._subscriptions)
+        return {
+            'subscriptions': len(subscriptions),
+            'connected': sum(1 for sub in subscriptions if sub.connected),
+            'connects': self.connects,
+            'events': self.events,
+            'errors': sum(sub.errors for sub in subscriptions),
+        }
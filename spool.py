@@ -0,0 +1,253 @@
+"""
+Спул исходящих доставок на SQLite
+Неудавшиеся записи в Firebase и отправки в Telegram ложатся в локальную базу и повторяются
+с экспоненциальной задержкой и разбросом; постоянные ошибки уходят в dead letter.
+Внутри полосы (комната, чат) порядок сохраняется, после рестарта спул дочитывается с начала.
+"""
+
+import asyncio
+import json
+import random
+import sqlite3
+import time
+
+from bot_logging import get_logger
+
+log = get_logger('core')
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    created REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS spool_lane ON spool (lane, id);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    lane TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    created REAL NOT NULL,
+    failed_at REAL NOT NULL,
+    error TEXT
+);
+"""
+
+
+class PartialDelivery(Exception):
+    """Доставка прошла частично: дальше повторяется только payload (остаток), причина - в __cause__"""
+
+    def __init__(self, payload):
+        super().__init__("доставлено частично")
+        self.payload = payload
+
+
+class Spool:
+    """Полосы доставок в SQLite: у каждой полосы свой воркер, голова полосы блокирует хвост
+
+    kind - тип доставки со своей функцией отправки (register), lane - порядок внутри типа
+    (например, 'firebase:<комната>' или 'telegram:<chat_id>').
+    """
+
+    def __init__(self, path, base_delay=1.0, max_delay=300.0, max_age=86400.0):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age  # дольше этого временные ошибки тоже уходят в dead letter
+
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+        # WAL + NORMAL: запись не ждёт fsync каждой транзакции, база переживает падение процесса
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+
+        self._kinds = {}    # kind → (sender, is_permanent)
+        self._workers = {}  # lane → task
+        self._pending = {}  # lane → записей в спуле
+        self._started = False
+        for lane, count in self._db.execute('SELECT lane, COUNT(*) FROM spool GROUP BY lane'):
+            self._pending[lane] = count
+
+        self.spooled = 0
+        self.delivered = 0
+        self.retries = 0
+        self.dead = self._db.execute('SELECT COUNT(*) FROM dead_letter').fetchone()[0]
+
+    def register(self, kind, sender, is_permanent=None):
+        """sender(payload) - async отправка; is_permanent(error) → True: повторять бесполезно"""
+        self._kinds[kind] = (sender, is_permanent or (lambda error: False))
+
+    def pending(self, lane):
+        """Сколько записей полосы ждут в спуле (новые сообщения встают за ними)"""
+        return self._pending.get(lane, 0)
+
+    def __len__(self):
+        return sum(self._pending.values())
+
+    # ---------- запись ----------
+
+    def put(self, kind, lane, payload, error=None):
+        """Положить доставку в конец полосы; постоянная ошибка - сразу в dead letter"""
+        now = time.time()
+        if error is not None and self._is_permanent(kind, error):
+            self._bury(kind, lane, payload, 1, now, error)
+            return
+        with self._db:
+            self._db.execute(
+                'INSERT INTO spool (kind, lane, payload, attempts, next_at, created, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, lane, json.dumps(payload, ensure_ascii=False), 1 if error else 0,
+                 now + (self._backoff(1) if error else 0), now, repr(error) if error else None),
+            )
+        self._pending[lane] = self._pending.get(lane, 0) + 1
+        self.spooled += 1
+        log.warning("📥 В спул (%s): %s", lane, error or 'полоса занята', extra={'pending': self._pending[lane]})
+        self._wake(lane)
+
+    def _bury(self, kind, lane, payload, attempts, created, error, row_id=None):
+        with self._db:
+            self._db.execute(
+                'INSERT INTO dead_letter (kind, lane, payload, attempts, created, failed_at, error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, lane, payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False),
+                 attempts, created, time.time(), repr(error)),
+            )
+            if row_id is not None:
+                self._db.execute('DELETE FROM spool WHERE id = ?', (row_id,))
+        self.dead += 1
+        log.error("☠️ Доставка в dead letter (%s, попыток: %d): %s", lane, attempts, error)
+
+    # ---------- повторы ----------
+
+    def start(self):
+        """Запустить воркеры полос, оставшихся с прошлого запуска"""
+        self._started = True
+        for lane in list(self._pending):
+            self._wake(lane)
+
+    async def stop(self):
+        self._started = False
+        workers, self._workers = list(self._workers.values()), {}
+        for task in workers:
+            task.cancel()
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def close(self):
+        self._db.close()
+
+    def _wake(self, lane):
+        if self._started and lane not in self._workers:
+            self._workers[lane] = asyncio.create_task(self._drain(lane))
+
+    async def _drain(self, lane):
+        try:
+            while True:
+                row = self._db.execute(
+                    'SELECT id, kind, payload, attempts, next_at, created FROM spool WHERE lane = ? ORDER BY id LIMIT 1',
+                    (lane,),
+                ).fetchone()
+                if row is None:
+                    self._pending.pop(lane, None)
+                    return
+                row_id, kind, payload, attempts, next_at, created = row
+
+                delay = next_at - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                sender, _ = self._kinds[kind]
+                try:
+                    await sender(json.loads(payload))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._failed(row_id, kind, lane, payload, attempts + 1, created, e)
+                    continue
+
+                with self._db:
+                    self._db.execute('DELETE FROM spool WHERE id = ?', (row_id,))
+                self._pending[lane] -= 1
+                self.delivered += 1
+                if attempts:
+                    log.info("📤 Доставлено из спула (%s) с попытки %d", lane, attempts + 1)
+        finally:
+            if self._workers.get(lane) is asyncio.current_task():
+                del self._workers[lane]
+
+    def _failed(self, row_id, kind, lane, payload, attempts, created, error):
+        if isinstance(error, PartialDelivery):
+            payload = json.dumps(error.payload, ensure_ascii=False)
+            error = error.__cause__ or error
+        if self._is_permanent(kind, error) or time.time() - created > self.max_age:
+            self._bury(kind, lane, payload, attempts, created, error, row_id)
+            self._pending[lane] -= 1
+            return
+        delay = self._backoff(attempts)
+        with self._db:
+            self._db.execute(
+                'UPDATE spool SET payload = ?, attempts = ?, next_at = ?, error = ? WHERE id = ?',
+                (payload, attempts, time.time() + delay, repr(error), row_id),
+            )
+        self.retries += 1
+        log.warning("🔁 Повтор %s через %.1f с (попытка %d): %s", lane, delay, attempts, error)
+
+    def _backoff(self, attempts):
+        """Экспонента с разбросом: [d/2, d], d = base * 2^(attempts-1), не больше max_delay"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _is_permanent(self, kind, error):
+        _, is_permanent = self._kinds.get(kind, (None, None))
+        return bool(is_permanent and is_permanent(error))
+
+    # ---------- dead letter ----------
+
+    def dead_letters(self, limit=50):
+        """Последние записи dead letter: [{id, kind, lane, payload, attempts, error, failed_at}]"""
+        rows = self._db.execute(
+            'SELECT id, kind, lane, payload, attempts, error, failed_at FROM dead_letter ORDER BY id DESC LIMIT ?',
+            (limit,),
+        ).fetchall()
+        return [
+            {'id': row[0], 'kind': row[1], 'lane': row[2], 'payload': json.loads(row[3]),
+             'attempts': row[4], 'error': row[5], 'failed_at': row[6]}
+            for row in rows
+        ]
+
+    def retry_dead(self, ids=None):
+        """Вернуть записи dead letter в спул (все или по id) - например, после исправления прав"""
+        query = 'SELECT id, kind, lane, payload, created FROM dead_letter'
+        params = ()
+        if ids:
+            query += f" WHERE id IN ({', '.join('?' * len(ids))})"
+            params = tuple(ids)
+        rows = self._db.execute(query + ' ORDER BY id', params).fetchall()
+        now = time.time()
+        with self._db:
+            for row_id, kind, lane, payload, created in rows:
+                self._db.execute(
+                    'INSERT INTO spool (kind, lane, payload, attempts, next_at, created) VALUES (?, ?, ?, 0, ?, ?)',
+                    (kind, lane, payload, now, now),
+                )
+                self._db.execute('DELETE FROM dead_letter WHERE id = ?', (row_id,))
+        for _, _, lane, _, _ in rows:
+            self._pending[lane] = self._pending.get(lane, 0) + 1
+            self._wake(lane)
+        self.dead -= len(rows)
+        return len(rows)
+
+    def stats(self):
+        return {
+            'pending': len(self),
+            'lanes': len(self._pending),
+            'spooled': self.spooled,
+            'delivered': self.delivered,
+            'retries': self.retries,
+            'dead': self.dead,
+        }
@@ -0,0 +1,330 @@
+"""
+Исходящая очередь в Telegram для одного чата
+Token bucket под лимит группы (~20 сообщений в минуту), склейка пачек в одно сообщение
+при заторе, точное соблюдение RetryAfter и статистика задержки доставки.
+Текст приходит уже в MarkdownV2 (render); длиннее лимита Telegram - уходит частями.
+Пересылки из другого чата копятся так же и уходят одним forward_messages (до 100 штук).
+"""
+
+import asyncio
+import time
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, InvalidToken, NetworkError, RetryAfter
+
+import metrics
+from bot_logging import get_logger
+from render import MARKDOWN_V2, TELEGRAM_MAX_CHARS, split_message, to_plain
+
+log = get_logger('telegram_out')
+
+MAX_FORWARD_IDS = 100  # лимит message_ids в forward_messages
+
+
+class PartialSendError(Exception):
+    """Длинное сообщение ушло не целиком: unsent - текст неотправленных частей (причина - в __cause__)"""
+
+    def __init__(self, unsent):
+        super().__init__("сообщение отправлено не целиком")
+        self.unsent = unsent
+
+    def __str__(self):
+        return f"сообщение отправлено не целиком: {self.__cause__}"
+
+
+def is_permanent_error(error):
+    """Повторять бесполезно: запрос отклонён (после отката разметки), бота выгнали, токен неверный"""
+    if isinstance(error, PartialSendError):
+        error = error.__cause__
+    return isinstance(error, (BadRequest, Forbidden, InvalidToken))
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_acquire(self):
+        """Забрать токен без ожидания"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Дождаться и забрать токен"""
+        while not self.try_acquire():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def drain(self, seconds=0.0):
+        """Обнулить запас (например, после RetryAfter) и не пополнять ещё seconds"""
+        self.tokens = 0.0
+        self.updated = time.monotonic() + seconds
+
+
+class OutboundItem:
+    """Одно сообщение в очереди на отправку: текст или пересылка (source = (чат, message_id))"""
+
+    __slots__ = ('text', 'source', 'created', 'on_done', 'valid', 'future')
+
+    def __init__(self, text, on_done=None, valid=None, future=None, source=None):
+        self.text = text
+        self.source = source
+        self.created = time.monotonic()
+        self.on_done = on_done
+        self.valid = valid  # valid() → False: отправлять уже нельзя (например, воркер потерял лидерство)
+        self.future = future  # для send(): результат отправки или её ошибка
+
+
+class ChatOutbox:
+    """Очередь отправки в один Telegram чат"""
+
+    def __init__(self, bot, chat_id, rate_per_minute=20, burst=3, coalesce_window=2.0,
+                 max_chars=TELEGRAM_MAX_CHARS, parse_mode=MARKDOWN_V2, network_retries=3):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.coalesce_window = coalesce_window
+        self.max_chars = max_chars
+        self.parse_mode = parse_mode
+        self.network_retries = network_retries
+
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        # Статистика
+        self.sent_messages = 0
+        self.forwarded = 0
+        self.api_calls = 0
+        self.coalesced = 0
+        self.retry_after = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1000)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def submit(self, text, on_done=None, valid=None):
+        """Поставить сообщение в очередь; on_done(ok) вызывается после отправки или отказа
+
+        valid() проверяется перед отправкой: если False - сообщение снимается с on_done(False).
+        Длинное сообщение, ушедшее не целиком, завершается on_done(False, unsent) - повторять нужно только unsent.
+        """
+        self._queue.append(OutboundItem(text, on_done, valid))
+        self._wakeup.set()
+
+    def submit_forward(self, from_chat_id, message_id, on_done=None, valid=None):
+        """Поставить в очередь пересылку сообщения из from_chat_id (подряд идущие уходят одним вызовом)"""
+        self._queue.append(OutboundItem('', on_done, valid, source=(from_chat_id, message_id)))
+        self._wakeup.set()
+
+    async def send(self, text):
+        """Отправить через очередь и дождаться результата; ошибка отправки пробрасывается
+        (PartialSendError - часть длинного сообщения уже в чате)"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append(OutboundItem(text, future=future))
+        self._wakeup.set()
+        await future
+
+    def qsize(self):
+        return len(self._queue)
+
+    # ---------- отправка ----------
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Пока ждём токен, в очереди копится хвост - его и склеим
+            await self.bucket.acquire()
+            batch = self._take_batch()
+            stale = [item for item in batch if item.valid is not None and not item.valid()]
+            if stale:
+                self._finish(stale, False, RuntimeError("сообщение устарело"))
+                batch = [item for item in batch if item not in stale]
+                if not batch:
+                    continue
+            error = None
+            try:
+                ok = await self._deliver(batch)
+            except asyncio.CancelledError:
+                # Не потерять пачку при остановке - вернём её в начало очереди
+                self._queue.extendleft(reversed(batch))
+                raise
+            except Exception as e:
+                log.error("❌ Ошибка отправки в %s: %s", self.chat_id, e)
+                ok = False
+                error = e
+
+            self._finish(batch, ok, error)
+
+    def _take_batch(self):
+        first = self._queue.popleft()
+        batch = [first]
+        length = len(first.text)
+
+        # Пачка однородная: тексты склеиваются, пересылки из одного чата - одним вызовом; порядок не меняется.
+        # Пересылки не ограничены окном склейки - весь накопленный за ожиданием токена хвост уходит разом
+        while self._queue:
+            item = self._queue[0]
+            if first.source is not None:
+                if item.source is None or item.source[0] != first.source[0] or len(batch) >= MAX_FORWARD_IDS:
+                    break
+            elif (item.source is not None or item.created - first.created > self.coalesce_window
+                  or length + 1 + len(item.text) > self.max_chars):
+                break
+            batch.append(self._queue.popleft())
+            length += 1 + len(item.text)
+
+        if len(batch) > 1:
+            self.coalesced += len(batch) - 1
+        return batch
+
+    async def _deliver(self, batch):
+        if batch[0].source is not None:
+            await self._forward(batch[0].source[0], [item.source[1] for item in batch])
+            self.forwarded += len(batch)
+            return True
+
+        text = '\n'.join(item.text for item in batch)
+        # Склейка не выходит за max_chars; длиннее может быть только одно сообщение - шлём частями
+        parts = split_message(text, self.max_chars)
+        for index, part in enumerate(parts):
+            if index:
+                await self.bucket.acquire()  # каждая часть - отдельное сообщение под лимитом группы
+            try:
+                await self._send(part)
+            except Exception as e:
+                if not index:
+                    raise
+                # Первые части уже в чате - повтор всего текста их продублирует
+                raise PartialSendError('\n'.join(parts[index:])) from e
+        return True
+
+    async def _send(self, text):
+        parse_mode = self.parse_mode
+
+        while True:
+            try:
+                await self._request(lambda: self.bot.send_message(
+                    chat_id=self.chat_id, text=text, parse_mode=parse_mode))
+                return
+
+            except BadRequest as e:
+                # Текст экранируется при рендере, так что сюда попадает только непредвиденное: шлём без разметки
+                if parse_mode is None:
+                    raise
+                log.warning("⚠️ Разметка отклонена (%s), отправляем без форматирования", e)
+                if parse_mode == MARKDOWN_V2:
+                    text = to_plain(text)
+                parse_mode = None
+
+    async def _forward(self, from_chat_id, message_ids):
+        # Ненайденные (например, удалённые) сообщения Telegram сам пропускает
+        await self._request(lambda: self.bot.forward_messages(
+            chat_id=self.chat_id, from_chat_id=from_chat_id, message_ids=message_ids))
+
+    async def _request(self, call):
+        """Вызов Bot API с ожиданием RetryAfter и повторами сетевых ошибок"""
+        network_errors = 0
+
+        while True:
+            try:
+                self.api_calls += 1
+                with metrics.TELEGRAM_SEND_SECONDS.time(chat=self.chat_id):
+                    return await call()
+
+            except RetryAfter as e:
+                # Telegram сам говорит, сколько ждать - ждём ровно столько и повторяем ту же пачку
+                self.retry_after += 1
+                retry = e.retry_after
+                if isinstance(retry, timedelta):
+                    retry = retry.total_seconds()
+                metrics.TELEGRAM_RETRY_AFTER.inc(chat=self.chat_id)
+                metrics.TELEGRAM_RETRY_AFTER_SECONDS.inc(retry, chat=self.chat_id)
+                log.warning("⏳ RetryAfter %s с для чата %s", retry, self.chat_id)
+                self.bucket.drain(retry)
+                await asyncio.sleep(retry)
+
+            except NetworkError as e:
+                if isinstance(e, BadRequest):
+                    raise
+                network_errors += 1
+                if network_errors > self.network_retries:
+                    raise
+                log.warning("⚠️ Сетевая ошибка при отправке в %s: %s, повтор #%d", self.chat_id, e, network_errors)
+                await asyncio.sleep(min(2 ** network_errors, 30))
+
+    def _finish(self, batch, ok, error=None):
+        now = time.monotonic()
+        unsent = error.unsent if isinstance(error, PartialSendError) else None
+        for item in batch:
+            if ok:
+                self.sent_messages += 1
+                self._latencies.append(now - item.created)
+                metrics.TELEGRAM_QUEUE_SECONDS.observe(now - item.created, chat=self.chat_id)
+            else:
+                self.failed += 1
+            if item.future is not None and not item.future.done():
+                if ok:
+                    item.future.set_result(None)
+                else:
+                    item.future.set_exception(error or RuntimeError("сообщение не отправлено"))
+            if item.on_done is not None:
+                try:
+                    if unsent is None:
+                        item.on_done(ok)
+                    else:
+                        item.on_done(ok, unsent)
+                except Exception as e:
+                    log.exception("❌ Ошибка в on_done: %s", e)
+
+    # ---------- статистика ----------
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            'chat_id': self.chat_id,
+            'queued': len(self._queue),
+            'sent_messages': self.sent_messages,
+            'forwarded': self.forwarded,
+            'api_calls': self.api_calls,
+            'coalesced': self.coalesced,
+            'retry_after': self.retry_after,
+            'failed': self.failed,
+            'latency_p50': percentile(0.50),
+            'latency_p99': percentile(0.99),
+        }
@@ -0,0 +1,303 @@
+"""
+Планировщик удаления узлов Firebase по таймеру (RAT режим)
+Одна куча дедлайнов вместо задачи на каждое сообщение, расписание на диске,
+удаление пачкой через один многопутевой update({path: None, ...}).
+Для нескольких воркеров - общее расписание в Firebase, удаляет только лидер.
+"""
+
+import asyncio
+import heapq
+import json
+import os
+import time
+
+from bot_logging import get_logger
+from firebase_store import normalize_path, push_key
+
+log = get_logger('firebase_out')
+
+
+class TTLDeleter:
+    """Один фоновый таск, который удаляет пути Firebase по наступлению дедлайнов"""
+
+    def __init__(self, store, schedule_path, batch_size=500, batch_slack=1.0, retry_delay=5.0,
+                 save_interval=1.0):
+        self.store = store
+        self.schedule_path = schedule_path
+        self.batch_size = batch_size
+        self.batch_slack = batch_slack      # захватываем и те, чей срок наступит в ближайшую секунду
+        self.retry_delay = retry_delay
+        self.save_interval = save_interval
+
+        self._heap = []                     # (deadline, path), deadline - unix время
+        self._paths = {}                    # path → deadline (последний запланированный)
+        self._wakeup = asyncio.Event()
+        self._dirty = False
+        self._last_save = 0.0
+        self._task = None
+
+        self.deleted = 0
+        self.batches = 0
+        self.errors = 0
+
+    # ---------- расписание ----------
+
+    def schedule(self, path, delay):
+        """Удалить path через delay секунд"""
+        deadline = time.time() + delay
+        self._paths[path] = deadline
+        heapq.heappush(self._heap, (deadline, path))
+        self._dirty = True
+        if self._heap[0][1] == path:
+            self._wakeup.set()
+
+    def cancel(self, path):
+        """Отменить удаление (запись в куче станет устаревшей и будет пропущена)"""
+        if self._paths.pop(path, None) is not None:
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._paths)
+
+    def load(self):
+        """Читает расписание с диска - просроченное за время простоя удалится первым же пакетом"""
+        try:
+            with open(self.schedule_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.warning("⚠️ Расписание удалений повреждено: %s", e)
+            return
+
+        self.restore(entries)
+        overdue = sum(1 for deadline in self._paths.values() if deadline <= time.time())
+        log.info("⏳ Расписание удалений: %d путей, просрочено за простой: %d", len(self._paths), overdue)
+
+    def restore(self, entries):
+        for path, deadline in entries.items():
+            if path not in self._paths or deadline < self._paths[path]:
+                self._paths[path] = deadline
+        self._heap = [(deadline, path) for path, deadline in self._paths.items()]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+
+    def save(self):
+        tmp_path = f"{self.schedule_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._paths, f)
+            os.replace(tmp_path, self.schedule_path)
+            self._dirty = False
+            self._last_save = time.monotonic()
+        except Exception as e:
+            log.error("❌ Ошибка сохранения расписания удалений: %s", e)
+
+    # ---------- фоновый таск ----------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.save()
+
+    async def close(self):
+        await self.stop()
+
+    async def _run(self):
+        while True:
+            self._drop_stale()
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, self._heap[0][0] - time.time())
+            if self._dirty:
+                save_in = max(0.0, self._last_save + self.save_interval - time.monotonic())
+                timeout = save_in if timeout is None else min(timeout, save_in)
+
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            due = self._take_due()
+            if due:
+                await self._delete_batch(due)
+
+            if self._dirty and time.monotonic() - self._last_save >= self.save_interval:
+                self.save()
+
+    def _drop_stale(self):
+        while self._heap and self._paths.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _take_due(self):
+        horizon = time.time() + self.batch_slack
+        due = []
+        while self._heap and len(due) < self.batch_size and self._heap[0][0] <= horizon:
+            deadline, path = heapq.heappop(self._heap)
+            if self._paths.get(path) == deadline:
+                due.append(path)
+        # Если ни один срок ещё не наступил строго - ждём дальше (slack лишь добирает соседей)
+        if due and self._paths[due[0]] > time.time():
+            for path in due:
+                heapq.heappush(self._heap, (self._paths[path], path))
+            return []
+        return due
+
+    async def _delete_batch(self, paths):
+        try:
+            await self.store.update('/', {path: None for path in paths})
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка пакетного удаления (%d путей): %s", len(paths), e)
+            retry_at = time.time() + self.retry_delay
+            for path in paths:
+                if path in self._paths:
+                    self._paths[path] = retry_at
+                    heapq.heappush(self._heap, (retry_at, path))
+            return
+
+        for path in paths:
+            self._paths.pop(path, None)
+        self._dirty = True
+        self.deleted += len(paths)
+        self.batches += 1
+        log.debug("🗑️ Удалено пакетом: %d путей", len(paths))
+
+    def stats(self):
+        return {
+            'scheduled': len(self._paths),
+            'deleted': self.deleted,
+            'batches': self.batches,
+            'errors': self.errors,
+        }
+
+
+class SharedTTLSchedule:
+    """Расписание удалений в узле Firebase: планирует любой воркер, удаляет владелец аренды
+
+    Записи {'p': путь, 'at': срок в мс} копятся коротким окном и уходят одной записью;
+    start() запускает периодический проход по наступившим срокам (только у лидера).
+    """
+
+    def __init__(self, store, schedule_path, batch_size=500, poll_interval=2.0, window=0.2):
+        self.store = store
+        self.schedule_path = normalize_path(schedule_path)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.window = window
+
+        self._pending = {}   # ключ записи → {'p', 'at'}
+        self._flush_handle = None
+        self._flush_tasks = set()
+        self._task = None
+
+        self.planned = 0
+        self.deleted = 0
+        self.batches = 0
+        self.errors = 0
+
+    # ---------- планирование (любой воркер) ----------
+
+    def schedule(self, path, delay):
+        """Удалить path через delay секунд"""
+        at_ms = int((time.time() + delay) * 1000)
+        self._pending[push_key()] = {'p': normalize_path(path), 'at': at_ms}
+        self.planned += 1
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self.store.update(self.schedule_path, pending)
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка записи расписания удалений (%d шт.): %s", len(pending), e)
+            pending.update(self._pending)
+            self._pending = pending
+            if self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(self.poll_interval, self._start_flush)
+
+    async def close(self):
+        """Остановить проход и дописать накопленное"""
+        await self.stop()
+        await self.flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    # ---------- удаление (владелец аренды) ----------
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.sweep() >= self.batch_size:
+                    pass
+            except Exception as e:
+                self.errors += 1
+                log.error("❌ Ошибка прохода по расписанию удалений: %s", e)
+            await asyncio.sleep(self.poll_interval)
+
+    async def sweep(self):
+        """Удалить всё, чей срок наступил: сами узлы и записи расписания - одним update"""
+        now_ms = int(time.time() * 1000)
+        due = await self.store.get(
+            self.schedule_path, orderBy='at', endAt=now_ms, limitToFirst=self.batch_size
+        ) or {}
+        updates = {}
+        for key, entry in due.items():
+            if isinstance(entry, dict) and entry.get('p'):
+                updates[entry['p']] = None
+            updates[f"{self.schedule_path}/{key}"] = None
+        if not updates:
+            return 0
+        await self.store.update('/', updates)
+        self.deleted += len(due)
+        self.batches += 1
+        log.debug("🗑️ Удалено по общему расписанию: %d путей", len(due))
+        return len(due)
+
+    def stats(self):
+        return {
+            'scheduled': len(self._pending),  # ещё не записаны в Firebase
+            'planned': self.planned,
+            'deleted': self.deleted,
+            'batches': self.batches,
+            'errors': self.errors,
+        }
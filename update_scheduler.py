@@ -0,0 +1,116 @@
+"""
+Обработка апдейтов по ключам
+Апдейты одного чата выполняются строго по порядку, разные чаты, личка и кнопки - параллельно,
+с общим лимитом одновременных обработчиков. Глубина очереди видна по каждому ключу.
+"""
+
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from bot_logging import get_logger
+
+log = get_logger('telegram_in')
+
+
+def update_key(update):
+    """Ключ порядка: чат апдейта; кнопки - по пользователю (нажатия не ждут сообщений группы)"""
+    if not isinstance(update, Update):
+        return None
+    if update.callback_query is not None:
+        return f"callback:{update.callback_query.from_user.id}"
+    chat = update.effective_chat
+    return str(chat.id) if chat is not None else None
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Порядок внутри ключа, параллельность между ключами
+
+    Семафор PTB (max_pending) ограничивает апдейты в работе и в очередях ключей вместе,
+    а свой семафор (concurrency) - только выполняющиеся: апдейт, ждущий свой чат, слот не занимает.
+    """
+
+    def __init__(self, concurrency=8, max_pending=1000, key_fn=update_key, depth_warning=20):
+        super().__init__(max(concurrency, max_pending))
+        self.concurrency = concurrency
+        self.key_fn = key_fn
+        self.depth_warning = depth_warning
+        self._running = None     # asyncio.Semaphore(concurrency), создаётся в initialize
+        self._tails = {}         # ключ → future последнего апдейта ключа (следующий ждёт его)
+        self._depth = {}         # ключ → апдейтов в очереди и в работе
+        self._active = 0
+
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    async def initialize(self):
+        self._running = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key_fn(update)
+        if key is None:
+            try:
+                await self._run(coroutine)
+            finally:
+                coroutine.close()
+            return
+
+        # Цепочка: ждём предыдущий апдейт ключа (без await до этого места - порядок прихода сохраняется)
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        depth = self._depth[key] = self._depth.get(key, 0) + 1
+        self.max_depth = max(self.max_depth, depth)
+        if depth == self.depth_warning:
+            log.warning("🐢 Очередь апдейтов %s: %d", key, depth)
+
+        try:
+            if previous is not None:
+                # shield: отмена ждущего не должна отменять future предыдущего
+                await asyncio.shield(previous)
+            await self._run(coroutine)
+        finally:
+            # Отменены в ожидании очереди - обработчик не запускался, закрываем его корутину;
+            # следующий апдейт ключа всё равно ждёт предыдущий, а не нас
+            coroutine.close()
+            if previous is not None and not previous.done():
+                previous.add_done_callback(lambda _: done.set_result(None))
+            else:
+                done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+            self._depth[key] -= 1
+            if not self._depth[key]:
+                del self._depth[key]
+
+    async def _run(self, coroutine):
+        async with self._running:
+            self._active += 1
+            try:
+                await coroutine
+            except Exception:
+                # Application сам логирует ошибки обработчиков - здесь только счётчик
+                self.errors += 1
+                raise
+            finally:
+                self._active -= 1
+        self.processed += 1
+
+    def depths(self):
+        """Глубина очереди по ключам (только ключи, где что-то есть)"""
+        return dict(self._depth)
+
+    def stats(self):
+        return {
+            'active': self._active,
+            'keys': len(self._depth),
+            'queued': sum(self._depth.values()),
+            'max_depth': self.max_depth,
+            'processed': self.processed,
+            'errors': self.errors,
+        }
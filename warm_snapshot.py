@@ -0,0 +1,168 @@
+"""
+Снимок состояния для быстрого старта
+Индекс привязок, RAT режим и курсор чата каждой комнаты периодически и при остановке пишутся
+в один компактный файл. При запуске снимок загружается до подключения к Firebase - бот отвечает
+сразу, а слушатели сверяют снимок с Firebase в фоне (их первое событие - полный узел).
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from bot_logging import get_logger
+
+log = get_logger('core')
+
+
+SNAPSHOT_VERSION = 1
+
+
+class WarmSnapshot:
+    """Файл снимка комнат: {version, saved, rooms: {имя: {links, rat, cursor}}}"""
+
+    def __init__(self, path, interval=30.0, max_age=86400.0):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age  # старше - привязки и RAT режим не берём (курсор берём всегда)
+        self._rooms = {}        # последнее записанное/загруженное состояние комнат
+        self._written = None    # последний записанный текст - без изменений файл не трогаем
+        self._task = None
+
+        self.saved_at = None
+        self.saves = 0
+        self.restored = 0
+        self.errors = 0
+
+    # ---------- загрузка ----------
+
+    def load(self):
+        """Читает снимок: {имя комнаты: состояние}; без файла или с повреждённым - пусто"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning("⚠️ Снимок состояния повреждён (%s) - холодный старт", e)
+            return {}
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            return {}
+        self.saved_at = data.get('saved')
+        self._rooms = data.get('rooms') or {}
+        rooms = self._rooms
+        age = time.time() - (self.saved_at or 0)
+        if age > self.max_age:
+            log.info("🧊 Снимок состояния старше %d с - берём только курсоры", self.max_age)
+            rooms = {name: {'cursor': state.get('cursor')} for name, state in rooms.items()}
+        return rooms
+
+    def restore(self, room, state):
+        """Применяет состояние комнаты из снимка; True - индекс привязок уже в памяти"""
+        if not state:
+            return False
+        links = state.get('links')
+        if links is not None:
+            room.link_index.load(links)
+        if state.get('rat') is not None:
+            room.rat_mode.apply('put', '/', state['rat'])
+
+        # Курсор: файл курсора пишется на каждую доставку, снимок нужен, если файла нет или он старее
+        cursor = state.get('cursor')
+        if cursor and (room.chat_cursor.fresh or
+                       (cursor.get('t', 0), cursor.get('key', '')) > (room.chat_cursor.t, room.chat_cursor.key)):
+            room.chat_cursor.restore(cursor)
+
+        self.restored += 1
+        log.info("🔥 Из снимка: привязок %d, RAT %s", len(room.link_index),
+                 'ON' if room.is_rat_active() else 'OFF', extra={'room': room.name})
+        return links is not None
+
+    # ---------- запись ----------
+
+    def capture(self, rooms):
+        """Состояние комнат сейчас; ещё не загруженные части берутся из прошлого снимка"""
+        captured = {}
+        for room in rooms:
+            previous = self._rooms.get(room.name, {})
+            state = {}
+            if room.link_index.ready:
+                state['links'] = room.link_index.snapshot()
+            elif previous.get('links') is not None:
+                state['links'] = previous['links']
+            if room.rat_mode.ready:
+                state['rat'] = room.rat_mode.snapshot()
+            elif previous.get('rat') is not None:
+                state['rat'] = previous['rat']
+            if room.chat_cursor is not None and not room.chat_cursor.fresh:
+                state['cursor'] = room.chat_cursor.to_dict()
+            elif previous.get('cursor'):
+                state['cursor'] = previous['cursor']
+            captured[room.name] = state
+        return captured
+
+    def save(self, rooms):
+        """Снимает состояние и атомарно пишет файл; False - ничего не изменилось"""
+        captured, text = self._serialize(rooms)
+        if text == self._written:
+            return False
+        self._write(captured, text)
+        return True
+
+    def _serialize(self, rooms):
+        captured = self.capture(rooms)
+        return captured, json.dumps(captured, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+    def _write(self, captured, rooms_text):
+        now = time.time()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f'{{"version":{SNAPSHOT_VERSION},"saved":{now},"rooms":{rooms_text}}}')
+        os.replace(tmp_path, self.path)
+        self._rooms = captured
+        self._written = rooms_text
+        self.saved_at = now
+        self.saves += 1
+
+    # ---------- фоновая запись ----------
+
+    def start(self, rooms):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(list(rooms)))
+        return self._task
+
+    async def stop(self, rooms):
+        """Останавливает фоновую запись и пишет снимок последний раз"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            self.save(rooms)
+        except Exception as e:
+            self.errors += 1
+            log.error("❌ Ошибка записи снимка состояния: %s", e)
+
+    async def _run(self, rooms):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Копии снимаются в event loop, запись на диск - в потоке
+                captured, text = self._serialize(rooms)
+                if text != self._written:
+                    await asyncio.to_thread(self._write, captured, text)
+            except Exception as e:
+                self.errors += 1
+                log.error("❌ Ошибка записи снимка состояния: %s", e)
+
+    def stats(self):
+        return {
+            'saves': self.saves,
+            'restored': self.restored,
+            'errors': self.errors,
+            'age_seconds': round(time.time() - self.saved_at, 1) if self.saved_at else -1,
+        }